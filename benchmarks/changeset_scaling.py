@@ -0,0 +1,80 @@
+"""Show that diffing the device listing against the previous backup scales linearly.
+
+Times the single pass Changeset against the set based diff used before it and
+reports time and traced memory per entry, which should stay flat as n grows.
+
+Usage: python benchmarks/changeset_scaling.py [--sizes 10000 100000 1000000] [--legacy-max 100000]
+"""
+
+import gc
+import tracemalloc
+from pathlib import Path
+from argparse import ArgumentParser
+
+from snbackup.files import SnFiles
+from snbackup.utilities import Timer
+from snbackup.changeset import diff_files
+
+
+def synthetic(n: int) -> tuple[list[tuple], list[tuple]]:
+    """Previous and current listings with 1% new, 1% modified and 1% deleted files."""
+    previous = [(f'Note/folder_{i % 500}/note_{i}.note', f'2024-07-{i % 28 + 1:02d} 10:00', i) for i in range(n)]
+    kept = previous[n // 100 :]
+    modified = [(uri, '2024-08-01 09:00', size + 1) for uri, _, size in kept[: n // 100]]
+    added = [(f'Note/new/note_{i}.note', '2024-08-01 09:00', i) for i in range(n // 100)]
+    current = modified + kept[n // 100 :] + added
+    return previous, current
+
+
+def changeset_diff(previous: list[tuple], current: list[tuple]):
+    before, today = Path('/backups/2024-07-31'), Path('/backups/2024-08-01')
+    previous_map = {uri: SnFiles(before, uri, date, size) for uri, date, size in previous}
+    changes = diff_files((SnFiles(today, uri, date, size) for uri, date, size in current), previous_map)
+    return len(changes.to_download), len(changes.unchanged), len(changes.deleted)
+
+
+def legacy_diff(previous: list[tuple], current: list[tuple]):
+    """The set based diff backup() used before the changeset engine."""
+    before, today = Path('/backups/2024-07-31'), Path('/backups/2024-08-01')
+    todays_files = {SnFiles(today, uri, date, size) for uri, date, size in current}
+    previous_files = {SnFiles(before, uri, date, size) for uri, date, size in previous}
+    symmetric = todays_files.symmetric_difference(previous_files)
+    deleted = [file for file in symmetric if file not in todays_files]
+    for file in deleted:
+        previous_files.discard(file)
+    to_download = todays_files.difference(previous_files)
+    unchanged = todays_files.intersection(previous_files)
+    return len(to_download), len(unchanged), len(deleted)
+
+
+def measure(func, previous, current) -> tuple[float, float]:
+    gc.collect()
+    with Timer() as timer:
+        func(previous, current)
+    gc.collect()
+    tracemalloc.start()
+    func(previous, current)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return timer.elapsed, peak
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--legacy-max', type=int, default=100_000, help='Largest size to run the set based diff at')
+    args = parser.parse_args()
+
+    print(f'{"engine":<10}{"entries":>10}{"seconds":>10}{"us/entry":>10}{"peak MB":>10}{"bytes/entry":>13}')
+    for n in args.sizes:
+        previous, current = synthetic(n)
+        engines = [('changeset', changeset_diff)]
+        if n <= args.legacy_max:
+            engines.append(('sets', legacy_diff))
+        for name, func in engines:
+            elapsed, peak = measure(func, previous, current)
+            print(f'{name:<10}{n:>10}{elapsed:>10.2f}{elapsed / n * 1e6:>10.2f}{peak / 1e6:>10.1f}{peak / n:>13.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Measure content-defined chunking speed and how much it saves on a growing notebook.
+
+Cuts random data with chunk_stream to report throughput, then stores a synthetic history
+of one .note file in the objects and the chunks layouts. Each version rewrites a small
+header and a trailing page index and appends a page, as the device does when a page is
+added, so whole-file dedup stores every version in full while chunks share the pages.
+
+Usage: python benchmarks/chunking.py [--megabytes 16] [--versions 30] [--pages 40]
+"""
+
+import os
+import random
+from pathlib import Path
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+from snbackup.objects import ChunkStore, ObjectStore
+from snbackup.chunking import chunk_stream
+from snbackup.utilities import Timer
+
+PAGE_SIZE = 48 * 1024
+BLOCK_SIZE = 64 * 1024
+
+
+def blocks(data: bytes):
+    for start in range(0, len(data), BLOCK_SIZE):
+        yield data[start : start + BLOCK_SIZE]
+
+
+def note_history(versions: int, pages: int) -> list[bytes]:
+    """Versions of a note that starts with `pages` pages and gains one per version."""
+    rng = random.Random(1)
+    content = [rng.randbytes(PAGE_SIZE) for _ in range(pages)]
+    history = []
+    for version in range(versions):
+        header = f'noteSN_FILE_VER_20230015 version {version} pages {len(content)}'.encode().ljust(1024, b'\0')
+        index = b''.join(f'PAGE{i}:{i * PAGE_SIZE};'.encode() for i in range(len(content)))
+        history.append(header + b''.join(content) + index)
+        content.append(rng.randbytes(PAGE_SIZE))
+    return history
+
+
+def disk_usage(folder: Path) -> int:
+    return sum(path.stat().st_size for path in folder.rglob('*') if path.is_file())
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--megabytes', type=int, default=16, help='Random data to time chunking on')
+    parser.add_argument('--versions', type=int, default=30, help='Backups of the note to store')
+    parser.add_argument('--pages', type=int, default=40, help='Pages in the first version of the note')
+    args = parser.parse_args()
+
+    data = os.urandom(args.megabytes * 1024**2)
+    with Timer() as timer:
+        sizes = [len(chunk) for chunk in chunk_stream(blocks(data))]
+    speed = len(data) / timer.elapsed / 1e6
+    print(f'chunk_stream: {speed:.1f} MB/s, {len(sizes)} chunks of {len(data) // len(sizes)} bytes on average')
+
+    history = note_history(args.versions, args.pages)
+    logical = sum(len(version) for version in history)
+    print(f'\n{"layout":<10}{"stored MB":>12}{"of logical":>12}{"seconds":>10}')
+    print(f'{"folders":<10}{logical / 1e6:>12.1f}{"100.0%":>12}{"":>10}')
+    for name, store_type in (('objects', ObjectStore), ('chunks', ChunkStore)):
+        with TemporaryDirectory() as tmp:
+            store = store_type(Path(tmp))
+            with Timer() as timer:
+                for version in history:
+                    store.add_stream(blocks(version), expected_size=len(version))
+            stored = disk_usage(Path(tmp))
+        print(f'{name:<10}{stored / 1e6:>12.1f}{stored / logical:>12.1%}{timer.elapsed:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
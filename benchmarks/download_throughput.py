@@ -0,0 +1,54 @@
+"""Compare serial and concurrent download throughput against the local device simulator.
+
+Usage: python benchmarks/download_throughput.py [--files 200] [--size 50000] [--latency 0.02] [--workers 8]
+"""
+
+from pathlib import Path
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+from snbackup import backup
+from snbackup.files import SnFiles
+from snbackup.device import Device
+from snbackup.utilities import Timer
+from snbackup.helpers import bytes_to_mb
+from snbackup.traffic import TrafficController
+from snbackup.simulator import DeviceSimulator, SyntheticTree
+
+
+def run(device: Device, listing: list[tuple], workers: int) -> float:
+    with TemporaryDirectory() as tmp:
+        files = {SnFiles(Path(tmp), uri, date, size) for uri, date, size in listing}
+        with Timer() as timer:
+            downloaded, skipped, failed = backup.download_files(device, files, workers=workers)
+    assert not failed, f'{len(failed)} downloads failed'
+    return timer.elapsed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=50_000)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    backup.create_logger(__file__, level='WARNING', running_tests=True)
+
+    tree = SyntheticTree.generate(args.files, median_size=args.size, sigma=0.0)
+    with DeviceSimulator(tree, latency=args.latency) as simulator:  # Latency simulates the Wi-Fi round trip
+        device = Device(simulator.url, timeout=30, traffic=TrafficController(args.workers))
+        listing = list(backup.device_uri_gen(device, [{'uri': 'Note', 'isDirectory': True}], workers=args.workers))
+        total = tree.total_size
+        print(f'{args.files} files, {bytes_to_mb(total)} MB total, {args.latency * 1000:.0f} ms latency per request')
+        try:
+            for workers in (1, args.workers):
+                elapsed = run(device, listing, workers)
+                rate = bytes_to_mb(total / elapsed)
+                print(f'workers={workers:<3} {elapsed:6.2f}s  {args.files / elapsed:7.1f} files/s  {rate} MB/s')
+        finally:
+            device.close()
+
+
+if __name__ == '__main__':
+    main()
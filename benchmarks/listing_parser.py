@@ -0,0 +1,65 @@
+"""Compare the regex listing parser with the fast string search parser on large folders.
+
+Builds synthetic Browse & Access listing pages and times extracting their file
+details with each parser.
+
+Usage: python benchmarks/listing_parser.py [--sizes 10 100 1000 10000 100000] [--repeat 5]
+"""
+
+import json
+import timeit
+from argparse import ArgumentParser
+
+from snbackup import backup
+
+
+def synthetic_page(n: int) -> str:
+    """A folder listing page holding n note files, laid out like the device serves it."""
+    entries = [
+        {
+            'date': f'2024-07-{i % 28 + 1:02d} 10:{i % 60:02d}',
+            'extension': 'note',
+            'isDirectory': False,
+            'name': f'note {i}.note',
+            'size': 1000 + i,
+            'uri': f'/Note/Big Folder/note {i}.note',
+        }
+        for i in range(n)
+    ]
+    listing = {
+        'availableMemory': 23330586624,
+        'deviceName': 'Supernote',
+        'fileList': entries,
+        'routeList': [{'name': 'Supernote', 'path': '/'}, {'name': 'Note', 'path': '/Note'}],
+        'totalMemory': 32.0,
+    }
+    payload = json.dumps(listing, separators=(',', ':'), ensure_ascii=False)
+    return f"<html><body><div id='table-item'></div><script>const json = '{payload}'\n</script></body></html>"
+
+
+def regex_parser(html_text: str) -> list[dict]:
+    return backup.load_parsed(backup.parse_html(html_text))
+
+
+def fast_parser(html_text: str) -> list[dict]:
+    return backup.listing_entries(html_text)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10_000, 100_000])
+    parser.add_argument('--repeat', type=int, default=5, help='Best of this many runs is reported')
+    args = parser.parse_args()
+
+    print(f'{"entries":>10}{"page KB":>10}{"regex ms":>12}{"fast ms":>12}{"speedup":>10}')
+    for n in args.sizes:
+        page = synthetic_page(n)
+        assert regex_parser(page) == fast_parser(page)
+        number = max(1, 10_000 // n)
+        regex = min(timeit.repeat(lambda: regex_parser(page), number=number, repeat=args.repeat)) / number
+        fast = min(timeit.repeat(lambda: fast_parser(page), number=number, repeat=args.repeat)) / number
+        print(f'{n:>10}{len(page) / 1024:>10.0f}{regex * 1000:>12.3f}{fast * 1000:>12.3f}{regex / fast:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
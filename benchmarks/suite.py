@@ -0,0 +1,316 @@
+"""Time the backup hot paths at realistic and extreme scales without a device.
+
+Each case builds its own synthetic input, is timed over several repeats and reported
+as best and median seconds plus microseconds per item. Results can be saved as JSON
+and compared against an earlier run to spot regressions between releases.
+
+Usage: python benchmarks/suite.py [--scale realistic|extreme] [--only NAME ...] [--repeat 5]
+                                  [--output results.json] [--compare baseline.json]
+"""
+
+import gc
+import json
+import shutil
+import platform
+import statistics
+from pathlib import Path
+from datetime import datetime
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from importlib.metadata import version
+
+from snbackup import backup
+from snbackup.files import SnFiles
+from snbackup.metadata import MetadataStore
+from snbackup.changeset import diff_files
+from snbackup.storage import Durability
+from snbackup.utilities import Timer
+from snbackup.helpers import recursive_scan
+from snbackup.snapshots import scan_snapshot
+from snbackup.packs import Pack
+from snbackup.objects import file_digest
+
+from listing_parser import synthetic_page
+from changeset_scaling import synthetic
+
+# Items each case runs over at each scale
+SCALES = {
+    'realistic': {
+        'snfiles_construct': 10_000,
+        'snfiles_set': 10_000,
+        'file_hash': 200,
+        'changeset_diff': 10_000,
+        'legacy_json_import': 10_000,
+        'commit_run': 10_000,
+        'previous_map': 10_000,
+        'parse_html': 1_000,
+        'listing_entries': 1_000,
+        'recursive_scan': 2_000,
+        'snapshot_scan': 2_000,
+        'cleanup_backups': 2_000,
+        'pack_snapshot': 2_000,
+    },
+    'extreme': {
+        'snfiles_construct': 1_000_000,
+        'snfiles_set': 1_000_000,
+        'file_hash': 2_000,
+        'changeset_diff': 1_000_000,
+        'legacy_json_import': 200_000,
+        'commit_run': 200_000,
+        'previous_map': 200_000,
+        'parse_html': 100_000,
+        'listing_entries': 100_000,
+        'recursive_scan': 50_000,
+        'snapshot_scan': 50_000,
+        'cleanup_backups': 50_000,
+        'pack_snapshot': 50_000,
+    },
+}
+
+BASE = Path('/backups/2024-08-01')
+HASH_PAYLOAD = b'x' * 256 * 1024
+
+
+def listing(n: int) -> list[tuple]:
+    return [(f'Note/folder_{i % 500}/note_{i}.note', f'2024-07-{i % 28 + 1:02d} 10:00', i) for i in range(n)]
+
+
+def records(n: int) -> list[dict]:
+    return [SnFiles(BASE, uri, date, size).make_record() for uri, date, size in listing(n)]
+
+
+def snapshot_tree(root: Path, n: int, snapshots=1) -> None:
+    """Write n small files spread over snapshot folders with up to 100 files per subfolder."""
+    per_snapshot = max(1, n // snapshots)
+    for s in range(snapshots):
+        snapshot = root.joinpath(f'2024-{s // 28 + 1:02d}-{s % 28 + 1:02d}')
+        for i in range(per_snapshot):
+            folder = snapshot.joinpath('Note', f'folder_{i // 100}')
+            if i % 100 == 0:
+                folder.mkdir(parents=True)
+            folder.joinpath(f'note_{i}.note').write_bytes(b'note')
+
+
+# Each case is prepare(n, tmp) -> state and run(state). Prepare is called before every
+# repeat and is not timed, so cases that delete or write files start from the same place.
+
+
+def prepare_listing(n, tmp):
+    return listing(n)
+
+
+def run_snfiles_construct(rows):
+    return [SnFiles(BASE, uri, date, size) for uri, date, size in rows]
+
+
+def prepare_snfiles(n, tmp):
+    return run_snfiles_construct(listing(n))
+
+
+def run_snfiles_set(files):
+    return set(files)
+
+
+def prepare_file_hash(n, tmp):
+    clean(tmp)
+    payload = tmp.joinpath('payload.note')
+    payload.write_bytes(HASH_PAYLOAD)
+    return [payload] * n
+
+
+def run_file_hash(paths):
+    return [file_digest(path) for path in paths]
+
+
+def prepare_changeset(n, tmp):
+    previous, current = synthetic(n)
+    previous_map = {uri: SnFiles(BASE, uri, date, size) for uri, date, size in previous}
+    return previous_map, current
+
+
+def run_changeset(state):
+    previous_map, current = state
+    today = Path('/backups/2024-08-02')
+    return diff_files((SnFiles(today, uri, date, size) for uri, date, size in current), dict(previous_map))
+
+
+def prepare_legacy_json(n, tmp):
+    clean(tmp)
+    metadata_file = tmp.joinpath('metadata.json')
+    metadata_file.write_text(json.dumps(records(n)))
+    return metadata_file, tmp.joinpath(MetadataStore.file_name)
+
+
+def run_legacy_json(state):
+    metadata_file, db_path = state
+    store = MetadataStore(db_path)
+    try:
+        return store.import_records(backup.previous_record_gen(metadata_file))
+    finally:
+        store.close()
+
+
+def prepare_commit_run(n, tmp):
+    clean(tmp)
+    store = MetadataStore(tmp.joinpath(MetadataStore.file_name))
+    return store, store.begin_run('2024-08-01'), records(n)
+
+
+def run_commit_run(state):
+    store, run_id, rows = state
+    try:
+        store.commit_run(run_id, rows, downloaded=len(rows))
+    finally:
+        store.close()
+
+
+def prepare_previous_map(n, tmp):
+    state = prepare_commit_run(n, tmp)
+    run_commit_run(state)
+    return tmp.joinpath(MetadataStore.file_name)
+
+
+def run_previous_map(db_path):
+    store = MetadataStore(db_path)
+    try:
+        return store.previous_map()
+    finally:
+        store.close()
+
+
+def prepare_page(n, tmp):
+    return synthetic_page(n)
+
+
+def run_parse_html(page):
+    return backup.load_parsed(backup.parse_html(page))
+
+
+def run_listing_entries(page):
+    return backup.listing_entries(page)
+
+
+def prepare_scan(n, tmp):
+    clean(tmp)
+    snapshot_tree(tmp, n)
+    return tmp
+
+
+def run_scan(root):
+    return recursive_scan(root)
+
+
+def run_snapshot_scan(root):
+    return scan_snapshot(root)
+
+
+def prepare_cleanup(n, tmp):
+    clean(tmp)
+    snapshot_tree(tmp, n, snapshots=20)
+    return tmp
+
+
+def run_cleanup(root):
+    backup.cleanup_backups(root, num_backups=1, cleanup=True)
+
+
+def prepare_pack(n, tmp):
+    clean(tmp)
+    snapshot_tree(tmp, n)
+    return tmp.joinpath('2024-01-01')
+
+
+def run_pack(folder):
+    return Pack.create(folder, durability=Durability('none'))
+
+
+def clean(tmp: Path) -> None:
+    for item in tmp.iterdir():
+        shutil.rmtree(item) if item.is_dir() else item.unlink()
+
+
+CASES = {
+    'snfiles_construct': (prepare_listing, run_snfiles_construct),
+    'snfiles_set': (prepare_snfiles, run_snfiles_set),
+    'file_hash': (prepare_file_hash, run_file_hash),
+    'changeset_diff': (prepare_changeset, run_changeset),
+    'legacy_json_import': (prepare_legacy_json, run_legacy_json),
+    'commit_run': (prepare_commit_run, run_commit_run),
+    'previous_map': (prepare_previous_map, run_previous_map),
+    'parse_html': (prepare_page, run_parse_html),
+    'listing_entries': (prepare_page, run_listing_entries),
+    'recursive_scan': (prepare_scan, run_scan),
+    'snapshot_scan': (prepare_scan, run_snapshot_scan),
+    'cleanup_backups': (prepare_cleanup, run_cleanup),
+    'pack_snapshot': (prepare_pack, run_pack),
+}
+
+
+def measure(name: str, n: int, repeat: int) -> dict:
+    prepare, run = CASES[name]
+    timer = Timer()
+    with TemporaryDirectory() as tmp:
+        for _ in range(repeat):
+            state = prepare(n, Path(tmp))
+            gc.collect()
+            with timer:
+                run(state)
+            del state
+    best = min(timer.runs)
+    return {
+        'name': name,
+        'n': n,
+        'repeat': repeat,
+        'best': best,
+        'median': statistics.median(timer.runs),
+        'us_per_item': best / n * 1e6,
+    }
+
+
+def compare(results: list[dict], baseline_file: Path) -> None:
+    baseline = {(row['name'], row['n']): row for row in json.loads(baseline_file.read_text())['results']}
+    print(f'\nCompared with {baseline_file} (best time, lower is better)')
+    for row in results:
+        old = baseline.get((row['name'], row['n']))
+        if old is None:
+            print(f'{row["name"]:<20}{"not in baseline":>30}')
+            continue
+        change = (row['best'] - old['best']) / old['best'] * 100
+        print(f'{row["name"]:<20}{old["best"]:>10.4f}{row["best"]:>10.4f}{change:>+9.1f}%')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--scale', choices=SCALES, default='realistic')
+    parser.add_argument('--only', nargs='+', choices=CASES, help='Run only these cases')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', type=Path, help='Save results as JSON to this file')
+    parser.add_argument('--compare', type=Path, help='JSON results from an earlier run to compare against')
+    args = parser.parse_args()
+
+    backup.create_logger(__file__, level='WARNING', running_tests=True)
+
+    print(f'{"case":<20}{"n":>10}{"best s":>10}{"median s":>10}{"us/item":>10}')
+    results = []
+    for name in args.only or CASES:
+        row = measure(name, SCALES[args.scale][name], args.repeat)
+        results.append(row)
+        print(f'{name:<20}{row["n"]:>10}{row["best"]:>10.4f}{row["median"]:>10.4f}{row["us_per_item"]:>10.2f}')
+
+    if args.output:
+        report = {
+            'snbackup': version('snbackup'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'scale': args.scale,
+            'results': results,
+        }
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f'\nSaved results to {args.output}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,37 @@
+from __future__ import annotations
+
 import os
 import re
 import json
-import shutil
 import itertools as it
 from pathlib import Path
+from hashlib import sha256
+from datetime import date, timedelta
+from collections import Counter
+from collections import deque
+from typing import TYPE_CHECKING
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
-import httpx
-
-from .files import SnFiles
-from .device import Device
+from .files import SnFiles, SizeMismatchError
+from .traffic import TrafficController
 from .setup import SetupConf
+from .metadata import MetadataStore
+from .snapshots import (
+    SCAN_WORKERS,
+    SnapshotUsage,
+    rebased,
+    freed_bytes,
+    scan_snapshot,
+    snapshot_folders,
+    rescan_snapshots,
+)
+from .retention import RetentionPolicy, prune_backups
+from .objects import LAYOUTS, STORES, ObjectStore
+from .packs import Pack, packed_snapshots
+from .changeset import Changeset, diff_files
+from .storage import LINK_MODES, DURABILITY_MODES, Durability, carry_file, temp_file
+from .metrics import RunMetrics
+from .profiling import tracer
 from .utilities import CustomLogger, truncate_log
 from .helpers import (
     EXTS,
@@ -19,11 +41,24 @@ from .helpers import (
     today_pth,
     load_config,
     bytes_to_mb,
-    count_backups,
-    recursive_scan,
     locate_config,
 )
 
+# httpx is only imported once the device is contacted, keeping -v, -ls and --setup quick
+if TYPE_CHECKING:
+    import httpx
+
+    from .device import Device
+
+
+CHUNK_SIZE = 256 * 1024
+
+LISTING_RE = re.compile(r"const json = '(?P<json_str>{.*?})'")
+LISTING_MARKER = "const json = '"
+FILE_LIST_KEY = '"fileList":'
+
+_decoder = json.JSONDecoder()
+
 
 def create_logger(log_file_name: str, level='INFO', *, running_tests=False) -> None:
     """Set up a global logger to be used throughout the program."""
@@ -37,10 +72,12 @@ def create_logger(log_file_name: str, level='INFO', *, running_tests=False) -> N
 
 def talk_to_device(device: Device, uri: str, document=None) -> httpx.Response:
     """Wrapper to handle calling device, logging, and managing exceptions"""
+    import httpx
+
     try:
         response = device.http_request(uri, document)
     except (httpx.ConnectTimeout, httpx.ConnectError) as e:
-        logger.error(f'Unable to reach Supernote device: {e!r}')
+        logger.error(f'Unable to reach Supernote device after {device.retries} retries: {e!r}')
         raise SystemExit(1)
     except httpx.HTTPError as e:
         logger.error(f'Unhandled error: {e!r}')
@@ -48,7 +85,7 @@ def talk_to_device(device: Device, uri: str, document=None) -> httpx.Response:
     return response
 
 
-def parse_html(html_text: str, regex_str=r"const json = '(?P<json_str>{.*?})'") -> str:
+def parse_html(html_text: str, regex_str=LISTING_RE) -> str:
     """Search for and extract a particular json string in html."""
     try:
         re_match = re.search(regex_str, html_text)
@@ -69,40 +106,254 @@ def load_parsed(parsed: str) -> list[dict] | list:
     return parsed_dict.get('fileList', [])
 
 
-def device_uri_gen(device: Device, file_details: list[dict]):
-    """Recursive generator to extract uri, modified date, and file size."""
-    for file in file_details:
-        file_uri = file.get('uri').lstrip('/')  # Drop anchor slash to call joinpath later and it work
-        if not file.get('isDirectory'):
-            yield file_uri, file.get('date'), file.get('size')
-        else:
-            html = talk_to_device(device, file_uri)
-            re_parse = parse_html(html.text)
-            new_file_details = load_parsed(re_parse)
-            yield from device_uri_gen(device, new_file_details)
+def extract_file_list(html_text: str) -> list[dict] | None:
+    """Fast path for folder listings. Finds the embedded json with plain string searches
+    and decodes only its fileList array. Returns None if the page isn't laid out as expected.
+    """
+    start = html_text.find(LISTING_MARKER)
+    if start == -1:
+        return None
+    key = html_text.find(FILE_LIST_KEY, start)
+    if key == -1:
+        return None
+    pos = key + len(FILE_LIST_KEY)
+    while html_text[pos : pos + 1].isspace():
+        pos += 1
+    try:
+        file_list, _ = _decoder.raw_decode(html_text, pos)
+    except json.JSONDecodeError:
+        return None
+    return file_list if isinstance(file_list, list) else None
+
 
+def listing_entries(html_text: str) -> list[dict]:
+    """File details from a device folder listing, falling back to the regex parser. The fast
+    path decodes the whole fileList array in one call, as decoding it one entry at a time is
+    slower on large folders.
+    """
+    file_list = extract_file_list(html_text)
+    if file_list is None:
+        file_list = load_parsed(parse_html(html_text))
+    return file_list
 
-def save_file(local_pth: Path, file: bytes) -> None:
-    """Make parent directory and write file bytes object to local disk."""
-    local_pth.parent.mkdir(exist_ok=True, parents=True)
 
-    logger.info(f'Saving {local_pth.stem!r} to {local_pth}')
-    with open(local_pth, 'wb') as file_output:
-        file_output.write(file)
-        file_output.flush()
-        os.fsync(file_output.fileno())
+def list_directory(device: Device, uri: str) -> list[dict]:
+    """Fetch a single folder listing from device and return its file details."""
+    with tracer.span('list_request', uri=uri) as span:
+        html = talk_to_device(device, uri)
+        span.add(nbytes=len(html.content), requests=1)
+        return listing_entries(html.text)
+
 
+def device_uri_gen(device: Device, file_details: list[dict], *, workers=1, folder_cache=None, listed=None):
+    """Breadth-first generator to extract uri, modified date, and file size.
+    Sibling folders are listed concurrently with at most `workers` listing requests in flight.
+
+    folder_cache maps a folder uri to the (date, entries) seen by an earlier crawl. A folder
+    whose listed date still matches is not fetched again and its cached entries are used in
+    its place. When given, listed collects the (date, entries) of every folder walked.
+    """
+    workers = max(1, workers)
+    folder_cache = folder_cache or {}
+    listed = {} if listed is None else listed
+    entries = deque(file_details)
+    folders = deque()
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            while entries:
+                file = entries.popleft()
+                file_uri = file.get('uri').lstrip('/')  # Drop anchor slash to call joinpath later and it work
+                if not file.get('isDirectory'):
+                    yield file_uri, file.get('date'), file.get('size')
+                    continue
+                date = file.get('date')
+                cached_date, cached_entries = folder_cache.get(file_uri, (None, None))
+                if date and date == cached_date:
+                    listed[file_uri] = (date, cached_entries)
+                    entries.extend(cached_entries)
+                else:
+                    folders.append((file_uri, date))
 
-def save_records(file_records: list[dict], json_md: Path) -> None:
-    """Persist today's file metadata to json file."""
-    logger.info('Saving file records to metadata json file')
-    with open(json_md, 'wt') as json_out:
-        print(json.dumps(file_records), file=json_out)
+            while folders and len(in_flight) < workers:
+                folder_uri, date = folders.popleft()
+                in_flight[pool.submit(list_directory, device, folder_uri)] = (folder_uri, date)
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for listing in done:
+                folder_uri, date = in_flight.pop(listing)
+                children = [folder_entry(file) for file in listing.result()]
+                listed[folder_uri] = (date, children)
+                entries.extend(children)
+
+
+def folder_entry(file: dict) -> dict:
+    """Keep only the listing fields the crawl uses, so cached folder listings stay small."""
+    return {key: file.get(key) for key in ('uri', 'isDirectory', 'date', 'size')}
+
+
+def already_saved(snfile: SnFiles, today: Path) -> bool:
+    """Check today's backup for a file matching the device listing's size and modified date,
+    e.g. one saved by an earlier run on the same day.
+    """
+    try:
+        stat = today.joinpath(snfile.file_uri).stat()
+    except OSError:
+        return False
+    return stat.st_size == snfile.file_size and int(stat.st_mtime) == int(snfile.last_modified.timestamp())
+
+
+def stamp_modified(local_pth: Path, snfile: SnFiles) -> None:
+    """Set a saved file's modification time to the modified date listed on device."""
+    mtime = snfile.last_modified.timestamp()
+    os.utime(local_pth, (mtime, mtime))
+
+
+def download_file(device: Device, new_file: SnFiles, durability=None, objects=None) -> SnFiles:
+    """Stream a single file from device straight to local disk, or into the object store
+    when one is given, retrying transient failures.
+    """
+    return device.retry(_download_attempt, device, new_file, durability, objects, retry_on=(SizeMismatchError,))
+
+
+def _download_attempt(device: Device, new_file: SnFiles, durability=None, objects=None, *, attempt=0) -> SnFiles:
+    with tracer.span('download_request', uri=new_file.file_uri, attempt=attempt) as span:
+        with device.stream_request(new_file.file_uri, size=new_file.file_size, attempt=attempt) as download_response:
+            chunks = device.read_chunks(download_response, CHUNK_SIZE)
+            if objects is not None:
+                new_file.file_hash = objects.add_stream(chunks, expected_size=new_file.file_size)
+                logger.info(f'Stored {new_file.file_uri!r} as object {new_file.file_hash[:12]}')
+            else:
+                new_file.file_hash = save_stream(
+                    new_file.full_path,
+                    chunks,
+                    expected_size=new_file.file_size,
+                    mtime=new_file.last_modified.timestamp(),
+                    durability=durability,
+                )
+        span.add(nbytes=new_file.file_size, requests=1)
+    return new_file
+
+
+def download_files(
+    device: Device, to_download, *, workers=1, skip_present=False, durability=None, objects=None
+) -> tuple[list, list, list]:
+    """Download files from device using a bounded pool of worker threads.
+    Files already saved in today's backup are skipped when skip_present is set.
+    Failures are logged per file and returned instead of aborting the run.
+    """
+    import httpx
+
+    downloaded, skipped, failed = [], [], []
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for new_file in to_download:
+            if skip_present and already_saved(new_file, new_file.base_path):
+                logger.info(f'Skipping {new_file.file_uri}, already saved today')
+                skipped.append(new_file)
+                continue
+            futures[pool.submit(download_file, device, new_file, durability, objects)] = new_file
+
+        for future in as_completed(futures):
+            new_file = futures[future]
+            try:
+                future.result()
+            except (httpx.HTTPError, OSError, SizeMismatchError) as e:
+                logger.error(f'Failed to download {new_file.file_uri}: {e!r}')
+                failed.append(new_file)
+            else:
+                downloaded.append(new_file)
+    return tuple(sorted(files, key=lambda f: f.file_uri) for files in (downloaded, skipped, failed))
+
+
+def changed_files(device_files, changes: Changeset, today: Path):
+    """Feed each file from the device crawl to the changeset as it arrives
+    and yield back the new or modified ones.
+    """
+    for uri, mdate, size in device_files:
+        current = SnFiles(today, uri, mdate, size)
+        if changes.add(current):
+            yield current
+    # Files that only looked like moves are known once every folder has been listed
+    yield from changes.finish()
+
+
+def pipeline_backup(
+    device: Device,
+    device_files,
+    changes: Changeset,
+    today: Path,
+    *,
+    workers=1,
+    full=False,
+    durability=None,
+    objects=None,
+) -> tuple[list, list, list]:
+    """Diff each file against the previous backup as soon as the crawl yields it and queue new
+    or modified files for download right away, so transfers overlap the folder listing.
+    Deleted files are determined once the crawl completes.
+    """
+    results = download_files(
+        device,
+        changed_files(device_files, changes, today),
+        workers=workers,
+        skip_present=not full,
+        durability=durability,
+        objects=objects,
+    )
+    return results
+
+
+def download_summary(downloaded: list[SnFiles], skipped: list[SnFiles], failed: list[SnFiles]) -> None:
+    """Log an ordered summary of downloaded, skipped and failed files."""
+    total = sum(file.file_size for file in downloaded)
+    logger.info(f'Downloaded {len(downloaded)} files ({bytes_to_mb(total)} MB)')
+    for c, file in enumerate(downloaded, start=1):
+        logger.info(f'{c}.{file.file_uri} ({bytes_to_mb(file.file_size)} MB)')
+    if skipped:
+        logger.info(f'Skipped {len(skipped)} files already saved in today\'s backup.')
+    if failed:
+        logger.warning(f'{len(failed)} files failed to download and will be retried next run:')
+        for c, file in enumerate(failed, start=1):
+            logger.warning(f'{c}.{file.file_uri}')
+
+
+def save_stream(local_pth: Path, chunks, *, expected_size=None, mtime=None, durability=None) -> str:
+    """Write chunks to a temp file beside local_pth while hashing them, then
+    atomically rename into place. Returns the SHA-256 hex digest.
+    """
+    durability = durability or Durability()
+    durability.makedirs(local_pth.parent)
+
+    logger.info(f'Saving {local_pth.stem!r} to {local_pth}')
+    digest, received = sha256(), 0
+    fd, temp_name = temp_file(local_pth.parent, local_pth.name)
+    try:
+        with open(fd, 'wb') as file_output:
+            for chunk in chunks:
+                digest.update(chunk)
+                received += len(chunk)
+                file_output.write(chunk)
+            file_output.flush()
+            if durability.mode == 'file':
+                os.fsync(file_output.fileno())
+        if expected_size is not None and received != expected_size:
+            raise SizeMismatchError(f'Received {received} bytes, device listed {expected_size}')
+        if mtime is not None:
+            os.utime(temp_name, (mtime, mtime))
+        os.replace(temp_name, local_pth)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+    durability.written(local_pth, synced=True)
+    return digest.hexdigest()
 
 
 def previous_record_gen(json_md: Path, *, previous=None):
-    """Retreive last backup metadata found locally and yield
-    back relevant info to instantiate file objects.
+    """Retreive backup metadata from a legacy metadata.json file and yield
+    back relevant info to import into the metadata store.
     """
     try:
         with open(json_md) as json_in:
@@ -115,45 +366,418 @@ def previous_record_gen(json_md: Path, *, previous=None):
         previous = previous or []
 
     for record in previous:
-        yield (record.get('current_loc'), record.get('uri'), record.get('modified'), record.get('size'))
-
-
-def check_for_deleted(current: set, previous: set) -> list[SnFiles]:
-    """Look for files no longer on device from last backup."""
-    symmetric = current.symmetric_difference(previous)
-    return [file for file in symmetric if file not in current]
+        yield (
+            record.get('current_loc'),
+            record.get('uri'),
+            record.get('modified'),
+            record.get('size'),
+            record.get('hash'),
+        )
 
 
 def prepare_upload(ufile: list):
-    """Prepare file upload to send to device."""
+    """Yield the files to upload that exist and have an extension the device accepts,
+    dropping any whose name was already given, as they would land on the same device path.
+    """
+    names = set()
     for file in (Path(file) for file in ufile):
-        if file.is_file() and file.suffix.casefold() in EXTS:
-            yield {f'{file.name}': open(file, 'rb')}
+        if not (file.is_file() and file.suffix.casefold() in EXTS):
+            logger.warning(f'Not uploading {file}, it is missing or not a supported file type')
+        elif file.name in names:
+            logger.warning(f'Not uploading {file}, another file named {file.name!r} is already being uploaded')
+        else:
+            names.add(file.name)
+            yield file
+
+
+def upload_file(device: Device, local_pth: Path, destination: str) -> int:
+    """Stream a single file from disk to a device folder. Returns the size the device reports."""
+    with tracer.span('upload_request', file=local_pth.name) as span, open(local_pth, 'rb') as file_in:
+        response = device.http_request(destination, {local_pth.name: file_in}, size=os.fstat(file_in.fileno()).st_size)
+        size = sum(resp.get('size', 0) for resp in response.json())
+        span.add(nbytes=size, requests=1)
+    return size
+
+
+def upload_files(device: Device, to_upload: list, destination: str, *, workers=1) -> tuple[list, list, list]:
+    """Upload files to a device folder with up to `workers` uploads in flight. Files already in
+    the folder with the same name and size are skipped. Failures are logged per file and
+    returned instead of aborting the rest. Returns (uploaded, skipped, failed) lists of paths.
+    """
+    import httpx
+
+    candidates = list(prepare_upload(to_upload))
+    if not candidates:
+        return [], [], []
+
+    on_device = {
+        Path(entry.get('uri', '')).name: entry.get('size')
+        for entry in list_directory(device, destination)
+        if not entry.get('isDirectory')
+    }
+    uploaded, skipped, failed = [], [], []
+    to_send = []
+    for file in candidates:
+        if on_device.get(file.name) == file.stat().st_size:
+            logger.info(f'Skipping {file.name}, already in {destination} folder on device')
+            skipped.append(file)
+        else:
+            to_send.append(file)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(upload_file, device, file, destination): file for file in to_send}
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                size = future.result()
+            except (httpx.HTTPError, OSError, ValueError) as e:
+                logger.error(f'Failed to upload {file.name}: {e!r}')
+                failed.append(file)
+                continue
+            logger.info(f'Uploaded {file.name} to {destination} folder ({bytes_to_mb(size)} MB)')
+            uploaded.append(file)
+    return sorted(uploaded), sorted(skipped), sorted(failed)
+
+
+def upload_summary(uploaded: list, skipped: list, failed: list, destination: str) -> None:
+    """Log the result of each upload."""
+    if not (uploaded or skipped or failed):
+        logger.info('No files to upload.')
+        return
+    logger.info(f'Upload complete: {len(uploaded)} uploaded, {len(skipped)} already on device, {len(failed)} failed')
+    for label, files in (('uploaded', uploaded), ('already on device', skipped), ('FAILED', failed)):
+        for file in files:
+            logger.info(f'  {file.name}: {label} ({destination})')
+
+
+def snapshot_names(base_dir: Path, objects=None) -> list[str]:
+    """Names of the backups in base_dir, oldest first: the dated folders and packs, or the manifests
+    in the object store.
+    """
+    if objects is not None:
+        return objects.snapshots()
+    return sorted({folder.name for folder in snapshot_folders(base_dir)}.union(packed_snapshots(base_dir)))
+
+
+def backup_paths(folder: Path) -> list[Path]:
+    """What holds a backup on disk: its dated folder, its pack and index, or both after an interrupted --pack."""
+    return ([folder] if folder.is_dir() else []) + Pack(folder.parent, folder.name).paths()
+
+
+def cleanup_backups(
+    base_dir: Path, *, num_backups=0, cleanup=False, retention=None, dry_run=False, workers=SCAN_WORKERS, objects=None
+) -> list[Path]:
+    """Delete old backups from the backup save directory on local disk, keeping those the retention
+    policy selects or, without one, the last num_backups. Returns the folders removed, or that
+    would be with dry_run.
+    """
+    if retention is None:
+        retention = RetentionPolicy(daily=num_backups) if cleanup and num_backups > 0 else RetentionPolicy()
+    if not retention:
+        return []
+    names = snapshot_names(base_dir, objects)
+    keep = retention.keep(names)
+    doomed = [base_dir.joinpath(name) for name in names if name not in keep]
+    if dry_run:
+        for folder in doomed:
+            logger.info(f'Would remove backup: {folder}')
+        if objects is not None:
+            freed = bytes_to_mb(objects.freed_bytes([folder.name for folder in doomed]))
+        else:
+            packs = [Pack(base_dir, folder.name) for folder in doomed]
+            folders = [folder for folder in doomed if folder.is_dir()]
+            freed = bytes_to_mb(freed_bytes(folders, workers=workers) + sum(pack.disk_bytes() for pack in packs))
+        logger.info(f'Dry run: keeping {len(keep)} backups ({retention}), removing {len(doomed)} would free {freed} MB')
+        return doomed
+    logger.info(f'Removing old backups, keeping {retention}')
+    for folder in doomed:
+        logger.info(f'Removing backup: {folder}')
+    if objects is not None:
+        deleted = objects.remove([folder.name for folder in doomed])
+        logger.info(f'Deleted {deleted} objects no longer held by any backup')
+    else:
+        prune_backups(base_dir, [path for folder in doomed for path in backup_paths(folder)], workers=workers)
+    return doomed
+
+
+def index_snapshot(store: MetadataStore, today: Path, objects=None) -> None:
+    """Record the size of today's backup in the snapshot index read by -ls."""
+    if objects is not None:
+        names = objects.snapshots()
+        if today.name not in names:
+            return
+        earlier = names[: names.index(today.name)]
+        usage = objects.usage(today.name, earlier[-1] if earlier else None)
+    elif today.is_dir():
+        usage, _ = scan_snapshot(today)
+    else:
+        return
+    store.save_usage([usage])
+    logger.info(
+        f'Backup {today.name} holds {usage.files} files ({bytes_to_mb(usage.bytes)} MB, '
+        f'{bytes_to_mb(usage.unique_bytes)} MB not shared with the backup before)'
+    )
+
+
+def reindex_after_cleanup(store: MetadataStore, save_dir: Path, removed: list[Path], objects=None) -> None:
+    """Drop removed backups from the snapshot index. A backup that followed a removed one may
+    hold data it shared with it, so it is measured again against the backup now before it.
+    """
+    if not removed:
+        return
+    gone = {folder.name for folder in removed}
+    store.forget_usage(gone)
+    for previous, name in rebased(snapshot_names(save_dir, objects) + list(gone), gone):
+        if objects is not None:
+            store.save_usage([objects.usage(name, previous)])
+        else:
+            store.save_usage([measure_backup(save_dir, name, previous)])
 
 
-def upload_files(device: Device, to_upload: list, destination: str) -> str | None:
-    """Uploads chosen files to remote device."""
-    response = None
-    for file in prepare_upload(to_upload):
-        response = talk_to_device(device, destination, file)
-        for resp in response.json():
-            file, size = resp.get('name'), resp.get('size', 0)
-            logger.info(f'Uploaded {file} to {destination} folder ({bytes_to_mb(size)} MB)')
-    return 'Upload complete' if response else None
+def measure_backup(save_dir: Path, name: str, previous=None) -> SnapshotUsage:
+    """Size of a backup in the folders layout, leaving out data hard linked from the backup
+    before it. A pack shares nothing, with the backups before or after it.
+    """
+    pack = Pack(save_dir, name)
+    if pack.exists():
+        return pack.usage()
+    inodes = set()
+    if previous and not Pack(save_dir, previous).exists():
+        inodes = scan_snapshot(save_dir.joinpath(previous))[1]
+    return scan_snapshot(save_dir.joinpath(name), previous=inodes)[0]
+
+
+def rescan_backups(save_dir: Path, *, workers=SCAN_WORKERS):
+    """Yield the usage of every backup in the folders layout, oldest first, reading packs from their index."""
+    packed = set(packed_snapshots(save_dir))
+    # Each run of folders between packs is measured together, every folder against the one before it
+    folders = []
+    for name in snapshot_names(save_dir):
+        if name not in packed:
+            folders.append(save_dir.joinpath(name))
+            continue
+        yield from rescan_snapshots(folders, workers=workers)
+        folders = []
+        yield Pack(save_dir, name).usage()
+    yield from rescan_snapshots(folders, workers=workers)
+
+
+def list_backups(save_dir: Path, store: MetadataStore, *, rescan=False, workers=SCAN_WORKERS, objects=None) -> None:
+    """Log the size of each backup from the snapshot index, rebuilding the index first if rescan is set."""
+    names = snapshot_names(save_dir, objects)
+    if rescan:
+        logger.info(f'Rescanning {len(names)} backups in {save_dir} using {workers} workers')
+        if objects is not None:
+            store.save_usage(objects.rescan(), replace=True)
+        else:
+            store.save_usage(rescan_backups(save_dir, workers=workers), replace=True)
+    index = store.snapshot_usage()
+    usages = [index[name] for name in names if name in index]
+    total = sum(usage.bytes for usage in usages)
+    on_disk = sum(usage.unique_bytes for usage in usages)
+    logger.info(
+        f'{len(names)} backups found in {save_dir} ({bytes_to_mb(total)} MB, {bytes_to_mb(on_disk)} MB on disk)'
+    )
+    for usage in usages:
+        logger.info(
+            f'  {usage.name}: {usage.files} files, {bytes_to_mb(usage.bytes)} MB, '
+            f'{bytes_to_mb(usage.unique_bytes)} MB unique'
+        )
+    for label, name in (('Oldest', names[0]), ('Latest', names[-1])) if names else ():
+        usage = index.get(name)
+        logger.info(f'{label} backup: {name} ({bytes_to_mb(usage.bytes) + " MB" if usage else "not indexed"})')
+    missing = [name for name in names if name not in index]
+    if missing:
+        logger.warning(
+            f'{len(missing)} backups are not in the size index ({", ".join(missing)}). '
+            'Run "snbackup -ls --rescan" to measure them.'
+        )
+
 
+def checkout_snapshot(objects: ObjectStore, snapshot: str, target_dir: Path, *, link_mode='copy', paths=None) -> Path:
+    """Recreate a backup from the object store, or only the files at or under paths, as a dated
+    folder in target_dir. Returns the folder.
+    """
+    names = objects.snapshots()
+    if snapshot == 'latest' and names:
+        snapshot = names[-1]
+    if snapshot not in names:
+        raise SystemExit(f'No backup named {snapshot!r} in {objects.manifests}')
+    target = target_dir.joinpath(snapshot)
+    placed = 0
+    for entry, local_pth in objects.checkout(snapshot, target, link_mode=link_mode, paths=paths):
+        stamp_modified(local_pth, SnFiles(target, entry['uri'], entry['modified'], entry['size']))
+        placed += 1
+    flushed = objects.durability.sync()
+    logger.info(f'Checked out {placed} files from backup {snapshot} to {target} ({flushed} fsyncs)')
+    return target
 
-def cleanup_backups(base_dir: Path, *, num_backups=0, cleanup=False, pattern='202?-*') -> None:
-    """Delete old backups from the backup save directory on local disk."""
-    if num_backups > 0 and cleanup:
-        logger.info(f'Removing old backups, keeping last {num_backups}')
-        previous_folders = sorted(base_dir.glob(pattern), reverse=True)
-        while len(previous_folders) > num_backups:
-            old = previous_folders.pop()
-            logger.info(f'Removing backup folder: {old}')
-            shutil.rmtree(old)
+
+def unpack_snapshot(save_dir: Path, snapshot: str, target_dir: Path, *, paths=None, durability=None) -> Path:
+    """Extract a packed backup, or only the files at or under paths, as a dated folder in target_dir.
+    Each file is read from its own place in the pack. Returns the folder.
+    """
+    durability = durability or Durability()
+    packed = packed_snapshots(save_dir)
+    if snapshot == 'latest' and packed:
+        snapshot = packed[-1]
+    if snapshot not in packed:
+        if save_dir.joinpath(snapshot).is_dir():
+            raise SystemExit(f'Backup {snapshot} is not packed, its files are in {save_dir.joinpath(snapshot)}')
+        raise SystemExit(f'No packed backup named {snapshot!r} in {save_dir}')
+    pack = Pack(save_dir, snapshot, durability=durability)
+    target = target_dir.joinpath(snapshot)
+    entries = pack.select(paths)
+    for entry in entries:
+        save_stream(
+            target.joinpath(entry['path']),
+            pack.read(entry),
+            expected_size=entry['size'],
+            mtime=entry['mtime'],
+            durability=durability,
+        )
+    flushed = durability.sync()
+    logger.info(f'Unpacked {len(entries)} files from backup {snapshot} to {target} ({flushed} fsyncs)')
+    return target
+
+
+def pack_backups(
+    save_dir: Path, store: MetadataStore, *, older_than: int, workers=SCAN_WORKERS, durability=None
+) -> list[str]:
+    """Pack each dated backup folder older than `older_than` days into a compressed file with an
+    index, then remove the folder. The latest complete backup and any after it always stay folders,
+    as the next run copies unchanged files from it. Returns the names of the backups packed.
+    """
+    durability = durability or Durability()
+    names = snapshot_names(save_dir)
+    cutoff = (date.today() - timedelta(days=older_than)).isoformat()
+    keep = min(filter(None, (store.latest, names[-1] if names else None)), default='')
+    folders = [folder for folder in snapshot_folders(save_dir) if folder.name < cutoff and folder.name < keep]
+    if not folders:
+        logger.info(f'No backup folders older than {older_than} days to pack')
+        return []
+    # A folder left by an interrupted pack already has its index and only needs removing
+    unpacked = [folder for folder in folders if not Pack(save_dir, folder.name).exists()]
+    logger.info(f'Packing {len(unpacked)} backups older than {older_than} days using {workers} workers')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for pack in executor.map(lambda folder: Pack.create(folder, durability=durability), unpacked):
+            usage = pack.usage()
+            logger.info(
+                f'Packed backup {pack.name}: {usage.files} files, {bytes_to_mb(usage.bytes)} MB '
+                f'into {bytes_to_mb(usage.unique_bytes)} MB'
+            )
+    # Packs are flushed to disk before the folders they replace are deleted
+    durability.sync()
+    prune_backups(save_dir, folders, workers=workers)
+
+    # Data a folder shared with a packed backup is its own now, so it is measured again
+    packed = {folder.name for folder in folders}
+    names = snapshot_names(save_dir)
+    for previous, name in zip([None, *names], names):
+        if name in packed or previous in packed:
+            store.save_usage([measure_backup(save_dir, name, previous)])
+    return sorted(packed)
+
+
+def carry_unchanged(unchanged: list[SnFiles], today: Path, *, link_mode='copy', durability=None) -> tuple[list, list]:
+    """Bring unchanged files from their previous backup into today's.
+    Returns the carried files and any whose previous copy could not be reused.
+    """
+    logger.info(f'Copying {len(unchanged)} unchanged files from local disk ({link_mode} mode).')
+    carried, missing = [], []
+    strategies = Counter()
+    for previous_file in unchanged:
+        save_to_pth = today.joinpath(previous_file.file_uri)
+        if already_saved(previous_file, today):
+            strategy = 'existing'
+        else:
+            try:
+                strategy = carry_file(previous_file.full_path, save_to_pth, mode=link_mode, durability=durability)
+            except OSError as e:
+                logger.warning(f'Unable to reuse {previous_file.full_path} for {previous_file.file_uri}: {e!r}')
+                previous_file.base_path = today
+                missing.append(previous_file)
+                continue
+            stamp_modified(save_to_pth, previous_file)
+        logger.info(f'Carried {save_to_pth.stem!r} to {save_to_pth} ({strategy})')
+        strategies[strategy] += 1
+        previous_file.base_path = today
+        carried.append(previous_file)
+    if strategies:
+        used = ', '.join(f'{strategy}: {count}' for strategy, count in strategies.most_common())
+        logger.info(f'Unchanged files carried forward using {used}')
+    return carried, missing
+
+
+def store_previous(previous_file: SnFiles, objects: ObjectStore, stored: set, *, link_mode='copy') -> str:
+    """Make sure the object store holds the content of a file from an earlier backup and record its hash.
+    Files from a snapshot in stored, those with a manifest, are already there. Files last saved in a
+    dated folder are added from it. Returns 'stored' or the strategy used to add the file.
+    """
+    if previous_file.save_date in stored and previous_file.recorded_hash:
+        return 'stored'
+    previous_file.file_hash, strategy = objects.add_file(
+        previous_file.full_path, previous_file.recorded_hash, link_mode=link_mode
+    )
+    return strategy
+
+
+def store_unchanged(
+    unchanged: list[SnFiles], today: Path, objects: ObjectStore, *, link_mode='copy'
+) -> tuple[list, list]:
+    """Carry unchanged files into today's snapshot in the object store. Files already stored cost
+    nothing, so only files from dated backup folders touch the disk. Returns the carried files and
+    any whose previous copy could not be reused.
+    """
+    stored = set(objects.snapshots())
+    carried, missing = [], []
+    strategies = Counter()
+    for previous_file in unchanged:
+        try:
+            strategies[store_previous(previous_file, objects, stored, link_mode=link_mode)] += 1
+        except OSError as e:
+            logger.warning(f'Unable to reuse {previous_file.full_path} for {previous_file.file_uri}: {e!r}')
+            missing.append(previous_file)
+        else:
+            carried.append(previous_file)
+        previous_file.base_path = today
+    if strategies:
+        used = ', '.join(f'{strategy}: {count}' for strategy, count in strategies.most_common())
+        logger.info(f'{len(carried)} unchanged files carried forward in the object store ({used})')
+    return carried, missing
+
+
+def relocate_moved(moved: list[tuple], *, link_mode='copy', durability=None, objects=None) -> tuple[list, list]:
+    """Materialise files moved or renamed on device from their previous local copy.
+    Returns the relocated files and any whose local copy could not be reused.
+    """
+    relocated, missing = [], []
+    stored = set(objects.snapshots()) if objects is not None else set()
+    for source, current in moved:
+        if objects is not None:
+            try:
+                strategy = store_previous(source, objects, stored, link_mode=link_mode)
+            except OSError as e:
+                logger.warning(f'Unable to reuse {source.full_path} for {current.file_uri}: {e!r}')
+                missing.append(current)
+                continue
+            current.file_hash = source.recorded_hash
+        elif already_saved(current, current.base_path):
+            strategy = 'existing'
+        else:
+            try:
+                strategy = carry_file(source.full_path, current.full_path, mode=link_mode, durability=durability)
+            except OSError as e:
+                logger.warning(f'Unable to reuse {source.full_path} for {current.file_uri}: {e!r}')
+                missing.append(current)
+                continue
+            stamp_modified(current.full_path, current)
+        logger.info(f'Moved {source.file_uri} to {current.file_uri} from local disk ({strategy})')
+        relocated.append(current)
+    return relocated, missing
 
 
-def run_inspection(to_download: set) -> None:
+def run_inspection(to_download: list, moved=()) -> None:
     """Inspect current files, determine what's new or changed, and log that out."""
     logger.info('Inspecting changes only')
     if len(to_download) > 0:
@@ -162,9 +786,58 @@ def run_inspection(to_download: set) -> None:
         logger.info('No new or updated files to download.')
     for c, file in enumerate(to_download, start=1):
         logger.info(f'{c}.{file.file_uri} ({bytes_to_mb(file.file_size)} MB)')
+    if moved:
+        logger.info('Listing files moved on device to copy from local disk:')
+    for c, (source, current) in enumerate(moved, start=1):
+        logger.info(f'{c}.{source.file_uri} -> {current.file_uri}')
     logger.info('Inspection complete')
 
 
+def start_profiling(mode: str | None, *, trace=False):
+    """Begin tracing phases and requests for --profile or when trace is set, e.g. to export metrics.
+    In cprofile mode also start and return a cProfile profiler.
+    """
+    if mode or trace:
+        tracer.start()
+    if mode != 'cprofile':
+        return None
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def report_profile(save_dir: Path, profiler=None) -> None:
+    """Log a per phase summary and save the span tree, plus cProfile stats if collected, next to the log."""
+    trace_file = save_dir.joinpath('snbackup-trace.json')
+    tracer.write(trace_file)
+    logger.info(f'Profile of this run, trace saved to {trace_file}\n{tracer.summary()}')
+    if profiler is None:
+        return
+    import io
+    import pstats
+
+    profiler.disable()
+    stats_file = save_dir.joinpath('snbackup.prof')
+    profiler.dump_stats(stats_file)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(25)
+    logger.info(f'cProfile stats saved to {stats_file}, top functions by cumulative time:\n{report.getvalue()}')
+
+
+def report_metrics(run: RunMetrics, metrics_file: Path, history_file: Path) -> None:
+    """Export the run's metrics for monitoring. Failing to write them never fails the backup."""
+    run.finish(tracer.root)
+    try:
+        run.write_textfile(metrics_file)
+        run.append_history(history_file)
+    except OSError as e:
+        logger.warning(f'Unable to write run metrics: {e!r}')
+        return
+    logger.info(f'Run metrics written to {metrics_file} and {history_file}')
+
+
 def backup() -> None:
     """Main workflow logic."""
     args = user_input()
@@ -196,94 +869,275 @@ def backup() -> None:
     num_backups = config.get('num_backups', 0)
     cleanup = config.get('cleanup', False)
     truncate = config.get('truncate_log', 1000)
+    workers = args.workers or config.get('workers', 1)
+    timeout = config.get('timeout', 1)
+    retries = config.get('retries', 3)
+    bandwidth_limit = config.get('bandwidth_limit')
+    pipeline = args.pipeline or config.get('pipeline', False)
+    detect_moves = config.get('detect_moves', False) and not args.full
+    prune_crawl = config.get('prune_crawl', False) and not (args.full or args.full_crawl)
+    link_mode = config.get('link_mode', 'copy')
+    durability_mode = config.get('durability', 'file')
+    layout = config.get('layout', 'folders')
+    pack_after = config.get('pack_after')
+
+    if link_mode not in LINK_MODES:
+        raise SystemExit(f'The "link_mode" config option should be one of: {", ".join(LINK_MODES)}')
+    if durability_mode not in DURABILITY_MODES:
+        raise SystemExit(f'The "durability" config option should be one of: {", ".join(DURABILITY_MODES)}')
+    if layout not in LAYOUTS:
+        raise SystemExit(f'The "layout" config option should be one of: {", ".join(LAYOUTS)}')
+    for name, days in (('"pack_after" config option', pack_after), ('--pack option', args.pack)):
+        if days is None:
+            continue
+        if not isinstance(days, int) or isinstance(days, bool) or days < 0:
+            raise SystemExit(f'The {name} should be a whole number of days, 0 or more')
+        if layout in STORES:
+            raise SystemExit(f'The {name} needs the folders layout, the {layout} layout already stores each file once')
+    durability = Durability(durability_mode)
+    metrics_file = config.get('metrics_file')
+    history_file = config.get('metrics_history')
+
+    if args.cleanup:
+        retention = RetentionPolicy(daily=abs(args.cleanup))
+    elif config.get('retention'):
+        try:
+            retention = RetentionPolicy(**config['retention'])
+        except TypeError:
+            raise SystemExit('The "retention" config option should set any of "daily", "weekly" and "monthly"')
+        except ValueError as e:
+            raise SystemExit(f'The "retention" config option is invalid. {e}')
+    else:
+        retention = RetentionPolicy(daily=num_backups) if cleanup and num_backups > 0 else RetentionPolicy()
 
     save_dir = Path(save_dir)
     if not save_dir.is_dir():
         raise SystemExit(f'Unable to locate or write to {save_dir}')
 
     metadata_file = Path(save_dir.joinpath('metadata.json'))
+    objects = STORES[layout](save_dir, durability=durability) if layout in STORES else None
+
+    if config.get('metrics') or metrics_file or history_file:
+        metrics_file = Path(metrics_file or save_dir.joinpath('snbackup.prom'))
+        history_file = Path(history_file or save_dir.joinpath('snbackup-metrics.jsonl'))
 
     create_logger(str(save_dir.joinpath('snbackup')))
 
     logger.info(f'Loaded config {args.config}')
 
-    if args.list:
-        num, oldest, latest = count_backups(save_dir)
-        logger.info(f'{num} backups found in {save_dir} ({bytes_to_mb(recursive_scan(save_dir))} MB)')
-        logger.info(f'Oldest backup: {oldest.name} ({bytes_to_mb(recursive_scan(oldest))} MB)')
-        logger.info(f'Latest backup: {latest.name} ({bytes_to_mb(recursive_scan(latest))} MB)')
+    if args.list or args.rescan:
+        store = MetadataStore(save_dir.joinpath(MetadataStore.file_name), durability=durability.mode)
+        try:
+            list_backups(save_dir, store, rescan=args.rescan, objects=objects)
+        finally:
+            store.close()
+        raise SystemExit()
+
+    if args.dry_run:
+        if not retention:
+            logger.info('No backups would be removed. Set "retention" in config or pass --cleanup to choose some.')
+        cleanup_backups(save_dir, retention=retention, dry_run=True, objects=objects)
+        raise SystemExit()
+
+    if args.checkout:
+        target_dir = save_dir.joinpath('checkout')
+        if objects is not None:
+            checkout_snapshot(objects, args.checkout, target_dir, link_mode=link_mode, paths=args.path)
+        else:
+            unpack_snapshot(save_dir, args.checkout, target_dir, paths=args.path, durability=durability)
+        raise SystemExit()
+
+    if args.pack is not None:
+        store = MetadataStore(save_dir.joinpath(MetadataStore.file_name), durability=durability.mode)
+        try:
+            pack_backups(save_dir, store, older_than=args.pack, durability=durability)
+        finally:
+            store.close()
         raise SystemExit()
 
-    device = Device(device_url)
+    from .device import Device
+
+    rate = bandwidth_limit * 1000**2 if bandwidth_limit else None
+    # In pipeline mode folders are listed and files downloaded at the same time, each with up to `workers` requests
+    concurrency = workers * 2 if pipeline and not args.inspect else workers
+    device = Device(device_url, timeout, retries=retries, traffic=TrafficController(concurrency, rate=rate))
     logger.info(f'Device at {device.base_url}')
+    if rate:
+        logger.info(f'Device traffic limited to {bandwidth_limit} MB/s')
+
+    store = MetadataStore(save_dir.joinpath(MetadataStore.file_name), durability=durability.mode)
+    run_id = None
+
+    profiler = start_profiling(args.profile, trace=bool(metrics_file))
+    run = RunMetrics()
 
     try:
         if args.upload:
-            resp = upload_files(device, args.upload, FOLDERS.get(args.destination))
-            msg = resp if resp else 'No files to upload.'
-            logger.info(msg)
-            raise SystemExit()
+            destination = FOLDERS.get(args.destination)
+            with tracer.span('upload'):
+                uploaded, skipped, failed = upload_files(device, args.upload, destination, workers=workers)
+            upload_summary(uploaded, skipped, failed, destination)
+            raise SystemExit(1 if failed else None)
 
-        logger.info(f'Saving files to {save_dir.absolute()}')
+        if store.is_empty() and metadata_file.is_file():
+            with tracer.span('import'):
+                imported = store.import_records(previous_record_gen(metadata_file))
+            logger.info(f'Imported {imported} file records from {metadata_file.name} into {store.file_name}')
 
-        all_files = []
+        logger.info(f'Saving files to {save_dir.absolute()}')
 
-        for folder in args.notes:
-            httpx_response = talk_to_device(device, folder)
-            re_parse = parse_html(httpx_response.text)
-            device_data = load_parsed(re_parse)
-            all_files.extend(device_data)
+        root_folders = [{'uri': folder, 'isDirectory': True} for folder in args.notes]
 
         today = today_pth(save_dir)
 
-        todays_files = {
-            SnFiles(today, uri, mdate, size)
-            for uri, mdate, size in device_uri_gen(device, all_files)
-        }
+        with tracer.span('load_previous'):
+            folder_cache = store.folder_cache() if prune_crawl else {}
+            previous = {} if args.full else store.previous_map()
 
-        previous_files = {
-            SnFiles(Path(loc), uri, mod, fsize)
-            for loc, uri, mod, fsize in previous_record_gen(metadata_file)
-        }
+        listed = {}
+        device_files = device_uri_gen(device, root_folders, workers=workers, folder_cache=folder_cache, listed=listed)
 
-        for deleted_file in check_for_deleted(todays_files, previous_files):
-            previous_files.discard(deleted_file)
+        if pipeline and not args.inspect:
+            changes = Changeset(previous, detect_moves=detect_moves)
+            run_id = store.begin_run(today.name)
+            logger.info(f'Downloading new or updated files while listing device using {workers} workers.')
+            with tracer.span('crawl_and_download'):
+                downloaded, skipped, failed = pipeline_backup(
+                    device,
+                    device_files,
+                    changes,
+                    today,
+                    workers=workers,
+                    full=args.full,
+                    durability=durability,
+                    objects=objects,
+                )
+        else:
+            with tracer.span('crawl'):
+                changes = diff_files(
+                    (SnFiles(today, uri, mdate, size) for uri, mdate, size in device_files),
+                    previous,
+                    detect_moves=detect_moves,
+                )
 
-        if args.full:
-            previous_files = set()
+            if args.inspect:
+                run_inspection(changes.to_download, changes.moved)
+                raise SystemExit()
 
-        to_download = todays_files.difference(previous_files)
+            run_id = store.begin_run(today.name)
+            logger.info(f'Downloading {len(changes.to_download)} files from device using {workers} workers.')
+            with tracer.span('download'):
+                downloaded, skipped, failed = download_files(
+                    device,
+                    changes.to_download,
+                    workers=workers,
+                    skip_present=not args.full,
+                    durability=durability,
+                    objects=objects,
+                )
 
-        unchanged = todays_files.intersection(previous_files)
+        logger.info(f'Device changes since last backup: {changes.summary()}')
+        run.count(
+            listed=len(changes.to_download) + len(changes.unchanged) + len(changes.moved),
+            to_download=len(changes.to_download),
+            unchanged=len(changes.unchanged),
+            deleted=len(changes.deleted),
+        )
 
-        if args.inspect:
-            run_inspection(to_download)
-            raise SystemExit()
+        with tracer.span('relocate'):
+            relocated, missing = relocate_moved(
+                changes.moved, link_mode=link_mode, durability=durability, objects=objects
+            )
+            if changes.moved:
+                logger.info(f'{len(changes.moved)} files moved or renamed on device')
+            if missing:
+                logger.info(f'Downloading {len(missing)} moved files missing from local disk.')
+                more_downloaded, _, more_failed = download_files(
+                    device, missing, workers=workers, durability=durability, objects=objects
+                )
+                downloaded += more_downloaded
+                failed += more_failed
 
-        logger.info(f'Downloading {len(to_download)} files from device.')
-        for new_file in to_download:
-            download_response = talk_to_device(device, new_file.file_uri)
-            new_file.file_bytes = download_response.read()
-            save_file(new_file.full_path, new_file.file_bytes)
-
-        logger.info(f'Copying {len(unchanged)} unchanged files from local disk.')
-        for previous_file in unchanged:
-            local_file = previous_file.full_path.read_bytes()
-            save_to_pth = today.joinpath(previous_file.file_uri)
-            save_file(save_to_pth, local_file)
-            previous_file.base_path = today
-    finally:
-        device.close()
+        unchanged = changes.unchanged
+        with tracer.span('carry'):
+            if objects is not None:
+                unchanged, missing = store_unchanged(unchanged, today, objects, link_mode=link_mode)
+            else:
+                unchanged, missing = carry_unchanged(unchanged, today, link_mode=link_mode, durability=durability)
+            if missing:
+                logger.info(f'Downloading {len(missing)} unchanged files missing from local disk.')
+                more_downloaded, _, more_failed = download_files(
+                    device, missing, workers=workers, durability=durability, objects=objects
+                )
+                downloaded += more_downloaded
+                failed += more_failed
+        run.count(carried=len(unchanged))
 
-    if to_download or unchanged:
-        records = [snfile.make_record() for snfile in it.chain(to_download, unchanged)]
-        save_records(records, metadata_file)
+        download_summary(downloaded, skipped, failed)
+        if device.retried:
+            logger.info(f'Retried {device.retried} device requests after transient errors')
+        logger.info(f'Device traffic: {device.traffic.state()}')
+        run.count(downloaded=len(downloaded), skipped=len(skipped), failed=len(failed), moved=len(relocated))
+        run.bytes = sum(file.file_size for file in downloaded)
 
-    if args.cleanup:
-        num_backups = abs(args.cleanup)
-        cleanup = True
+        records = [snfile.make_record() for snfile in it.chain(downloaded, skipped, relocated, unchanged)]
+        if records and objects is not None:
+            manifest = objects.write_manifest(today.name, records)
+            logger.info(f'Saved manifest of {len(records)} files to {manifest}')
+
+        # Data and the manifest must be on disk before the run is committed to the metadata store
+        with tracer.span('fsync') as span:
+            flushed = durability.sync()
+            span.set(fsyncs=flushed)
+        logger.info(f'Flushed {flushed} files and folders to disk ({durability.mode} durability)')
+
+        with tracer.span('metadata'):
+            if records:
+                logger.info(f'Saving {len(records)} file records to {store.file_name}')
+                store.commit_run(
+                    run_id,
+                    records,
+                    downloaded=len(downloaded),
+                    skipped=len(skipped),
+                    carried=len(unchanged),
+                    failed=len(failed),
+                    deleted=len(changes.deleted),
+                    moved=len(relocated),
+                )
+            else:
+                store.end_run(run_id, 'empty')
+            run_id = None
 
-    cleanup_backups(save_dir, num_backups=num_backups, cleanup=cleanup)
+            reused = sum(1 for uri, (date, _) in listed.items() if date and folder_cache.get(uri, (None,))[0] == date)
+            logger.info(f'Listed {len(listed)} device folders, {reused} unchanged since the last crawl and not fetched')
+            store.save_folders(listed, roots=[folder['uri'] for folder in root_folders])
+
+        with tracer.span('index'):
+            index_snapshot(store, today, objects)
+
+        with tracer.span('cleanup'):
+            removed = cleanup_backups(save_dir, retention=retention, objects=objects)
+            store.prune(set(snapshot_names(save_dir, objects)))
+            reindex_after_cleanup(store, save_dir, removed, objects)
+            if pack_after is not None:
+                pack_backups(save_dir, store, older_than=pack_after, durability=durability)
+    except SystemExit as e:
+        run.exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        raise
+    except BaseException:
+        run.exit_code = 1
+        raise
+    finally:
+        if run_id is not None:
+            store.end_run(run_id)
+        device.close()
+        store.close()
+        tracer.stop()
+        run.retries = device.retried
+        if args.profile:
+            report_profile(save_dir, profiler)
+        if metrics_file and not (args.inspect or args.upload):
+            report_metrics(run, metrics_file, history_file)
 
     logger.info('Backup complete')
 
@@ -0,0 +1,102 @@
+"""Single pass diff of the device listing against the previous backup"""
+
+from collections import defaultdict
+
+from .files import SnFiles
+
+
+class Changeset:
+    """Sorts device files into added, modified and unchanged as they arrive, keyed by uri.
+
+    Each file costs one dict lookup, so a full diff is a single O(n) pass.
+    The previous mapping is consumed: whatever is left once the listing is
+    finished was deleted from the device.
+
+    With detect_moves, a new uri whose modified date and size match a previous file
+    is held back until the listing is finished. If exactly one matching file, or several
+    sharing the same recorded hash, disappeared from the device, the new uri is treated
+    as that file moved or renamed, so it can be copied locally instead of downloaded.
+    Otherwise it is a new file after all and finish() returns it for downloading.
+    """
+
+    def __init__(self, previous: dict[str, SnFiles], *, detect_moves=False) -> None:
+        self._previous = previous
+        self.added = []
+        self.modified = []
+        self.unchanged = []
+        self.deleted = []
+        self.moved = []
+        self._possible_moves = []
+        self._by_content = None
+        if detect_moves:
+            self._by_content = defaultdict(list)
+            for file in previous.values():
+                self._by_content[(file.last_modified, file.file_size)].append(file)
+
+    def _match_move(self, candidates: list[SnFiles]) -> SnFiles | None:
+        """The file a new uri was moved from, out of those matching it that are gone from device."""
+        gone = [file for file in candidates if file.file_uri in self._previous]
+        hashes = {file.recorded_hash for file in gone}
+        if len(gone) == 1 or (len(hashes) == 1 and None not in hashes):
+            return gone[0]
+        return None
+
+    def add(self, current: SnFiles) -> bool:
+        """Classify one device file. Returns True when it needs downloading."""
+        previous_file = self._previous.pop(current.file_uri, None)
+        if previous_file is None:
+            if self._by_content is not None:
+                candidates = self._by_content.get((current.last_modified, current.file_size))
+                if candidates:
+                    self._possible_moves.append((candidates, current))
+                    return False
+            self.added.append(current)
+            return True
+        if previous_file.same_content(current):
+            self.unchanged.append(previous_file)
+            return False
+        self.modified.append(current)
+        return True
+
+    def finish(self) -> list[SnFiles]:
+        """Everything not seen on device was deleted. Settles the possible moves and returns
+        those that turned out to be new files, which still need downloading.
+        """
+        unmatched = []
+        for candidates, current in self._possible_moves:
+            source = self._match_move(candidates)
+            if source is None:
+                unmatched.append(current)
+                continue
+            # A source is used up by its move, so it can't match again or count as deleted
+            del self._previous[source.file_uri]
+            self._by_content[(source.last_modified, source.file_size)].remove(source)
+            current.file_hash = source.recorded_hash
+            self.moved.append((source, current))
+        self._possible_moves.clear()
+        self.added.extend(unmatched)
+        self.deleted.extend(self._previous.values())
+        self._previous.clear()
+        return unmatched
+
+    @property
+    def to_download(self) -> list[SnFiles]:
+        return self.added + self.modified
+
+    def summary(self) -> str:
+        return (
+            f'{len(self.added)} new, {len(self.modified)} modified, {len(self.unchanged)} unchanged, '
+            f'{len(self.moved)} moved, {len(self.deleted)} deleted'
+        )
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.summary()})'
+
+
+def diff_files(current, previous: dict[str, SnFiles], *, detect_moves=False) -> Changeset:
+    """Diff an iterable of device files against previous files keyed by uri in one pass."""
+    changes = Changeset(previous, detect_moves=detect_moves)
+    for file in current:
+        changes.add(file)
+    changes.finish()
+    return changes
@@ -0,0 +1,74 @@
+"""Content-defined chunking for the chunks storage layout
+
+Files are cut with FastCDC (Xia et al., 2016): a gear rolling hash is updated for
+every byte and a chunk ends where the hash matches a mask. The cut points depend on
+the content around them rather than on offsets, so adding a page to a note only
+changes the chunks near the edit and the rest are stored once for every version.
+Normalized chunking uses a harder mask before the average size and an easier one
+after it, which keeps chunk sizes close to the average.
+"""
+
+import random
+
+MIN_SIZE = 16 * 1024
+AVG_SIZE = 64 * 1024
+MAX_SIZE = 256 * 1024
+
+_MASK64 = (1 << 64) - 1
+
+
+def _gear_table(seed: int) -> tuple[int, ...]:
+    # Fixed seed, so the same content is always cut in the same places
+    rng = random.Random(seed)
+    return tuple(rng.getrandbits(64) for _ in range(256))
+
+
+GEAR = _gear_table(0x5B5A)
+
+
+def _mask(bits: int) -> int:
+    """A mask of the top bits of the hash. Each of those depends on the last 64 bytes hashed."""
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def cut_point(data, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE) -> int:
+    """Length of the first chunk of data. No chunk is shorter than min_size, unless
+    data is, or longer than max_size.
+    """
+    length = len(data)
+    if length <= min_size:
+        return length
+    bits = avg_size.bit_length() - 1
+    mask_hard, mask_easy = _mask(bits + 2), _mask(bits - 2)
+    end = min(length, max_size)
+    normal = min(end, avg_size)
+    gear = GEAR
+    fingerprint = 0
+    position = min_size
+    for byte in data[min_size:normal]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & _MASK64
+        position += 1
+        if not fingerprint & mask_hard:
+            return position
+    for byte in data[normal:end]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & _MASK64
+        position += 1
+        if not fingerprint & mask_easy:
+            return position
+    return end
+
+
+def chunk_stream(blocks, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+    """Cut a stream of byte blocks, such as a download, into content-defined chunks."""
+    buffer = bytearray()
+    view_args = (min_size, avg_size, max_size)
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= max_size:
+            cut = cut_point(memoryview(buffer)[:max_size], *view_args)
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+    while buffer:
+        cut = cut_point(memoryview(buffer)[:max_size], *view_args)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
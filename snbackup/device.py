@@ -1,25 +1,130 @@
+import time
+import random
+import threading
+from contextlib import contextmanager
+
 import httpx
 
+from .traffic import TrafficController
+from .profiling import tracer
+
+MAX_CONNECT_TIMEOUT = 10.0
+MAX_READ_TIMEOUT = 120.0
+MIN_TRANSFER_RATE = 1_000_000  # Bytes per second allowed for when sizing read timeouts of large files
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
 
 class Device:
-    """Manages httpx Client."""
+    """Manages httpx Client.
+
+    Connect and read timeouts are sized per request from the response latency seen
+    so far and the size of the file being fetched, never falling below `timeout`.
+    Failed GET requests are retried up to `retries` times with jittered exponential
+    backoff, and each retry doubles the timeouts. Every request passes through
+    `traffic`, which sets how many may be in flight and caps bandwidth.
+    """
 
-    def __init__(self, base_url: str, timeout=1) -> None:
+    def __init__(self, base_url: str, timeout=1, *, retries=3, backoff=0.5, max_backoff=8.0, traffic=None) -> None:
         self.base_url = base_url
         self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency = None
+        self.retried = 0
+        self.traffic = traffic or TrafficController()
+        self._lock = threading.Lock()
         self.client = httpx.Client(base_url=self.base_url, timeout=self.timeout)
 
-    def http_request(self, uri: str, document=None) -> httpx.Response:
-        """Downloads and uploads files to remote device."""
+    def timeouts(self, size=0, attempt=0) -> httpx.Timeout:
+        """Timeouts for one request: a multiple of the observed latency, plus time to move
+        size bytes at a slow transfer rate, doubled for each retry.
+        """
+        base = max(self.timeout, 4 * (self.latency or 0.0)) * 2**attempt
+        connect = min(MAX_CONNECT_TIMEOUT, base)
+        read = min(MAX_READ_TIMEOUT, base + size / MIN_TRANSFER_RATE * 2**attempt)
+        return httpx.Timeout(connect=connect, read=read, write=read, pool=None)
+
+    def observe(self, seconds: float) -> None:
+        """Fold the time taken to receive a response's headers into the latency estimate."""
+        with self._lock:
+            self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+
+    def retry(self, func, *args, retry_on=(), **kwargs):
+        """Call func(*args, attempt=n, **kwargs) until it succeeds or retries run out.
+        Transport errors, retryable HTTP statuses and any retry_on exceptions are retried.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, attempt=attempt, **kwargs)
+            except (httpx.TransportError, httpx.HTTPStatusError, *retry_on) as e:
+                if attempt == self.retries or not _retryable(e):
+                    raise
+            with self._lock:
+                self.retried += 1
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt)))
+
+    def http_request(self, uri: str, document=None, *, size=0) -> httpx.Response:
+        """Downloads and uploads files to remote device. Only downloads are retried,
+        as an upload may have reached the device before the error. Uploads are given
+        time to send size bytes.
+        """
         if document:
-            response = self.client.post(uri, files=document)
-        else:
-            response = self.client.get(uri)
+            with self.traffic.slot():
+                response = self.client.post(uri, files=document, timeout=self.timeouts(size))
+            response.raise_for_status()
+            return response
+        return self.retry(self._get, uri)
+
+    def _get(self, uri: str, *, attempt=0) -> httpx.Response:
+        with self.traffic.slot(), self._watch():
+            start = time.perf_counter()
+            response = self.client.get(uri, timeout=self.timeouts(attempt=attempt))
+            self._responded(response, time.perf_counter() - start)
+        self.traffic.throttle(len(response.content))
         response.raise_for_status()
         return response
 
+    @contextmanager
+    def stream_request(self, uri: str, *, size=0, attempt=0):
+        """Streams a file download from remote device without reading it into memory.
+        Read the body with read_chunks so it counts against the bandwidth cap.
+        """
+        with self.traffic.slot(), self._watch():
+            start = time.perf_counter()
+            with self.client.stream('GET', uri, timeout=self.timeouts(size, attempt)) as response:
+                self._responded(response, time.perf_counter() - start)
+                response.raise_for_status()
+                yield response
+
+    def read_chunks(self, response: httpx.Response, chunk_size: int):
+        """Iterate over a streamed response body within the bandwidth cap."""
+        for chunk in response.iter_bytes(chunk_size):
+            self.traffic.throttle(len(chunk))
+            yield chunk
+
+    def _responded(self, response: httpx.Response, seconds: float) -> None:
+        tracer.set(latency=seconds)
+        self.observe(seconds)
+        self.traffic.record(seconds, error=response.status_code in RETRY_STATUS)
+
+    @contextmanager
+    def _watch(self):
+        """Report requests that fail outright, such as timeouts or dropped connections."""
+        try:
+            yield
+        except httpx.TransportError:
+            self.traffic.record(error=True)
+            raise
+
     def close(self) -> None:
         self.client.close()
 
     def __repr__(self) -> str:
         return f'{type(self).__name__}({self.base_url}, {self.timeout})'
+
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRY_STATUS
+    return True
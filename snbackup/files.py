@@ -1,5 +1,4 @@
 from pathlib import Path
-from hashlib import sha256
 from datetime import datetime
 from functools import total_ordering
 
@@ -12,16 +11,22 @@ class BadDateError(Exception):
     """Bad datetime format or value."""
 
 
+class SizeMismatchError(Exception):
+    """Number of bytes received differs from the size listed on device."""
+
+
 @total_ordering
 class SnFiles:
     """Represent an individual Supernote file."""
 
-    def __init__(self, base_path: Path, file_uri: str, last_modified: str, file_size: int) -> None:
+    __slots__ = ('base_path', 'file_uri', '_last_modified', 'file_size', '_file_hash')
+
+    def __init__(self, base_path: Path, file_uri: str, last_modified: str, file_size: int, file_hash=None) -> None:
         self.base_path = base_path
         self.file_uri = file_uri
         self.last_modified = last_modified
         self.file_size = file_size
-        self.file_bytes = b''
+        self._file_hash = file_hash
 
     @property
     def save_date(self) -> str:
@@ -32,20 +37,20 @@ class SnFiles:
         return self.base_path.joinpath(self.file_uri)
 
     @property
-    def file_bytes(self) -> bytes:
-        return self._file_bytes
+    def file_hash(self) -> str:
+        """SHA-256 recorded while streaming the download or adding the file to the object store."""
+        if not self._file_hash:
+            raise BytesEmptyError(f'No content hash recorded for {self.file_uri}')
+        return self._file_hash
 
-    @file_bytes.setter
-    def file_bytes(self, bytes_obj: bytes) -> None:
-        if not isinstance(bytes_obj, bytes):
-            raise TypeError('File must be bytes object')
-        self._file_bytes = bytes_obj
+    @file_hash.setter
+    def file_hash(self, hex_digest: str) -> None:
+        self._file_hash = hex_digest
 
     @property
-    def file_hash(self) -> str:
-        if self.file_bytes == b'':
-            raise BytesEmptyError(f'File is empty: {self.file_bytes!r}')
-        return sha256(self.file_bytes).hexdigest()
+    def recorded_hash(self) -> str | None:
+        """Hash recorded at download time, or None when there is none."""
+        return self._file_hash
 
     @property
     def last_modified(self) -> datetime:
@@ -62,12 +67,24 @@ class SnFiles:
     def __eq__(self, other) -> bool:
         if not isinstance(other, self.__class__):
             return NotImplemented
+        return (self.file_uri, self.last_modified, self.file_size) == (
+            other.file_uri,
+            other.last_modified,
+            other.file_size,
+        )
+
+    def same_content(self, other) -> bool:
+        """Same modified date and size, regardless of where the file lives."""
         return (self.last_modified, self.file_size) == (other.last_modified, other.file_size)
 
     def __lt__(self, other) -> bool:
         if not isinstance(other, self.__class__):
             return NotImplemented
-        return (self.last_modified, self.file_size) < (other.last_modified, other.file_size)
+        return (self.last_modified, self.file_size, self.file_uri) < (
+            other.last_modified,
+            other.file_size,
+            other.file_uri,
+        )
 
     def __hash__(self) -> int:
         return hash((self.file_uri, self.last_modified, self.file_size))
@@ -82,4 +99,5 @@ class SnFiles:
             'uri': self.file_uri,
             'modified': self.last_modified.strftime('%Y-%m-%d %H:%M:%S'),
             'size': self.file_size,
+            'hash': self.recorded_hash,
         }
@@ -58,6 +58,11 @@ def user_input() -> Namespace:
         help='Destination folder to send file upload',
     )
     parser.add_argument('-ls', '--list', action='store_true', help='List out information about backups found locally')
+    parser.add_argument(
+        '--rescan',
+        action='store_true',
+        help='Measure every local backup again to rebuild the size index used by -ls, then list them.',
+    )
     parser.add_argument('-v', '--version', action='store_true', help='Print program version and quit.')
     parser.add_argument(
         '--notes',
@@ -73,6 +78,56 @@ def user_input() -> Namespace:
         const=10,
         help='Remove locally stored previous backups. Keeps last 10 or any supplied number.',
     )
+    parser.add_argument(
+        '-n',
+        '--dry-run',
+        action='store_true',
+        help='Report the backups --cleanup or "retention" in config would remove and the space freed, then quit.',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        help='Number of files to download from device in parallel. Overrides "workers" in config.',
+    )
+    parser.add_argument(
+        '-p',
+        '--pipeline',
+        action='store_true',
+        help='Start downloading new or updated files while the device is still being listed.',
+    )
+    parser.add_argument(
+        '--full-crawl',
+        action='store_true',
+        help='List every folder on device, even when "prune_crawl" is set in config.',
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='trace',
+        choices=('trace', 'cprofile'),
+        help='Time each phase and device request and save a trace next to the log. "cprofile" also runs cProfile.',
+    )
+    parser.add_argument(
+        '--checkout',
+        nargs='?',
+        const='latest',
+        metavar='YYYY-MM-DD',
+        help='Recreate a packed backup, or one in the objects layout, as a dated folder in save_dir/checkout. '
+        'Defaults to the latest.',
+    )
+    parser.add_argument(
+        '--path',
+        action='append',
+        metavar='URI',
+        help='With --checkout, only restore this file or folder, e.g. Note/Journal.note. Can be given more than once.',
+    )
+    parser.add_argument(
+        '--pack',
+        type=int,
+        metavar='DAYS',
+        help='Compress each backup folder older than DAYS days into a single pack file, then quit.',
+    )
     parser.add_argument('--setup', action='store_true', help='Setup option to create a json config')
     return parser.parse_args()
 
@@ -119,16 +174,6 @@ def bytes_to_mb(byte_size: int) -> str:
     return format(byte_size / 1000**2, '.2f')
 
 
-def count_backups(directory: Path, pattern='202?-*') -> tuple[int, Path, Path]:
-    """Counts number of backup folders and returns
-    oldest and newest found on local disk
-    """
-    previous = sorted(directory.glob(pattern))
-    if not previous:
-        return 0, directory, directory
-    return len(previous), previous[0], previous[-1]
-
-
 def recursive_scan(path: Path) -> int:
     """Scan a directory and return total size of files in bytes"""
     if path.is_file():
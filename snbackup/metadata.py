@@ -0,0 +1,192 @@
+"""SQLite backed store of backup metadata"""
+
+import json
+import sqlite3
+from pathlib import Path
+from datetime import datetime
+
+from .files import SnFiles
+from .snapshots import SnapshotUsage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    snapshot TEXT NOT NULL,
+    started TEXT NOT NULL,
+    finished TEXT,
+    status TEXT NOT NULL,
+    downloaded INTEGER DEFAULT 0,
+    skipped INTEGER DEFAULT 0,
+    carried INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    deleted INTEGER DEFAULT 0,
+    moved INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    snapshot TEXT NOT NULL,
+    uri TEXT NOT NULL,
+    location TEXT NOT NULL,
+    modified TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT,
+    PRIMARY KEY (snapshot, uri)
+);
+CREATE INDEX IF NOT EXISTS files_uri ON files (uri);
+CREATE TABLE IF NOT EXISTS folders (
+    uri TEXT PRIMARY KEY,
+    date TEXT,
+    entries TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot TEXT PRIMARY KEY,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    unique_bytes INTEGER NOT NULL,
+    scanned TEXT NOT NULL
+);
+"""
+
+SYNCHRONOUS = {'file': 'FULL', 'batch': 'FULL', 'none': 'OFF'}
+
+
+class MetadataStore:
+    """Indexed, transactional record of the files saved in each backup and the runs that saved them.
+
+    The previous state is the set of file rows belonging to the snapshot of the
+    latest completed run. Each run replaces its own snapshot's rows in a single
+    transaction, so an interrupted run leaves the previous state untouched.
+    """
+
+    file_name = 'metadata.db'
+
+    def __init__(self, db_path: Path | str, *, durability='file') -> None:
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(f'PRAGMA synchronous = {SYNCHRONOUS.get(durability, "FULL")}')
+        self.conn.executescript(SCHEMA)
+        self.latest = self._latest_snapshot()
+
+    def _latest_snapshot(self) -> str | None:
+        row = self.conn.execute(
+            "SELECT snapshot FROM runs WHERE status IN ('complete', 'imported') ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        return row[0] if row else None
+
+    def is_empty(self) -> bool:
+        return self.conn.execute('SELECT 1 FROM runs LIMIT 1').fetchone() is None
+
+    def import_records(self, records) -> int:
+        """Load (current_loc, uri, modified, size, hash) tuples from a legacy metadata.json."""
+        rows = [(Path(loc).name, uri, Path(loc).as_posix(), mod, size, fhash) for loc, uri, mod, size, fhash in records]
+        if not rows:
+            return 0
+        snapshot = max(row[0] for row in rows)
+        now = _now()
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                [(snapshot, *row[1:]) for row in rows],
+            )
+            self.conn.execute(
+                'INSERT INTO runs (snapshot, started, finished, status) VALUES (?, ?, ?, ?)',
+                (snapshot, now, now, 'imported'),
+            )
+        self.latest = snapshot
+        return len(rows)
+
+    def previous_map(self) -> dict[str, SnFiles]:
+        """Load the latest completed snapshot in one query, keyed by uri."""
+        paths = {}
+        rows = self.conn.execute(
+            'SELECT location, uri, modified, size, hash FROM files WHERE snapshot = ?', (self.latest,)
+        )
+        return {
+            uri: SnFiles(paths.setdefault(loc, Path(loc)), uri, mod, size, fhash)
+            for loc, uri, mod, size, fhash in rows
+        }
+
+    def begin_run(self, snapshot: str) -> int:
+        with self.conn:
+            cursor = self.conn.execute(
+                'INSERT INTO runs (snapshot, started, status) VALUES (?, ?, ?)', (snapshot, _now(), 'running')
+            )
+        return cursor.lastrowid
+
+    def commit_run(self, run_id: int, records: list[dict], **counts) -> None:
+        """Replace the run's snapshot rows with records from make_record() and mark the run complete."""
+        snapshot = self.conn.execute('SELECT snapshot FROM runs WHERE id = ?', (run_id,)).fetchone()[0]
+        rows = [
+            (snapshot, rec['uri'], rec['current_loc'], rec['modified'], rec['size'], rec.get('hash'))
+            for rec in records
+        ]
+        columns = ', '.join(f'{column} = ?' for column in counts)
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE snapshot = ?', (snapshot,))
+            self.conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.conn.execute(
+                f"UPDATE runs SET finished = ?, status = 'complete'{', ' + columns if counts else ''} WHERE id = ?",
+                (_now(), *counts.values(), run_id),
+            )
+        self.latest = snapshot
+
+    def end_run(self, run_id: int, status='failed') -> None:
+        """Close out a run that recorded nothing, leaving the previous state in place."""
+        with self.conn:
+            self.conn.execute('UPDATE runs SET finished = ?, status = ? WHERE id = ?', (_now(), status, run_id))
+
+    def folder_cache(self) -> dict[str, tuple[str, list[dict]]]:
+        """Folder listings saved by the last crawl, keyed by folder uri."""
+        rows = self.conn.execute('SELECT uri, date, entries FROM folders')
+        return {uri: (date, json.loads(entries)) for uri, date, entries in rows}
+
+    def save_folders(self, listed: dict[str, tuple[str, list[dict]]], roots=()) -> None:
+        """Replace the cached listings under each crawled root folder with those just walked."""
+        with self.conn:
+            for root in roots:
+                self.conn.execute(
+                    'DELETE FROM folders WHERE uri = ? OR substr(uri, 1, ?) = ?', (root, len(root) + 1, f'{root}/')
+                )
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO folders VALUES (?, ?, ?)',
+                [(uri, date, json.dumps(entries, separators=(',', ':'))) for uri, (date, entries) in listed.items()],
+            )
+
+    def snapshot_usage(self) -> dict[str, SnapshotUsage]:
+        """Indexed sizes of the backup folders, keyed by snapshot."""
+        rows = self.conn.execute('SELECT snapshot, files, bytes, unique_bytes FROM snapshots ORDER BY snapshot')
+        return {row[0]: SnapshotUsage(*row) for row in rows}
+
+    def save_usage(self, usages, *, replace=False) -> None:
+        """Add or update the index entries of measured backup folders. With replace set,
+        entries for any other snapshot are dropped.
+        """
+        now = _now()
+        rows = [(usage.name, usage.files, usage.bytes, usage.unique_bytes, now) for usage in usages]
+        with self.conn:
+            if replace:
+                self.conn.execute('DELETE FROM snapshots')
+            self.conn.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)', rows)
+
+    def forget_usage(self, snapshots) -> None:
+        with self.conn:
+            self.conn.executemany('DELETE FROM snapshots WHERE snapshot = ?', [(name,) for name in snapshots])
+
+    def prune(self, existing: set[str]) -> int:
+        """Drop file rows for snapshots no longer on disk, keeping the latest. Returns rows removed."""
+        keep = existing | {self.latest} if self.latest else existing
+        if not keep:
+            return 0
+        placeholders = ', '.join('?' * len(keep))
+        with self.conn:
+            cursor = self.conn.execute(f'DELETE FROM files WHERE snapshot NOT IN ({placeholders})', tuple(keep))
+        return cursor.rowcount
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.db_path!s})'
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec='seconds')
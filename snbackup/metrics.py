@@ -0,0 +1,156 @@
+"""Per run metrics for monitoring unattended backups"""
+
+import os
+import json
+import math
+import time
+from pathlib import Path
+
+from .profiling import Span
+from .storage import temp_file
+
+PHASES = (
+    'import',
+    'load_previous',
+    'crawl',
+    'download',
+    'crawl_and_download',
+    'relocate',
+    'carry',
+    'fsync',
+    'metadata',
+    'index',
+    'cleanup',
+)
+REQUESTS = {'list_request': 'list', 'download_request': 'download'}
+QUANTILES = (0.5, 0.9, 0.99)
+
+FILE_COUNTS = ('listed', 'to_download', 'unchanged', 'downloaded', 'skipped', 'carried', 'moved', 'deleted', 'failed')
+
+
+class RunMetrics:
+    """Counts collected while a backup runs, combined with the span tree at the end
+    into phase durations, request latencies and throughput.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.counts = dict.fromkeys(FILE_COUNTS, 0)
+        self.bytes = 0
+        self.retries = 0
+        self.exit_code = 0
+        self.duration = 0.0
+        self.phases = {}
+        self.latencies = {}
+
+    def count(self, **counts) -> None:
+        self.counts.update(counts)
+
+    def finish(self, root: Span) -> None:
+        """Take phase durations and request latencies from a finished run's spans."""
+        self.duration = root.duration
+        self.phases = {span.name: span.duration for span in root.children if span.name in PHASES}
+        latencies = {name: [] for name in REQUESTS.values()}
+        _gather(root, latencies)
+        self.latencies = {name: sorted(times) for name, times in latencies.items() if times}
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second downloaded while the download phase ran."""
+        seconds = self.phases.get('download') or self.phases.get('crawl_and_download') or 0.0
+        return self.bytes / seconds if seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'timestamp': round(self.started),
+            'exit_code': self.exit_code,
+            'duration': round(self.duration, 3),
+            'files': self.counts,
+            'bytes': self.bytes,
+            'throughput': round(self.throughput),
+            'retries': self.retries,
+            'phases': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            'latency': {
+                name: {'count': len(times), **{f'p{round(q * 100)}': round(percentile(times, q), 4) for q in QUANTILES}}
+                for name, times in self.latencies.items()
+            },
+        }
+
+    def openmetrics(self) -> str:
+        """Render in the OpenMetrics text format read by the node exporter textfile collector."""
+        lines = []
+
+        def family(name: str, kind: str, help_text: str, samples) -> None:
+            lines.append(f'# TYPE snbackup_{name} {kind}')
+            lines.append(f'# HELP snbackup_{name} {help_text}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(
+                    f'snbackup_{name}{suffix}{{{label_text}}} {value}' if labels else f'snbackup_{name}{suffix} {value}'
+                )
+
+        family('last_run_timestamp_seconds', 'gauge', 'When the last run started.', [('', {}, round(self.started))])
+        family('last_run_exit_code', 'gauge', 'Exit status of the last run, 0 on success.', [('', {}, self.exit_code)])
+        family('last_run_duration_seconds', 'gauge', 'Wall time of the last run.', [('', {}, f'{self.duration:.3f}')])
+        family(
+            'files',
+            'gauge',
+            'Files handled by the last run, by what happened to them.',
+            [('', {'kind': kind}, n) for kind, n in self.counts.items()],
+        )
+        family('downloaded_bytes', 'gauge', 'Bytes downloaded by the last run.', [('', {}, self.bytes)])
+        family(
+            'download_throughput_bytes_per_second',
+            'gauge',
+            'Download rate of the last run.',
+            [('', {}, f'{self.throughput:.0f}')],
+        )
+        family('retries', 'gauge', 'Device requests retried during the last run.', [('', {}, self.retries)])
+        family(
+            'phase_duration_seconds',
+            'gauge',
+            'Wall time of each phase of the last run.',
+            [('', {'phase': phase}, f'{seconds:.3f}') for phase, seconds in self.phases.items()],
+        )
+        samples = []
+        for name, times in self.latencies.items():
+            samples += [('', {'request': name, 'quantile': q}, f'{percentile(times, q):.4f}') for q in QUANTILES]
+            samples += [('_sum', {'request': name}, f'{sum(times):.4f}'), ('_count', {'request': name}, len(times))]
+        family('request_latency_seconds', 'summary', 'Device request latency during the last run.', samples)
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: Path) -> None:
+        """Replace the metrics file in one step so a collector never reads it half written."""
+        fd, tmp = temp_file(path.parent, path.name)
+        try:
+            with os.fdopen(fd, 'w') as file_out:
+                file_out.write(self.openmetrics())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def append_history(self, path: Path) -> None:
+        with open(path, 'a', encoding='utf-8') as history:
+            history.write(json.dumps(self.to_dict(), separators=(',', ':')) + '\n')
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(exit_code={self.exit_code}, {self.counts})'
+
+
+def _gather(span: Span, latencies: dict) -> None:
+    """Collect the time to response headers the device recorded on each request span."""
+    for child in span.children:
+        if child.name in REQUESTS:
+            if 'latency' in child.attrs:
+                latencies[REQUESTS[child.name]].append(child.attrs['latency'])
+        else:
+            _gather(child, latencies)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest rank percentile of already sorted values."""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(q * len(values)) - 1)]
@@ -0,0 +1,302 @@
+"""Content-addressed stores for the objects and chunks storage layouts
+
+Each distinct file content is kept once under objects/, named by its SHA-256. A
+snapshot is a manifest in manifests/ listing the uri, modified date, size and hash
+of every file it holds, so backing up an unchanged file writes nothing but its line
+in the manifest.
+"""
+
+import os
+import json
+from pathlib import Path
+from hashlib import sha256
+
+from .files import SizeMismatchError
+from .storage import Durability, carry_file, temp_file, write_atomic
+from .chunking import MAX_SIZE, chunk_stream
+from .snapshots import SnapshotUsage, under_paths
+
+MANIFEST_FIELDS = ('uri', 'modified', 'size', 'hash')
+READ_SIZE = 1024 * 1024
+
+
+class ObjectStore:
+    """Objects and snapshot manifests kept under base_dir."""
+
+    def __init__(self, base_dir: Path, *, durability=None) -> None:
+        self.base_dir = base_dir
+        self.objects = base_dir.joinpath('objects')
+        self.manifests = base_dir.joinpath('manifests')
+        self.durability = durability or Durability()
+
+    def path(self, digest: str) -> Path:
+        return self.objects.joinpath(digest[:2], digest)
+
+    def __contains__(self, digest: str) -> bool:
+        return self.path(digest).is_file()
+
+    def add_stream(self, chunks, *, expected_size=None) -> str:
+        """Store the content of a stream unless it is already stored. Returns its SHA-256 hex digest."""
+        self.durability.makedirs(self.objects)
+        digest, received = sha256(), 0
+        fd, temp_name = temp_file(self.objects)
+        try:
+            with open(fd, 'wb') as file_output:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    received += len(chunk)
+                    file_output.write(chunk)
+                file_output.flush()
+                if self.durability.mode == 'file':
+                    os.fsync(file_output.fileno())
+            if expected_size is not None and received != expected_size:
+                raise SizeMismatchError(f'Received {received} bytes, device listed {expected_size}')
+            target = self.path(digest.hexdigest())
+            if target.is_file():
+                os.unlink(temp_name)
+            else:
+                self.durability.makedirs(target.parent)
+                os.replace(temp_name, target)
+                self.durability.written(target, synced=True)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.unlink(temp_name)
+            raise
+        return digest.hexdigest()
+
+    def add_file(self, src: Path, digest=None, *, link_mode='copy') -> tuple[str, str]:
+        """Store a file already on local disk, e.g. from a dated backup folder, hashing it first
+        when its digest is not known. Returns the digest and the carry strategy used.
+        """
+        if digest is None:
+            digest = file_digest(src)
+        target = self.path(digest)
+        if target.is_file():
+            return digest, 'existing'
+        return digest, carry_file(src, target, mode=link_mode, durability=self.durability)
+
+    def place(self, digest: str, dst: Path, *, link_mode='copy') -> str:
+        """Put the stored content at dst. Returns the carry strategy used."""
+        return carry_file(self.path(digest), dst, mode=link_mode, durability=self.durability)
+
+    def snapshots(self) -> list[str]:
+        """Names of the snapshots with a manifest, oldest first."""
+        if not self.manifests.is_dir():
+            return []
+        return sorted(manifest.stem for manifest in self.manifests.glob('*.json'))
+
+    def write_manifest(self, snapshot: str, records: list[dict]) -> Path:
+        """Save a snapshot's manifest from make_record() data, replacing any earlier one in a single step."""
+        entries = sorted(({field: rec[field] for field in MANIFEST_FIELDS} for rec in records), key=lambda e: e['uri'])
+        manifest = self.manifests.joinpath(f'{snapshot}.json')
+        data = json.dumps({'snapshot': snapshot, 'files': entries}, separators=(',', ':')).encode()
+        write_atomic(manifest, data, durability=self.durability)
+        return manifest
+
+    def read_manifest(self, snapshot: str) -> list[dict]:
+        with open(self.manifests.joinpath(f'{snapshot}.json'), encoding='utf-8') as manifest:
+            return json.load(manifest)['files']
+
+    def stored(self, entries: list[dict]) -> dict[str, int]:
+        """What holding these manifest entries keeps on disk: the size of each object."""
+        return {entry['hash']: entry['size'] for entry in entries}
+
+    def usage(self, snapshot: str, previous=None) -> SnapshotUsage:
+        """Size of a snapshot, with unique bytes counting each stored object once and leaving
+        out objects the previous snapshot also holds.
+        """
+        shared = self.stored(self.read_manifest(previous)) if previous else {}
+        return self._usage(snapshot, self.read_manifest(snapshot), shared)
+
+    def rescan(self):
+        """Yield the usage of every snapshot, oldest first, comparing each with the one before."""
+        shared = {}
+        for snapshot in self.snapshots():
+            entries = self.read_manifest(snapshot)
+            yield self._usage(snapshot, entries, shared)
+            shared = self.stored(entries)
+
+    def _usage(self, snapshot: str, entries: list[dict], shared: dict) -> SnapshotUsage:
+        usage = SnapshotUsage(snapshot, len(entries), sum(entry['size'] for entry in entries))
+        usage.unique_bytes = sum(size for key, size in self.stored(entries).items() if key not in shared)
+        return usage
+
+    def referenced(self, exclude=()) -> dict[str, int]:
+        """Size of every file content held by a snapshot, leaving out the snapshots in exclude."""
+        sizes = {}
+        for snapshot in self.snapshots():
+            if snapshot not in exclude:
+                sizes.update((entry['hash'], entry['size']) for entry in self.read_manifest(snapshot))
+        return sizes
+
+    def freed_bytes(self, snapshots: list[str]) -> int:
+        """Bytes that removing the snapshots would free, counting only what no other snapshot holds."""
+        kept = self.stored([{'hash': key, 'size': size} for key, size in self.referenced(set(snapshots)).items()])
+        doomed = {}
+        for snapshot in snapshots:
+            doomed.update(self.stored(self.read_manifest(snapshot)))
+        return sum(size for key, size in doomed.items() if key not in kept)
+
+    def remove(self, snapshots: list[str]) -> int:
+        """Delete the snapshots' manifests, then anything no remaining snapshot holds.
+        Returns the number of files deleted from the store.
+        """
+        for snapshot in snapshots:
+            self.manifests.joinpath(f'{snapshot}.json').unlink(missing_ok=True)
+        return self.collect_garbage()
+
+    def collect_garbage(self) -> int:
+        """Delete objects no snapshot holds and partial writes left by interrupted runs."""
+        return _sweep(self.objects, set(self.referenced()))
+
+    def checkout(self, snapshot: str, target: Path, *, link_mode='copy', paths=None):
+        """Recreate a snapshot, or only the files at or under paths, as a dated folder under target.
+        Yields each file placed.
+        """
+        for entry in self.read_manifest(snapshot):
+            if not under_paths(entry['uri'], paths):
+                continue
+            local_pth = target.joinpath(entry['uri'])
+            self.place(entry['hash'], local_pth, link_mode=link_mode)
+            yield entry, local_pth
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.base_dir!s})'
+
+
+class ChunkStore(ObjectStore):
+    """Object store that splits large files into content-defined chunks and keeps each chunk once,
+    so a note that grows by a page only adds the chunks around the change.
+
+    Files smaller than the largest chunk are stored whole, as in ObjectStore. A larger file
+    is stored as a recipe in recipes/, named by the file's SHA-256 and listing its chunks in
+    order. The chunks are in chunks/, named by their own SHA-256.
+    """
+
+    def __init__(self, base_dir: Path, *, durability=None) -> None:
+        super().__init__(base_dir, durability=durability)
+        self.chunks = base_dir.joinpath('chunks')
+        self.recipes = base_dir.joinpath('recipes')
+
+    def chunk_path(self, digest: str) -> Path:
+        return self.chunks.joinpath(digest[:2], digest)
+
+    def recipe_path(self, digest: str) -> Path:
+        return self.recipes.joinpath(digest[:2], f'{digest}.json')
+
+    def __contains__(self, digest: str) -> bool:
+        return self.recipe_path(digest).is_file() or super().__contains__(digest)
+
+    def add_stream(self, chunks, *, expected_size=None) -> str:
+        if expected_size is not None and expected_size < MAX_SIZE:
+            return super().add_stream(chunks, expected_size=expected_size)
+        digest, received, recipe = sha256(), 0, []
+        for chunk in chunk_stream(chunks):
+            digest.update(chunk)
+            received += len(chunk)
+            recipe.append((self._add_chunk(chunk), len(chunk)))
+        if expected_size is not None and received != expected_size:
+            raise SizeMismatchError(f'Received {received} bytes, device listed {expected_size}')
+        file_hash = digest.hexdigest()
+        if file_hash not in self:
+            data = json.dumps({'size': received, 'chunks': recipe}).encode()
+            write_atomic(self.recipe_path(file_hash), data, durability=self.durability)
+        return file_hash
+
+    def _add_chunk(self, chunk: bytes) -> str:
+        digest = sha256(chunk).hexdigest()
+        target = self.chunk_path(digest)
+        if not target.is_file():
+            write_atomic(target, chunk, durability=self.durability)
+        return digest
+
+    def add_file(self, src: Path, digest=None, *, link_mode='copy') -> tuple[str, str]:
+        size = src.stat().st_size
+        if size < MAX_SIZE:
+            return super().add_file(src, digest, link_mode=link_mode)
+        if digest is not None and digest in self:
+            return digest, 'existing'
+        with open(src, 'rb') as file_in:
+            return self.add_stream(iter(lambda: file_in.read(READ_SIZE), b''), expected_size=size), 'chunked'
+
+    def read_recipe(self, digest: str) -> list[tuple[str, int]]:
+        with open(self.recipe_path(digest), encoding='utf-8') as recipe:
+            return [tuple(chunk) for chunk in json.load(recipe)['chunks']]
+
+    def read(self, digest: str):
+        """Yield the content of a chunked file, checking it against its hash on the way."""
+        check = sha256()
+        for chunk_hash, _ in self.read_recipe(digest):
+            data = self.chunk_path(chunk_hash).read_bytes()
+            check.update(data)
+            yield data
+        if check.hexdigest() != digest:
+            raise OSError(f'Chunks of {digest} reassemble to different content, the store is damaged')
+
+    def place(self, digest: str, dst: Path, *, link_mode='copy') -> str:
+        if not self.recipe_path(digest).is_file():
+            return super().place(digest, dst, link_mode=link_mode)
+        if dst.exists():
+            dst.unlink()
+        self.durability.makedirs(dst.parent)
+        fd, temp_name = temp_file(dst.parent, dst.name)
+        try:
+            with open(fd, 'wb') as file_output:
+                for data in self.read(digest):
+                    file_output.write(data)
+            os.replace(temp_name, dst)
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+        self.durability.written(dst)
+        return 'chunks'
+
+    def stored(self, entries: list[dict]) -> dict[str, int]:
+        """The size of each whole object and each chunk that holding these entries keeps on disk."""
+        sizes = {}
+        for entry in entries:
+            if entry['size'] >= MAX_SIZE and self.recipe_path(entry['hash']).is_file():
+                sizes.update(self.read_recipe(entry['hash']))
+            else:
+                sizes[entry['hash']] = entry['size']
+        return sizes
+
+    def collect_garbage(self) -> int:
+        """Delete objects, recipes and chunks no snapshot holds, and partial writes."""
+        files = set(self.referenced())
+        kept_chunks = set()
+        if self.recipes.is_dir():
+            for recipe in self.recipes.glob('*/*.json'):
+                if recipe.stem in files:
+                    kept_chunks.update(chunk_hash for chunk_hash, _ in self.read_recipe(recipe.stem))
+        removed = _sweep(self.recipes, {f'{digest}.json' for digest in files})
+        removed += _sweep(self.chunks, kept_chunks)
+        return removed + _sweep(self.objects, files)
+
+
+STORES = {'objects': ObjectStore, 'chunks': ChunkStore}
+LAYOUTS = ('folders', *STORES)
+
+
+def file_digest(path: Path) -> str:
+    digest = sha256()
+    with open(path, 'rb') as file_in:
+        while chunk := file_in.read(READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _sweep(folder: Path, keep: set) -> int:
+    """Delete files in the two level folder not named in keep, and any partial writes. Returns files deleted."""
+    if not folder.is_dir():
+        return 0
+    removed = 0
+    for entry in folder.iterdir():
+        if entry.is_file() and entry.name.endswith('.part'):
+            entry.unlink()
+        elif entry.is_dir():
+            for stored in entry.iterdir():
+                if stored.name not in keep:
+                    stored.unlink()
+                    removed += 1
+    return removed
@@ -0,0 +1,128 @@
+"""Packs of old backups: a dated folder compressed into one file beside a small index
+
+Every file in the folder is compressed on its own and written one after another into
+YYYY-MM-DD.pack. The index, YYYY-MM-DD.pack.json, lists the path, modified time, size
+and hash of each file with where its compressed data starts in the pack and how long
+it is, so any one file can be read back without decompressing the others. The index
+is written last, and a backup counts as packed once it exists.
+"""
+
+import os
+import json
+import zlib
+from pathlib import Path
+from hashlib import sha256
+
+from .storage import Durability, temp_file, write_atomic
+from .snapshots import SNAPSHOT_PATTERN, SnapshotUsage, under_paths
+
+PACK_SUFFIX = '.pack'
+INDEX_SUFFIX = '.pack.json'
+INDEX_FIELDS = ('path', 'mtime', 'size', 'hash', 'offset', 'length')
+COMPRESS_LEVEL = 6
+READ_SIZE = 1024 * 1024
+
+
+class Pack:
+    """The pack and index of the backup called name in save_dir."""
+
+    def __init__(self, save_dir: Path, name: str, *, durability=None) -> None:
+        self.name = name
+        self.path = save_dir.joinpath(f'{name}{PACK_SUFFIX}')
+        self.index_path = save_dir.joinpath(f'{name}{INDEX_SUFFIX}')
+        self.durability = durability or Durability()
+        self._entries = None
+
+    @classmethod
+    def create(cls, folder: Path, *, level=COMPRESS_LEVEL, durability=None) -> 'Pack':
+        """Pack every file in a backup folder. The folder is left for the caller to remove."""
+        pack = cls(folder.parent, folder.name, durability=durability)
+        files = sorted(path for path in folder.rglob('*') if path.is_file() and not path.is_symlink())
+        entries, offset = [], 0
+        fd, temp_name = temp_file(folder.parent, pack.path.name)
+        try:
+            with open(fd, 'wb') as pack_output:
+                for path in files:
+                    compressor, digest, size, length = zlib.compressobj(level), sha256(), 0, 0
+                    with open(path, 'rb') as file_input:
+                        while block := file_input.read(READ_SIZE):
+                            digest.update(block)
+                            size += len(block)
+                            data = compressor.compress(block)
+                            pack_output.write(data)
+                            length += len(data)
+                    data = compressor.flush()
+                    pack_output.write(data)
+                    length += len(data)
+                    fields = (path.relative_to(folder).as_posix(), path.stat().st_mtime, size, digest.hexdigest())
+                    entries.append(dict(zip(INDEX_FIELDS, (*fields, offset, length))))
+                    offset += length
+                pack_output.flush()
+                if pack.durability.mode == 'file':
+                    os.fsync(pack_output.fileno())
+            os.replace(temp_name, pack.path)
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+        pack.durability.written(pack.path, synced=True)
+        index = {'snapshot': pack.name, 'compression': 'zlib', 'files': entries}
+        write_atomic(pack.index_path, json.dumps(index, separators=(',', ':')).encode(), durability=pack.durability)
+        pack._entries = entries
+        return pack
+
+    def exists(self) -> bool:
+        return self.index_path.is_file()
+
+    def entries(self) -> list[dict]:
+        """The index entries, one per file in path order."""
+        if self._entries is None:
+            with open(self.index_path, encoding='utf-8') as index:
+                self._entries = json.load(index)['files']
+        return self._entries
+
+    def select(self, paths=None) -> list[dict]:
+        """Entries for the files at or under any of paths, or every entry when paths is not given."""
+        return [entry for entry in self.entries() if under_paths(entry['path'], paths)]
+
+    def read(self, entry: dict):
+        """Yield the content of one packed file, checking it against its hash on the way."""
+        damaged = f'{entry["path"]} in {self.path} unpacks to different content, the pack is damaged'
+        decompressor, check, remaining = zlib.decompressobj(), sha256(), entry['length']
+        with open(self.path, 'rb') as pack_input:
+            pack_input.seek(entry['offset'])
+            while remaining:
+                block = pack_input.read(min(READ_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                try:
+                    data = decompressor.decompress(block)
+                except zlib.error:
+                    raise OSError(damaged) from None
+                check.update(data)
+                yield data
+        data = decompressor.flush()
+        check.update(data)
+        yield data
+        if remaining or check.hexdigest() != entry['hash']:
+            raise OSError(damaged)
+
+    def disk_bytes(self) -> int:
+        return sum(path.stat().st_size for path in self.paths())
+
+    def usage(self) -> SnapshotUsage:
+        """Size of the packed backup. Nothing in a pack is shared, so its unique bytes are its size on disk."""
+        entries = self.entries()
+        return SnapshotUsage(self.name, len(entries), sum(entry['size'] for entry in entries), self.disk_bytes())
+
+    def paths(self) -> list[Path]:
+        """The pack's files that exist on disk."""
+        return [path for path in (self.path, self.index_path) if path.exists()]
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.path!s})'
+
+
+def packed_snapshots(save_dir: Path) -> list[str]:
+    """Names of the packed backups in save_dir, oldest first."""
+    return sorted(index.name[: -len(INDEX_SUFFIX)] for index in save_dir.glob(f'{SNAPSHOT_PATTERN}{INDEX_SUFFIX}'))
@@ -0,0 +1,159 @@
+"""Span tracing for the --profile flag"""
+
+import json
+import threading
+from pathlib import Path
+from time import perf_counter
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+class Span:
+    """A timed piece of a run with the bytes moved and device requests made inside it."""
+
+    __slots__ = ('name', 'attrs', 'start', 'duration', 'bytes', 'requests', 'children')
+
+    def __init__(self, name: str, attrs=None) -> None:
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = perf_counter()
+        self.duration = 0.0
+        self.bytes = 0
+        self.requests = 0
+        self.children = []
+
+    def add(self, *, nbytes=0, requests=0) -> None:
+        self.bytes += nbytes
+        self.requests += requests
+
+    def set(self, **attrs) -> None:
+        """Record attributes found out while the span runs, such as a count of fsyncs."""
+        self.attrs.update(attrs)
+
+    @property
+    def total_bytes(self) -> int:
+        return self.bytes + sum(child.total_bytes for child in self.children)
+
+    @property
+    def total_requests(self) -> int:
+        return self.requests + sum(child.total_requests for child in self.children)
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            'name': self.name,
+            'start': round(self.start - origin, 6),
+            'duration': round(self.duration, 6),
+            'bytes': self.total_bytes,
+            'requests': self.total_requests,
+            **({'attrs': self.attrs} if self.attrs else {}),
+            'children': [child.to_dict(origin) for child in self.children],
+        }
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.name!r}, {self.duration:.3f}s)'
+
+
+class _NullSpan:
+    """Stands in for a span while tracing is off. Anything recorded on it is discarded."""
+
+    __slots__ = ()
+
+    def add(self, *, nbytes=0, requests=0) -> None:
+        pass
+
+    def set(self, **attrs) -> None:
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Records a tree of spans when enabled and costs next to nothing when not.
+
+    Phases are opened on the thread that called start(). Spans opened on worker
+    threads, such as one per device request, attach to whichever phase that
+    thread is in at the time.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.root = Span('run')
+        self._active = self.root
+        self._owner = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        self.enabled = True
+        self.root = self._active = Span('run')
+        self._owner = threading.current_thread()
+
+    def stop(self) -> None:
+        self.root.duration = perf_counter() - self.root.start
+        self.enabled = False
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            yield NULL_SPAN
+            return
+        stack = self._local.__dict__.setdefault('stack', [])
+        owner = threading.current_thread() is self._owner
+        parent = stack[-1] if stack else self._active
+        span = Span(name, attrs)
+        with self._lock:
+            parent.children.append(span)
+        stack.append(span)
+        if owner:
+            self._active = span
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs['error'] = type(e).__name__
+            raise
+        finally:
+            span.duration = perf_counter() - span.start
+            stack.pop()
+            if owner:
+                self._active = stack[-1] if stack else self.root
+
+    def set(self, **attrs) -> None:
+        """Record attributes on the innermost span open on the calling thread, if tracing is on."""
+        stack = self._local.__dict__.get('stack') if self.enabled else None
+        if stack:
+            stack[-1].set(**attrs)
+
+    def summary(self) -> str:
+        """Indented per phase breakdown, with repeated spans such as requests rolled up."""
+        lines = [f'{"span":<40}{"count":>8}{"seconds":>10}{"MB":>10}{"requests":>10}']
+        self._summarise(self.root, 0, lines)
+        return '\n'.join(lines)
+
+    def _summarise(self, span: Span, depth: int, lines: list) -> None:
+        lines.append(_row(span.name, depth, 1, span.duration, span.total_bytes, span.total_requests))
+        groups = defaultdict(list)
+        for child in span.children:
+            groups[child.name].append(child)
+        for name, spans in groups.items():
+            if len(spans) == 1:
+                self._summarise(spans[0], depth + 1, lines)
+                continue
+            duration = sum(s.duration for s in spans)
+            nbytes = sum(s.total_bytes for s in spans)
+            requests = sum(s.total_requests for s in spans)
+            slowest = max(spans, key=lambda s: s.duration)
+            lines.append(_row(name, depth + 1, len(spans), duration, nbytes, requests))
+            lines.append(f'{"  " * (depth + 2)}slowest {slowest.duration:.3f}s {slowest.attrs}')
+
+    def write(self, path: Path) -> None:
+        """Save the span tree as JSON, with start times relative to the start of the run."""
+        path.write_text(json.dumps(self.root.to_dict(self.root.start), indent=1))
+
+
+def _row(name: str, depth: int, count: int, duration: float, nbytes: int, requests: int) -> str:
+    label = f'{"  " * depth}{name}'
+    return f'{label:<40}{count:>8}{duration:>10.3f}{nbytes / 1000**2:>10.2f}{requests:>10}'
+
+
+tracer = Tracer()
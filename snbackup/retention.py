@@ -0,0 +1,106 @@
+"""Which old backups to keep, and removing the rest"""
+
+import os
+import shutil
+from pathlib import Path
+from datetime import date
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .snapshots import SCAN_WORKERS
+
+TIERS = ('daily', 'weekly', 'monthly')
+TRASH = '.snbackup-trash'  # Backups are moved here before deletion, so a half deleted one is never listed
+
+
+class RetentionPolicy:
+    """Grandfather-father-son retention.
+
+    Keeps the newest backup of each of the last `daily` days that have one, of the
+    last `weekly` ISO weeks and of the last `monthly` months. A backup can count
+    towards several tiers. The newest backup is always kept, as the next run copies
+    unchanged files from it. A policy with every tier at zero keeps everything.
+    """
+
+    def __init__(self, daily=0, weekly=0, monthly=0) -> None:
+        for tier, count in zip(TIERS, (daily, weekly, monthly)):
+            if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+                raise ValueError(f'Retention for {tier} backups should be a whole number of 0 or more, not {count!r}')
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+
+    def keep(self, names: list[str]) -> set[str]:
+        """Names of the backups, named YYYY-MM-DD, that the policy keeps."""
+        if not self:
+            return set(names)
+        newest_first = sorted(names, reverse=True)
+        kept = set(newest_first[:1])
+        periods = {
+            'daily': lambda day: day,
+            'weekly': lambda day: day.isocalendar()[:2],
+            'monthly': lambda day: (day.year, day.month),
+        }
+        for tier, period in periods.items():
+            limit = getattr(self, tier)
+            seen = set()
+            for name in newest_first:
+                if len(seen) >= limit:
+                    break
+                key = period(date.fromisoformat(name))
+                if key not in seen:
+                    seen.add(key)
+                    kept.add(name)
+        return kept
+
+    def __bool__(self) -> bool:
+        return any((self.daily, self.weekly, self.monthly))
+
+    def __str__(self) -> str:
+        return ', '.join(f'{getattr(self, tier)} {tier}' for tier in TIERS if getattr(self, tier)) or 'everything'
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(daily={self.daily}, weekly={self.weekly}, monthly={self.monthly})'
+
+
+def _clear_dir(path: str) -> list[str]:
+    """Unlink the files in one folder and return its subfolders."""
+    folders = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            else:
+                os.unlink(entry.path)
+    return folders
+
+
+def remove_trees(paths: list[Path], *, workers=SCAN_WORKERS) -> None:
+    """Delete folders and everything in them, unlinking files in many folders at once."""
+    emptied = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_clear_dir, os.fspath(path)): os.fspath(path) for path in paths}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                emptied.append(pending.pop(future))
+                for folder in future.result():
+                    pending[executor.submit(_clear_dir, folder)] = folder
+    # Every subfolder was found after its parent, so the reverse order removes children first
+    for folder in reversed(emptied):
+        os.rmdir(folder)
+
+
+def prune_backups(base_dir: Path, doomed: list[Path], *, workers=SCAN_WORKERS) -> None:
+    """Move doomed backup folders and packs out of view, then delete them along with anything
+    an interrupted prune left.
+    """
+    trash = base_dir.joinpath(TRASH)
+    if not doomed and not trash.exists():
+        return
+    trash.mkdir(exist_ok=True)
+    for path in doomed:
+        target = trash.joinpath(path.name)
+        if target.is_dir():
+            shutil.rmtree(target)
+        path.replace(target)
+    remove_trees([trash], workers=workers)
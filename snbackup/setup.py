@@ -4,8 +4,6 @@ import re
 import json
 from pathlib import Path
 
-from rich.prompt import Prompt
-
 
 class SetupConf:
     """Assist in setting up a config file for application."""
@@ -21,6 +19,8 @@ class SetupConf:
 
     def prompt(self) -> None:
         """Collect user input."""
+        from rich.prompt import Prompt
+
         try:
             print(' SETUP '.center(55, '='))
             print('Where do you want to save your Supernote backups?')
@@ -0,0 +1,318 @@
+"""Local stand-in for the Supernote Browse & Access server, for load and integration testing.
+
+Serves folder listings in the device's HTML with embedded json format, file downloads and
+upload posts from a synthetic file tree, with configurable latency, bandwidth, slow
+responses and dropped connections. Run it with:
+
+    python -m snbackup.simulator --files 5000 --depth 3 --latency 0.02 --port 8089
+
+and point "device_url" in config.json at the address it prints.
+"""
+
+import json
+import math
+import time
+import random
+import threading
+from hashlib import sha256
+from datetime import datetime, timedelta
+from urllib.parse import unquote, urlsplit
+from email.parser import BytesParser
+from email.policy import HTTP
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .helpers import FOLDERS
+
+DATE_FORMAT = '%Y-%m-%d %H:%M'
+CHUNK_SIZE = 64 * 1024
+
+
+class SyntheticTree:
+    """Folders and files of a simulated device.
+
+    Folder dates track the newest file beneath them, so adding a file anywhere
+    bumps the date of every folder above it.
+    """
+
+    def __init__(self) -> None:
+        self.folders = {'': []}
+        self.folder_dates = {}
+        self.files = {}
+        self.uploads = {}
+        self._lock = threading.Lock()
+        for root in FOLDERS.values():
+            self.add_folder(root)
+
+    @classmethod
+    def generate(cls, files=100, *, depth=2, fanout=3, median_size=200_000, sigma=1.0, root='Note', seed=0):
+        """Build a tree of nested folders `depth` levels deep under root, each holding `fanout`
+        subfolders, with files spread across them and log-normally distributed sizes.
+        """
+        rng = random.Random(seed)
+        tree = cls()
+        level = [root]
+        folders = [root]
+        for _ in range(depth):
+            level = [f'{parent}/folder_{n}' for parent in level for n in range(fanout)]
+            folders.extend(level)
+        for folder in folders:
+            tree.add_folder(folder)
+
+        start = datetime(2024, 1, 1)
+        for n in range(files):
+            size = max(1, int(rng.lognormvariate(math.log(median_size), sigma)))
+            modified = start + timedelta(minutes=rng.randrange(365 * 24 * 60))
+            tree.add_file(f'{rng.choice(folders)}/note {n}.note', size, modified.strftime(DATE_FORMAT))
+        return tree
+
+    def add_folder(self, uri: str) -> None:
+        with self._lock:
+            self._add_folder(uri)
+
+    def _add_folder(self, uri: str) -> None:
+        if uri in self.folders:
+            return
+        parent = uri.rpartition('/')[0]
+        self._add_folder(parent)
+        self.folders[parent].append(uri)
+        self.folders[uri] = []
+        self.folder_dates[uri] = '2024-01-01 00:00'
+
+    def add_file(self, uri: str, size: int, date: str, content: bytes | None = None) -> None:
+        with self._lock:
+            folder = uri.rpartition('/')[0]
+            self._add_folder(folder)
+            if uri not in self.files:
+                self.folders[folder].append(uri)
+            self.files[uri] = (date, size)
+            if content is not None:
+                self.uploads[uri] = content
+            while folder:
+                self.folder_dates[folder] = max(self.folder_dates[folder], date)
+                folder = folder.rpartition('/')[0]
+
+    def listing(self, uri: str) -> list[dict]:
+        """Child entries of a folder in the form the device lists them."""
+        entries = []
+        for child in self.folders[uri]:
+            name = child.rpartition('/')[2]
+            entry = {'date': None, 'extension': '', 'isDirectory': child in self.folders, 'name': name, 'size': 0}
+            if entry['isDirectory']:
+                entry['date'] = self.folder_dates[child]
+            else:
+                entry['date'], entry['size'] = self.files[child]
+                entry['extension'] = name.rpartition('.')[2]
+            entry['uri'] = f'/{child}'
+            entries.append(entry)
+        return entries
+
+    def content(self, uri: str):
+        """Yield a file's bytes in chunks. Synthetic files repeat a block derived from their uri."""
+        if uri in self.uploads:
+            yield self.uploads[uri]
+            return
+        size = self.files[uri][1]
+        chunk = sha256(uri.encode()).digest() * (CHUNK_SIZE // 32)
+        for offset in range(0, size, CHUNK_SIZE):
+            yield chunk[: min(CHUNK_SIZE, size - offset)]
+
+    @property
+    def total_size(self) -> int:
+        return sum(size for _, size in self.files.values())
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({len(self.folders) - 1} folders, {len(self.files)} files)'
+
+
+def listing_page(tree: SyntheticTree, uri: str) -> bytes:
+    listing = {
+        'availableMemory': 23330586624,
+        'deviceName': 'Supernote',
+        'fileList': tree.listing(uri),
+        'routeList': [{'name': 'Supernote', 'path': '/'}],
+        'totalMemory': 32.0,
+    }
+    payload = json.dumps(listing, separators=(',', ':'), ensure_ascii=False)
+    return f"<html><body><script>const json = '{payload}'\n</script></body></html>".encode()
+
+
+class DeviceSimulator:
+    """Serve a SyntheticTree over HTTP the way Browse & Access does.
+
+    latency:    seconds added before every response
+    bandwidth:  bytes per second each response body is capped at, or None for no cap
+    slow_rate:  chance a response is delayed a further slow_delay seconds
+    drop_rate:  chance a file download is cut off half way through
+
+    Faults are drawn from a seeded random generator so runs are repeatable.
+    """
+
+    def __init__(
+        self,
+        tree: SyntheticTree | None = None,
+        *,
+        host='127.0.0.1',
+        port=0,
+        latency=0.0,
+        bandwidth=None,
+        slow_rate=0.0,
+        slow_delay=1.0,
+        drop_rate=0.0,
+        seed=0,
+    ) -> None:
+        self.tree = tree or SyntheticTree.generate()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.drop_rate = drop_rate
+        self.requests = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def faults(self, method: str, uri: str) -> tuple[float, bool]:
+        """Record a request and decide its extra delay and whether its connection drops."""
+        with self._lock:
+            self.requests.append((method, uri))
+            delay = self.latency + (self.slow_delay if self._rng.random() < self.slow_rate else 0.0)
+            drop = uri in self.tree.files and self._rng.random() < self.drop_rate
+        return delay, drop
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.url}, {self.tree!r})'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:
+        simulator = self.server.simulator
+        tree = simulator.tree
+        uri = self._uri()
+        delay, drop = simulator.faults('GET', uri)
+        time.sleep(delay)
+
+        if uri in tree.folders:
+            body = listing_page(tree, uri)
+            self._respond(200, len(body), [body], 'text/html; charset=utf-8')
+        elif uri in tree.files:
+            size = tree.files[uri][1]
+            self._respond(200, size, tree.content(uri), 'application/octet-stream', drop=drop)
+        else:
+            self._respond(404, 0, [], 'text/plain')
+
+    def do_POST(self) -> None:
+        simulator = self.server.simulator
+        uri = self._uri()
+        delay, _ = simulator.faults('POST', uri)
+        time.sleep(delay)
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        header = f'Content-Type: {self.headers.get("Content-Type", "")}\r\n\r\n'.encode()
+        message = BytesParser(policy=HTTP).parsebytes(header + body)
+        if uri not in simulator.tree.folders or not message.is_multipart():
+            self._respond(400, 0, [], 'text/plain')
+            return
+
+        now = datetime.now().strftime(DATE_FORMAT)
+        saved = []
+        for part in message.iter_parts():
+            name, content = part.get_filename(), part.get_payload(decode=True) or b''
+            simulator.tree.add_file(f'{uri}/{name}', len(content), now, content)
+            saved.append({'name': name, 'size': len(content)})
+        reply = json.dumps(saved).encode()
+        self._respond(200, len(reply), [reply], 'application/json')
+
+    def _uri(self) -> str:
+        return unquote(urlsplit(self.path).path).strip('/')
+
+    def _respond(self, status: int, length: int, chunks, content_type: str, *, drop=False) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+        bandwidth = self.server.simulator.bandwidth
+        sent = 0
+        for chunk in chunks:
+            if drop and sent + len(chunk) >= length // 2:
+                self.wfile.write(chunk[: length // 2 - sent])
+                self.close_connection = True
+                return
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Serve a synthetic Supernote device for testing snbackup.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--files', type=int, default=1000, help='Number of files to generate')
+    parser.add_argument('--depth', type=int, default=2, help='Levels of folders below Note')
+    parser.add_argument('--fanout', type=int, default=3, help='Subfolders in each folder')
+    parser.add_argument('--size', type=int, default=200_000, help='Median file size in bytes')
+    parser.add_argument('--sigma', type=float, default=1.0, help='Spread of the log-normal file sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--bandwidth', type=int, help='Bytes per second cap for each response')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Chance a response is delayed further')
+    parser.add_argument('--slow-delay', type=float, default=1.0, help='Seconds a slow response is delayed')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Chance a download is cut off')
+    args = parser.parse_args()
+
+    tree = SyntheticTree.generate(
+        args.files, depth=args.depth, fanout=args.fanout, median_size=args.size, sigma=args.sigma, seed=args.seed
+    )
+    simulator = DeviceSimulator(
+        tree,
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        slow_rate=args.slow_rate,
+        slow_delay=args.slow_delay,
+        drop_rate=args.drop_rate,
+        seed=args.seed,
+    )
+    print(f'Serving {tree!r}, {tree.total_size / 1e6:.1f} MB, at {simulator.url}')
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Sizes of the backup folders on local disk, indexed so -ls does not have to walk them"""
+
+import os
+from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+SNAPSHOT_PATTERN = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'  # YYYY-MM-DD
+SCAN_WORKERS = 8  # Folders listed at once. Walking is I/O bound, so this helps most on network drives
+
+
+class SnapshotUsage:
+    """File count and sizes of one backup folder.
+
+    `bytes` adds up every file, the same as a plain listing would. `unique_bytes`
+    counts the data of each file once and leaves out data hard linked from the
+    backup before it, so it is how much the snapshot added to disk use. Summed over
+    all snapshots it gives the space they take up together.
+    """
+
+    __slots__ = ('name', 'files', 'bytes', 'unique_bytes')
+
+    def __init__(self, name: str, files=0, nbytes=0, unique_bytes=0) -> None:
+        self.name = name
+        self.files = files
+        self.bytes = nbytes
+        self.unique_bytes = unique_bytes
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SnapshotUsage):
+            return NotImplemented
+        return (self.name, self.files, self.bytes, self.unique_bytes) == (
+            other.name,
+            other.files,
+            other.bytes,
+            other.unique_bytes,
+        )
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.name}, files={self.files}, bytes={self.bytes}, unique={self.unique_bytes})'
+
+
+def snapshot_folders(save_dir: Path, pattern=SNAPSHOT_PATTERN) -> list[Path]:
+    """Backup folders in save_dir, oldest first."""
+    return sorted(folder for folder in save_dir.glob(pattern) if folder.is_dir())
+
+
+def _scan_dir(path: str) -> tuple[list[tuple], list[str]]:
+    files, folders = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                # scandir leaves inode and link count at zero on Windows
+                stat = os.stat(entry.path) if os.name == 'nt' else entry.stat(follow_symlinks=False)
+                files.append((stat.st_dev, stat.st_ino, stat.st_size, stat.st_nlink))
+    return files, folders
+
+
+def walk_files(path: Path, *, workers=SCAN_WORKERS):
+    """Yield (device, inode, size, links) for every file under path, listing folders in parallel."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_dir, os.fspath(path))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, folders = future.result()
+                pending.update(executor.submit(_scan_dir, folder) for folder in folders)
+                yield from files
+
+
+def scan_snapshot(path: Path, *, previous=None, workers=SCAN_WORKERS) -> tuple[SnapshotUsage, set]:
+    """Measure a backup folder. A file's data is shared when its inode is in previous, the
+    inodes of the backup before, or when previous is not given, when the file has other links.
+
+    Returns the usage and the folder's inodes, to pass as previous for the next backup.
+    """
+    usage = SnapshotUsage(path.name)
+    inodes = set()
+    for dev, ino, size, links in walk_files(path, workers=workers):
+        usage.files += 1
+        usage.bytes += size
+        if (dev, ino) in inodes:
+            continue
+        inodes.add((dev, ino))
+        shared = (dev, ino) in previous if previous is not None else links > 1
+        if not shared:
+            usage.unique_bytes += size
+    return usage, inodes
+
+
+def freed_bytes(folders: list[Path], *, workers=SCAN_WORKERS) -> int:
+    """Bytes that removing folders would free. Data hard linked from elsewhere stays on disk."""
+    links, sizes = {}, {}
+    for folder in folders:
+        for dev, ino, size, nlink in walk_files(folder, workers=workers):
+            links[dev, ino] = links.get((dev, ino), 0) + 1
+            sizes[dev, ino] = (size, nlink)
+    return sum(size for inode, (size, nlink) in sizes.items() if links[inode] >= nlink)
+
+
+def rescan_snapshots(folders: list[Path], *, workers=SCAN_WORKERS):
+    """Yield the usage of each backup folder, oldest first, comparing each with the one before."""
+    previous = set()
+    for folder in folders:
+        usage, previous = scan_snapshot(folder, previous=previous, workers=workers)
+        yield usage
+
+
+def rebased(names: list[str], removed: set[str]) -> list[tuple[str | None, str]]:
+    """Pair each remaining snapshot that directly followed a removed one with the snapshot now before it."""
+    pairs = []
+    previous, gap = None, False
+    for name in sorted(names):
+        if name in removed:
+            gap = True
+            continue
+        if gap:
+            pairs.append((previous, name))
+        previous, gap = name, False
+    return pairs
+
+
+def under_paths(uri: str, paths) -> bool:
+    """Whether uri is one of paths or inside one of them. Every uri is when paths is empty."""
+    if not paths:
+        return True
+    return any(uri == path.strip('/') or uri.startswith(f'{path.strip("/")}/') for path in paths)
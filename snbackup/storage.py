@@ -0,0 +1,225 @@
+"""Strategies for writing files into today's backup and flushing them to disk"""
+
+import os
+import errno
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+FICLONE = 0x40049409  # Linux ioctl to share extents between files on btrfs, xfs, etc.
+
+LINK_MODES = {
+    'hardlink': ('hardlink', 'reflink', 'copy_file_range', 'copy'),
+    'reflink': ('reflink', 'copy_file_range', 'copy'),
+    'copy_file_range': ('copy_file_range', 'copy'),
+    'copy': ('copy',),
+}
+
+
+DURABILITY_MODES = ('file', 'batch', 'none')
+
+
+def _umask() -> int:
+    # Read once at import, as setting the umask to look at it is not thread safe
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+FILE_MODE = 0o666 & ~_umask()  # Permissions open() would give a new file
+
+
+class Durability:
+    """Decides when written files and their folders are flushed to disk.
+
+    file:  fsync each file as soon as it is written (the default)
+    batch: fsync every written file once, together, at the end of the run
+    none:  never fsync and leave flushing to the operating system
+
+    In file and batch modes the folders holding new files are fsynced
+    at the end of the run too, so renames and links survive a crash.
+    """
+
+    def __init__(self, mode='file') -> None:
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f'Unknown durability mode {mode!r}. Choose from {", ".join(DURABILITY_MODES)}')
+        self.mode = mode
+        self.created = set()
+        self.pending_files = set()
+        self.pending_dirs = set()
+        self._lock = threading.Lock()
+
+    def makedirs(self, directory: Path) -> None:
+        """Create a folder and any missing parents, at most once per run."""
+        if directory in self.created:
+            return
+        missing = []
+        parent = directory
+        while not parent.exists():
+            missing.append(parent)
+            parent = parent.parent
+        directory.mkdir(exist_ok=True, parents=True)
+        with self._lock:
+            self.created.add(directory)
+            if self.mode != 'none':
+                self.pending_dirs.update(folder.parent for folder in missing)
+
+    def written(self, path: Path, *, synced=False) -> None:
+        """Record that a file's data was written. In file mode it is flushed
+        now unless the caller already fsynced it before closing.
+        """
+        if self.mode == 'file' and not synced:
+            _fsync_path(path)
+        with self._lock:
+            if self.mode == 'batch':
+                self.pending_files.add(path)
+            if self.mode != 'none':
+                self.pending_dirs.add(path.parent)
+
+    def linked(self, path: Path) -> None:
+        """Record a new directory entry whose data is already on disk."""
+        if self.mode != 'none':
+            with self._lock:
+                self.pending_dirs.add(path.parent)
+
+    def sync(self) -> int:
+        """Flush pending files, then their folders. Returns the number of fsync calls made."""
+        with self._lock:
+            files, self.pending_files = self.pending_files, set()
+            dirs, self.pending_dirs = self.pending_dirs, set()
+        for path in files:
+            _fsync_path(path)
+        if os.name == 'nt':  # Folders can't be opened for fsync on Windows
+            return len(files)
+        for directory in dirs:
+            _fsync_path(directory)
+        return len(files) + len(dirs)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.mode!r})'
+
+
+def _fsync_path(path: Path) -> None:
+    flags = os.O_RDWR if os.name == 'nt' else os.O_RDONLY
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _hardlink(src: Path, dst: Path) -> None:
+    os.link(src, dst)
+
+
+def _reflink(src: Path, dst: Path) -> None:
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.ENOTSUP, 'Reflinks not supported on this platform') from None
+
+    with open(src, 'rb') as file_in, open(dst, 'wb') as file_out:
+        try:
+            fcntl.ioctl(file_out.fileno(), FICLONE, file_in.fileno())
+        except OSError:
+            file_out.close()
+            dst.unlink()
+            raise
+
+
+def _copy_file_range(src: Path, dst: Path) -> None:
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOTSUP, 'copy_file_range not supported on this platform')
+
+    with open(src, 'rb') as file_in, open(dst, 'wb') as file_out:
+        try:
+            remaining = os.fstat(file_in.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(file_in.fileno(), file_out.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except OSError:
+            file_out.close()
+            dst.unlink()
+            raise
+
+
+def _copy(src: Path, dst: Path) -> None:
+    with open(src, 'rb') as file_in, open(dst, 'wb') as file_out:
+        shutil.copyfileobj(file_in, file_out)
+
+
+STRATEGIES = {
+    'hardlink': _hardlink,
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'copy': _copy,
+}
+
+
+def _place(src: Path, dst: Path, mode: str) -> str:
+    *preferred, fallback = LINK_MODES[mode]
+    for strategy in preferred:
+        try:
+            STRATEGIES[strategy](src, dst)
+        except OSError:
+            continue
+        return strategy
+    STRATEGIES[fallback](src, dst)
+    return fallback
+
+
+def carry_file(src: Path, dst: Path, *, mode='copy', durability=None) -> str:
+    """Place an unchanged file from a previous backup at dst using the cheapest
+    strategy the filesystem supports for the chosen mode. Returns the strategy used.
+    """
+    if mode not in LINK_MODES:
+        raise ValueError(f'Unknown link mode {mode!r}. Choose from {", ".join(LINK_MODES)}')
+    durability = durability or Durability()
+
+    if dst.exists():
+        if os.path.samefile(src, dst):
+            return 'existing'
+        dst.unlink()
+    durability.makedirs(dst.parent)
+
+    strategy = _place(src, dst, mode)
+    if strategy == 'hardlink':
+        durability.linked(dst)
+    else:
+        durability.written(dst)
+    return strategy
+
+
+def write_atomic(path: Path, data: bytes, *, durability=None) -> None:
+    """Write a small file in a single step, so it is never seen half written."""
+    durability = durability or Durability()
+    durability.makedirs(path.parent)
+    fd, temp_name = temp_file(path.parent, path.name)
+    try:
+        with open(fd, 'wb') as file_output:
+            file_output.write(data)
+            file_output.flush()
+            if durability.mode == 'file':
+                os.fsync(file_output.fileno())
+        os.replace(temp_name, path)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+    durability.written(path, synced=True)
+
+
+def temp_file(directory: Path, name='') -> tuple[int, str]:
+    """Create a temp file in directory to be renamed over `name` once written. mkstemp makes it
+    readable by the owner only, so it is given the permissions of any other new file.
+    """
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix=f'.{name}.' if name else '.', suffix='.part')
+    try:
+        os.chmod(temp_name, FILE_MODE)
+    except BaseException:
+        os.close(fd)
+        os.unlink(temp_name)
+        raise
+    return fd, temp_name
@@ -0,0 +1,123 @@
+"""Concurrency and bandwidth control for requests to the device"""
+
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+CONGESTED_LATENCY = 0.05  # Below this a response is never treated as a sign of congestion
+DECREASE_COOLDOWN = 1.0  # Seconds after a decrease before the next, so one bad burst only halves once
+
+
+class TokenBucket:
+    """Caps throughput at `rate` bytes per second with bursts of up to `capacity` bytes.
+
+    Callers going over the cap run the bucket into debt and sleep until it is
+    paid back, so concurrent readers share the rate between them.
+    """
+
+    def __init__(self, rate: float, capacity=None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes: int) -> float:
+        """Take nbytes from the bucket, sleeping if it is empty. Returns the seconds slept."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class TrafficController:
+    """Limits requests in flight to the device with additive increase, multiplicative decrease.
+
+    Every response that arrives in good time raises the limit by 1/limit, about one
+    extra request per round of responses. An error, or a response slower than
+    `latency_factor` times the fastest seen, halves it. The limit stays between
+    min_concurrency and max_concurrency, and with no max_concurrency requests are
+    never held back. When `rate` is set, response bodies are also held to that many
+    bytes per second.
+    """
+
+    def __init__(self, max_concurrency=None, *, min_concurrency=1, rate=None, latency_factor=3.0) -> None:
+        self.max_concurrency = math.inf if max_concurrency is None else max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.limit = float(self.max_concurrency)
+        self.latency_factor = latency_factor
+        self.bucket = TokenBucket(rate) if rate else None
+        self.baseline = None
+        self.in_flight = 0
+        self.peak = 0
+        self.lowest = self.limit
+        self.decreases = {'error': 0, 'slow': 0}
+        self.throttled = 0.0
+        self._last_decrease = float('-inf')
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the permitted in-flight requests for the duration of the block."""
+        with self._cond:
+            while self.in_flight + 1 > self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def record(self, latency=None, *, error=False) -> None:
+        """Adjust the limit after a response, or after a request failed when error is set."""
+        if self.max_concurrency == math.inf:
+            return
+        with self._cond:
+            slow = False
+            if latency is not None:
+                self.baseline = latency if self.baseline is None else min(self.baseline, latency)
+                slow = latency > max(CONGESTED_LATENCY, self.latency_factor * self.baseline)
+            if error or slow:
+                now = time.monotonic()
+                if now - self._last_decrease >= DECREASE_COOLDOWN:
+                    self._last_decrease = now
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.lowest = min(self.lowest, self.limit)
+                    self.decreases['error' if error else 'slow'] += 1
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def throttle(self, nbytes: int) -> None:
+        """Account for bytes received, sleeping as needed to stay under the bandwidth cap."""
+        if self.bucket is None:
+            return
+        waited = self.bucket.consume(nbytes)
+        if waited:
+            with self._cond:
+                self.throttled += waited
+
+    def state(self) -> str:
+        with self._cond:
+            if self.max_concurrency == math.inf:
+                limit = 'no concurrency limit'
+            else:
+                limit = f'concurrency limit {self.limit:.1f} of {self.max_concurrency} (lowest {self.lowest:.1f})'
+            backoffs = (
+                f'halved {self.decreases["error"]} times on errors and {self.decreases["slow"]} on slow responses'
+            )
+            rate = f', capped at {self.bucket.rate / 1000**2:.2f} MB/s' if self.bucket else ''
+            throttled = f', throttled {self.throttled:.1f}s' if self.bucket else ''
+            return f'{limit}, peak {self.peak} in flight, {backoffs}{rate}{throttled}'
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.max_concurrency}, limit={self.limit:.1f})'
@@ -1,4 +1,6 @@
 import json
+import time
+import hashlib
 import random
 import textwrap
 from pathlib import Path
@@ -9,8 +11,9 @@ import pytest
 import httpx
 
 from snbackup import backup
-from snbackup.files import SnFiles
+from snbackup.files import SnFiles, SizeMismatchError
 from snbackup.device import Device
+from snbackup.changeset import Changeset
 
 # Create global logger inside backup namespace otherwise the functions with logging will fail
 backup.create_logger(__file__, running_tests=True)
@@ -131,21 +134,21 @@ def json_string() -> str:
 
 @pytest.fixture
 def device():
-    test_device = Device('http://192.168.1.5:8089/')
+    test_device = Device('http://192.168.1.5:8089/', backoff=0)
     yield test_device
     test_device.close()
 
 
 def test_talk_to_device_get_success(device, html_text):
     with patch.object(device.client, 'get') as mock_get:
-        mock_response = MagicMock(spec=httpx.Response)
+        mock_response = MagicMock(spec=httpx.Response, status_code=200)
         mock_response.raise_for_status.return_value = None
         mock_response.text = html_text
         mock_get.return_value = mock_response
 
         response = backup.talk_to_device(device, '/root-index-html-test')
         assert response.text == html_text
-        mock_get.assert_called_once_with('/root-index-html-test')
+        mock_get.assert_called_once_with('/root-index-html-test', timeout=device.timeouts())
 
 
 def test_talk_to_device_post_success(device):
@@ -157,7 +160,9 @@ def test_talk_to_device_post_success(device):
 
         response = backup.talk_to_device(device, '/fake-post', document={'fake_file': "open(fake_file, 'rb')"})
         assert response.json() == mock_response.json()
-        mock_post.assert_called_once_with('/fake-post', files={'fake_file': "open(fake_file, 'rb')"})
+        mock_post.assert_called_once_with(
+            '/fake-post', files={'fake_file': "open(fake_file, 'rb')"}, timeout=device.timeouts()
+        )
 
 
 def test_talk_to_device_http_errors(device):
@@ -168,6 +173,43 @@ def test_talk_to_device_http_errors(device):
         with pytest.raises(SystemExit) as e:
             backup.talk_to_device(device, "/test-http-errors")
         assert e.value.code == 1
+        transient = isinstance(mock_get.side_effect, httpx.TransportError)
+        assert mock_get.call_count == (device.retries + 1 if transient else 1)
+
+
+def test_device_retries_and_timeouts(device):
+    ok = MagicMock(spec=httpx.Response, status_code=200)
+    unavailable = httpx.Response(503, request=httpx.Request('GET', 'http://192.168.1.5:8089/Note'))
+    not_found = httpx.Response(404, request=httpx.Request('GET', 'http://192.168.1.5:8089/Note'))
+    with patch.object(device.client, 'get') as mock_get:
+        mock_get.side_effect = [httpx.ReadTimeout('read timeout'), unavailable, ok]
+        assert device.http_request('Note') is ok
+        assert device.retried == 2
+        timeouts = [call.kwargs['timeout'] for call in mock_get.call_args_list]
+        assert [t.read for t in timeouts] == [device.timeouts(attempt=n).read for n in range(3)]
+        assert timeouts[0].read < timeouts[1].read < timeouts[2].read
+
+        mock_get.side_effect = [not_found]
+        with pytest.raises(httpx.HTTPStatusError):
+            device.http_request('Note')
+        assert device.retried == 2
+
+    device.latency = None
+    device.observe(2.0)
+    assert device.timeouts().connect == 8.0
+    assert device.timeouts(size=20_000_000).read == 28.0
+    assert device.timeouts(size=10**10).read == 120.0
+
+
+def test_upload_timeouts_sized_by_file(device, tmp_path):
+    note = tmp_path.joinpath('Large.note')
+    note.write_bytes(b'n' * 20_000_000)
+    uploaded = MagicMock(spec=httpx.Response)
+    uploaded.json.return_value = [{'size': 20_000_000}]
+    with patch.object(device.client, 'post', return_value=uploaded) as mock_post:
+        assert backup.upload_file(device, note, '/Note') == 20_000_000
+    assert mock_post.call_args.kwargs['timeout'] == device.timeouts(size=20_000_000)
+    assert mock_post.call_args.kwargs['timeout'].write > device.timeouts().write
 
 
 def test_previous_record_gen(metadata):
@@ -176,7 +218,8 @@ def test_previous_record_gen(metadata):
         temp.flush() 
         pth = Path(temp.name)
         data_lst = [
-            (data.get('current_loc'), data.get('uri'), data.get('modified'), data.get('size')) for data in metadata
+            (data.get('current_loc'), data.get('uri'), data.get('modified'), data.get('size'), data.get('hash'))
+            for data in metadata
         ]
         assert list(backup.previous_record_gen(pth)) == data_lst
 
@@ -269,18 +312,202 @@ def test_load_parsed(json_string):
     assert backup.load_parsed(json_string) == response
 
 
-def test_check_for_deleted():
-    # Common notes 
-    cur_notes = {SnFiles(Path(f'/test/path/2024-08-0{n}'), f'uri/common_{n}.note', f'2024-07-04 13:45:0{n}', 404040) for n in range(1,5)}
-    pre_notes = {SnFiles(Path(f'/test/path/2024-08-0{n}'), f'uri/common_{n}.note', f'2024-07-04 13:45:0{n}', 404040) for n in range(1,5)}
+@pytest.fixture
+def device_tree() -> dict:
+    return {
+        'Note': [('Note/Work', True, 0), ('Note/Today.note', False, 10), ('Note/Study', True, 0)],
+        'Note/Work': [('Note/Work/Deep', True, 0), ('Note/Work/Plan.note', False, 20)],
+        'Note/Work/Deep': [('Note/Work/Deep/Down.note', False, 30)],
+        'Note/Study': [('Note/Study/Python.note', False, 40)],
+    }
+
+
+def fake_device(tree: dict, calls: list, *, delay=0.0, payload=b'bytes', broken=()) -> Device:
+    """Device whose client serves listings from tree and file downloads from memory."""
+    sizes = {uri: size for entries in tree.values() for uri, is_dir, size in entries if not is_dir}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        uri = request.url.path.lstrip('/')
+        calls.append(uri)
+        if uri in broken:
+            raise httpx.ReadTimeout('read timeout', request=request)
+        if uri in tree:
+            time.sleep(delay)
+            entries = [
+                {'uri': f'/{u}', 'isDirectory': d, 'date': '2024-08-01 10:00', 'size': s} for u, d, s in tree[uri]
+            ]
+            listing = json.dumps({'fileList': entries}, separators=(',', ':'))
+            return httpx.Response(200, text=f"const json = '{listing}'")
+        return httpx.Response(200, content=b'x' * sizes[uri] if uri in sizes else payload)
+
+    test_device = Device('http://192.168.1.5:8089/', backoff=0)
+    test_device.client = httpx.Client(base_url=test_device.base_url, transport=httpx.MockTransport(handler))
+    return test_device
+
+
+def test_download_files_with_failures(tmp_path):
+    good = [SnFiles(tmp_path, f'Note/good_{n}.note', '2024-08-01 10:00:00', 5) for n in range(6)]
+    bad = SnFiles(tmp_path, 'Note/bad.note', '2024-08-01 10:00:00', 5)
+    short = SnFiles(tmp_path, 'Note/short.note', '2024-08-01 10:00:00', 50)
+
+    test_device = fake_device({}, [], broken={bad.file_uri})
+    downloaded, skipped, failed = backup.download_files(test_device, set(good) | {bad, short}, workers=3)
+    test_device.close()
+
+    assert downloaded == sorted(good, key=lambda f: f.file_uri)
+    assert skipped == []
+    assert failed == [bad, short]
+    assert test_device.retried == 2 * test_device.retries
+    assert all(file.full_path.read_bytes() == b'bytes' for file in good)
+    assert all(file.file_hash == hashlib.sha256(b'bytes').hexdigest() for file in good)
+    assert not bad.full_path.exists()
+    assert not short.full_path.exists()
+    assert sorted(p.name for p in tmp_path.joinpath('Note').iterdir()) == [f.full_path.name for f in downloaded]
+
+
+def test_save_stream_replaces_atomically(tmp_path):
+    target = tmp_path.joinpath('Note/Today.note')
+    assert backup.save_stream(target, [b'old']) == hashlib.sha256(b'old').hexdigest()
+
+    with pytest.raises(SizeMismatchError):
+        backup.save_stream(target, [b'new', b'er'], expected_size=100)
+    assert target.read_bytes() == b'old'
+
+    assert backup.save_stream(target, [b'new', b'er'], expected_size=5) == hashlib.sha256(b'newer').hexdigest()
+    assert target.read_bytes() == b'newer'
+    assert list(target.parent.iterdir()) == [target]
+
+
+def test_device_uri_gen_breadth_first(device_tree):
+    expected = {
+        ('Note/Today.note', '2024-08-01 10:00', 10),
+        ('Note/Work/Plan.note', '2024-08-01 10:00', 20),
+        ('Note/Work/Deep/Down.note', '2024-08-01 10:00', 30),
+        ('Note/Study/Python.note', '2024-08-01 10:00', 40),
+    }
+    root = [{'uri': 'Note', 'isDirectory': True}]
+    calls = []
+    test_device = fake_device(device_tree, calls)
+    serial = list(backup.device_uri_gen(test_device, root))
+    parallel = list(backup.device_uri_gen(test_device, root, workers=4))
+    test_device.close()
+
+    assert set(serial) == set(parallel) == expected
+    assert len(serial) == len(parallel) == len(expected)
+    assert len(calls) == 2 * len(device_tree)
+
+
+def test_device_uri_gen_reuses_unchanged_folders(device_tree):
+    root = [{'uri': 'Note', 'isDirectory': True}]
+    calls = []
+    test_device = fake_device(device_tree, calls)
+    listed = {}
+    first = list(backup.device_uri_gen(test_device, root, listed=listed))
+    assert set(listed) == set(device_tree)
+
+    calls.clear()
+    cached = list(backup.device_uri_gen(test_device, root, folder_cache=listed))
+    assert cached == first
+    assert calls == ['Note']  # Root folders carry no date so they are always listed
+
+    calls.clear()
+    stale = dict(listed, **{'Note/Work': ('2024-07-01 10:00', listed['Note/Work'][1])})
+    refreshed = {}
+    assert set(backup.device_uri_gen(test_device, root, folder_cache=stale, listed=refreshed)) == set(first)
+    test_device.close()
+
+    assert sorted(calls) == ['Note', 'Note/Work']
+    assert refreshed == listed
+
+
+def test_pipeline_backup(device_tree, tmp_path):
+    previous_dir = tmp_path.joinpath('2024-08-01')
+    today = tmp_path.joinpath('2024-08-02')
+    previous = {
+        file.file_uri: file
+        for file in (
+            SnFiles(previous_dir, 'Note/Today.note', '2024-08-01 10:00', 10),  # Unchanged
+            SnFiles(previous_dir, 'Note/Study/Python.note', '2024-07-01 10:00', 40),  # Modified
+            SnFiles(previous_dir, 'Note/Gone.note', '2024-07-01 10:00', 50),  # Deleted
+        )
+    }
+    changes = Changeset(previous)
+    root = [{'uri': 'Note', 'isDirectory': True}]
+    calls = []
+    test_device = fake_device(device_tree, calls, delay=0.05)
+    device_files = backup.device_uri_gen(test_device, root)
+    downloaded, skipped, failed = backup.pipeline_backup(test_device, device_files, changes, today, workers=2)
+    test_device.close()
+
+    assert [file.file_uri for file in downloaded] == [
+        'Note/Study/Python.note',
+        'Note/Work/Deep/Down.note',
+        'Note/Work/Plan.note',
+    ]
+    assert all(file.full_path.stat().st_size == file.file_size for file in downloaded)
+    assert skipped == failed == []
+    assert [file.file_uri for file in changes.modified] == ['Note/Study/Python.note']
+    assert [(file.file_uri, file.base_path) for file in changes.unchanged] == [('Note/Today.note', previous_dir)]
+    assert [file.file_uri for file in changes.deleted] == ['Note/Gone.note']
+    # Downloads began before the deepest folder was listed
+    assert calls.index('Note/Work/Plan.note') < calls.index('Note/Work/Deep')
+
+
+def test_same_day_rerun_skips_saved_files(device_tree, tmp_path):
+    today = tmp_path.joinpath('2024-08-02')
+    files = [SnFiles(today, uri, '2024-08-01 10:00', size) for uri, size in (('Note/A.note', 10), ('Note/B.note', 20))]
+
+    calls = []
+    test_device = fake_device({'Note': [(f.file_uri, False, f.file_size) for f in files]}, calls)
+    downloaded, skipped, failed = backup.download_files(test_device, files[:1], skip_present=True)
+    assert (downloaded, skipped, failed) == (files[:1], [], [])
+    assert backup.already_saved(files[0], today)
+    assert not backup.already_saved(files[1], today)
+
+    # A second run on the same day only fetches what the first one missed
+    calls.clear()
+    downloaded, skipped, failed = backup.download_files(test_device, files, skip_present=True)
+    test_device.close()
+    assert (downloaded, skipped, failed) == (files[1:], files[:1], [])
+    assert calls == ['Note/B.note']
+
+    # Modified on device since the earlier run
+    changed = SnFiles(today, 'Note/A.note', '2024-08-02 09:00', 10)
+    assert not backup.already_saved(changed, today)
+
+
+
+def test_relocate_moved(tmp_path):
+    source = SnFiles(tmp_path.joinpath('2024-08-01'), 'Note/Old.note', '2024-08-01 10:00', 5)
+    source.full_path.parent.mkdir(parents=True)
+    source.full_path.write_bytes(b'bytes')
+    current = SnFiles(tmp_path.joinpath('2024-08-02'), 'Note/Folder/New.note', '2024-08-01 10:00', 5)
+    lost = SnFiles(tmp_path.joinpath('2024-08-02'), 'Note/Lost.note', '2024-08-01 10:00', 5)
+
+    gone = SnFiles(tmp_path.joinpath('2024-08-01'), 'Note/Deleted locally.note', '2024-08-01 10:00', 5)
+    relocated, missing = backup.relocate_moved([(source, current), (gone, lost)], link_mode='hardlink')
+
+    assert relocated == [current]
+    assert missing == [lost]
+    assert current.full_path.read_bytes() == b'bytes'
+    assert backup.already_saved(current, current.base_path)
+
+
+def test_extract_file_list(html_text, json_string):
+    expected = json.loads(json_string)['fileList']
+    assert backup.extract_file_list(html_text) == expected
+    assert backup.listing_entries(html_text) == expected
+
+    spaced = html_text.replace('"fileList":[', '"fileList": [')
+    assert backup.extract_file_list(spaced) == expected
 
-    # New note created on device since last backup
-    cur_notes.add(SnFiles(Path('/test/path/2024-08-11'), 'uri/NEW_only_in_current.note', '2024-08-11 13:45:00', 404040))
+    # Layouts the fast path doesn't understand fall back to the regex parser
+    assert backup.extract_file_list('invalid html text') is None
+    renamed_key = html_text.replace('"fileList":', '"files":')
+    assert backup.extract_file_list(renamed_key) is None
+    assert backup.listing_entries(renamed_key) == []
+    truncated = html_text.replace('"uri":"/Note/ABC123.note"}]', '"uri":"/Note/ABC123.note"}')
+    assert backup.extract_file_list(truncated) is None
 
-    # Two notes only found in previous, deleted from device since last backup
-    previous_1 = SnFiles(Path('/test/path/2023-07-31'), 'uri/only_in_previous_1.note', '2023-07-31 12:01:01', 404040)
-    previous_2 = SnFiles(Path('/test/path/2023-07-31'), 'uri/only_in_previous_2.note', '2023-07-31 12:01:01', 404040)
-    pre_notes.add(previous_1)
-    pre_notes.add(previous_2)
-    
-    assert backup.check_for_deleted(cur_notes, pre_notes) == [previous_1, previous_2]
+    with pytest.raises(SystemExit):
+        backup.listing_entries('invalid html text')
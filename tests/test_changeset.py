@@ -0,0 +1,96 @@
+from pathlib import Path
+
+from snbackup.files import SnFiles
+from snbackup.changeset import Changeset, diff_files
+
+
+def test_diff_files():
+    today = Path('/test/path/2024-08-11')
+    # Common notes
+    cur_notes = [SnFiles(today, f'uri/common_{n}.note', f'2024-07-04 13:45:0{n}', 404040) for n in range(1, 5)]
+    pre_notes = [
+        SnFiles(Path(f'/test/path/2024-08-0{n}'), f'uri/common_{n}.note', f'2024-07-04 13:45:0{n}', 404040)
+        for n in range(1, 5)
+    ]
+
+    # New note created on device since last backup
+    new = SnFiles(today, 'uri/NEW_only_in_current.note', '2024-08-11 13:45:00', 404040)
+    cur_notes.append(new)
+
+    # Modified on device, same uri as a previous note
+    modified = SnFiles(today, 'uri/common_1.note', '2024-08-10 09:00:00', 505050)
+    cur_notes[0] = modified
+
+    # Two notes only found in previous, deleted from device since last backup
+    previous_1 = SnFiles(Path('/test/path/2023-07-31'), 'uri/only_in_previous_1.note', '2023-07-31 12:01:01', 404040)
+    previous_2 = SnFiles(Path('/test/path/2023-07-31'), 'uri/only_in_previous_2.note', '2023-07-31 12:01:01', 404040)
+    pre_notes.extend((previous_1, previous_2))
+
+    changes = diff_files(cur_notes, {note.file_uri: note for note in pre_notes})
+    assert changes.added == [new]
+    assert changes.modified == [modified]
+    assert changes.unchanged == pre_notes[1:4]  # Unchanged files keep pointing at their previous location
+    assert changes.deleted == [previous_1, previous_2]
+    assert changes.to_download == [new, modified]
+    assert changes.summary() == '1 new, 1 modified, 3 unchanged, 0 moved, 2 deleted'
+
+
+def test_changeset_streaming():
+    today = Path('/test/path/2024-08-11')
+    previous = {'uri/a.note': SnFiles(Path('/test/path/2024-08-10'), 'uri/a.note', '2024-08-01 10:00', 1)}
+    changes = Changeset(previous)
+
+    assert changes.add(SnFiles(today, 'uri/a.note', '2024-08-01 10:00', 1)) is False
+    assert changes.add(SnFiles(today, 'uri/b.note', '2024-08-01 10:00', 1)) is True
+    assert changes.finish() == []
+    assert previous == {}
+
+
+def test_same_content_ignores_location():
+    a = SnFiles(Path('/test/path/2024-08-10'), 'uri/a.note', '2024-08-01 10:00', 1)
+    b = SnFiles(Path('/test/path/2024-08-11'), 'uri/b.note', '2024-08-01 10:00', 1)
+    assert a.same_content(b)
+    assert a != b
+    assert a == SnFiles(Path('/elsewhere'), 'uri/a.note', '2024-08-01 10:00', 1)
+
+
+def test_detect_moves():
+    before, today = Path('/test/path/2024-08-10'), Path('/test/path/2024-08-11')
+    renamed = SnFiles(before, 'Note/Old name.note', '2024-08-01 10:00', 100, 'aaa')
+    copied = SnFiles(before, 'Note/Original.note', '2024-08-02 10:00', 200, 'bbb')
+    twin_1 = SnFiles(before, 'Note/Twin 1.note', '2024-08-03 10:00', 300, 'ccc')
+    twin_2 = SnFiles(before, 'Note/Twin 2.note', '2024-08-03 10:00', 300, None)
+    previous = {file.file_uri: file for file in (renamed, copied, twin_1, twin_2)}
+
+    current = [
+        SnFiles(today, 'Note/Folder/New name.note', '2024-08-01 10:00', 100),
+        SnFiles(today, 'Note/Original.note', '2024-08-02 10:00', 200),
+        SnFiles(today, 'Note/Copy of Original.note', '2024-08-02 10:00', 200),  # Original is still on device
+        SnFiles(today, 'Note/Twin 3.note', '2024-08-03 10:00', 300),  # Ambiguous, hash unknown for one twin
+    ]
+    changes = Changeset(dict(previous), detect_moves=True)
+    # Possible moves wait for the end of the listing, when it is known which files are gone
+    assert [changes.add(file) for file in current] == [False, False, False, False]
+    assert changes.finish() == [current[2], current[3]]
+
+    assert changes.moved == [(renamed, current[0])]
+    assert current[0].file_hash == 'aaa'
+    assert changes.added == [current[2], current[3]]
+    assert changes.deleted == [twin_1, twin_2]
+    assert changes.summary() == '2 new, 0 modified, 1 unchanged, 1 moved, 2 deleted'
+
+    # A file gone from device is moved once, a second match is a new file
+    again = SnFiles(today, 'Note/Other name.note', '2024-08-01 10:00', 100)
+    changes = diff_files([current[0], again], {renamed.file_uri: renamed}, detect_moves=True)
+    assert changes.moved == [(renamed, current[0])]
+    assert changes.added == [again] and changes.deleted == []
+
+    # Twins gone from device with the same recorded hash are the same content
+    twin_2.file_hash = 'ccc'
+    changes = diff_files(current[3:], {file.file_uri: file for file in (twin_1, twin_2)}, detect_moves=True)
+    assert changes.moved == [(twin_1, current[3])]
+    assert changes.deleted == [twin_2]
+
+    changes = diff_files(current[:1], {renamed.file_uri: renamed})
+    assert changes.moved == []
+    assert changes.added == current[:1]
@@ -0,0 +1,75 @@
+import os
+import random
+from hashlib import sha256
+
+import pytest
+
+from snbackup.chunking import MAX_SIZE, MIN_SIZE, chunk_stream, cut_point
+from snbackup.objects import ChunkStore
+
+
+def pages(count: int, seed=1) -> list[bytes]:
+    rng = random.Random(seed)
+    return [rng.randbytes(20_000) for _ in range(count)]
+
+
+def blocks(data: bytes, size=100_000):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def entry(uri: str, data: bytes) -> dict:
+    return {'uri': uri, 'modified': '2024-08-01 10:00:00', 'size': len(data), 'hash': sha256(data).hexdigest()}
+
+
+def test_chunks_are_content_defined():
+    data = b''.join(pages(60))
+    chunks = list(chunk_stream(blocks(data)))
+    assert b''.join(chunks) == data
+    assert all(MIN_SIZE <= len(chunk) <= MAX_SIZE for chunk in chunks[:-1])
+    # Cut points do not depend on how the stream arrives
+    assert list(chunk_stream(blocks(data, 7_777))) == chunks
+    assert cut_point(b'short') == 5
+
+    # A page added in the middle only changes the chunks around it
+    edited = b''.join(pages(30) + pages(1, seed=2) + pages(60)[30:])
+    new_chunks = set(chunk_stream(blocks(edited))) - set(chunks)
+    assert sum(len(chunk) for chunk in new_chunks) < len(edited) // 3
+
+
+def test_chunk_store(tmp_path):
+    store = ChunkStore(tmp_path)
+    v1 = b''.join(pages(60))
+    v2 = v1 + b''.join(pages(2, seed=3))
+    small = b'small note'
+
+    h1 = store.add_stream(blocks(v1), expected_size=len(v1))
+    assert h1 == sha256(v1).hexdigest()
+    assert store.recipe_path(h1).is_file()
+    chunks_v1 = set(store.chunks.rglob('*'))
+    h2 = store.add_stream(blocks(v2), expected_size=len(v2))
+    assert b''.join(store.read(h2)) == v2
+    # Appending pages stores a couple of new chunks, not another copy of the file
+    new_chunks = [path for path in store.chunks.rglob('*') if path.is_file() and path not in chunks_v1]
+    assert 0 < len(new_chunks) <= 3
+    assert store.add_stream([small], expected_size=len(small)) in store
+    assert store.path(sha256(small).hexdigest()).read_bytes() == small
+
+    store.write_manifest('2024-08-01', [entry('Note/Big.note', v1), entry('Note/Small.note', small)])
+    store.write_manifest('2024-08-02', [entry('Note/Big.note', v2), entry('Note/Small.note', small)])
+    usage = store.usage('2024-08-02', '2024-08-01')
+    assert usage.bytes == len(v2) + len(small)
+    assert usage.unique_bytes == sum(path.stat().st_size for path in new_chunks)
+
+    target = tmp_path.joinpath('checkout/2024-08-02')
+    assert [placed['uri'] for placed, _ in store.checkout('2024-08-02', target)] == ['Note/Big.note', 'Note/Small.note']
+    assert target.joinpath('Note/Big.note').read_bytes() == v2
+
+    only_v1 = set(store.read_recipe(h1)) - set(store.read_recipe(h2))
+    assert store.freed_bytes(['2024-08-01']) == sum(size for _, size in only_v1)
+    assert store.remove(['2024-08-01']) == len(only_v1) + 1
+    assert not store.recipe_path(h1).exists()
+    assert b''.join(store.read(h2)) == v2
+
+    os.truncate(sorted(path for path in store.chunks.rglob('*') if path.is_file())[0], 10)
+    with pytest.raises(OSError):
+        b''.join(store.read(h2))
@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import pytest
+
+from snbackup.files import SnFiles
+from snbackup.metadata import MetadataStore
+from snbackup.snapshots import SnapshotUsage
+
+
+@pytest.fixture
+def store(tmp_path):
+    metadata_store = MetadataStore(tmp_path.joinpath(MetadataStore.file_name))
+    yield metadata_store
+    metadata_store.close()
+
+
+@pytest.fixture
+def legacy_records() -> list[tuple]:
+    return [
+        ('/backups/2024-08-04', 'Note/Journal.note', '2024-08-04 09:03:00', 17979631, None),
+        ('/backups/2024-08-04', 'Note/Cool.note', '2024-06-27 16:32:00', 27926564, 'abc123'),
+    ]
+
+
+def test_import_and_lookup(store, legacy_records):
+    assert store.is_empty()
+    assert store.previous_map() == {}
+
+    assert store.import_records(legacy_records) == 2
+    assert not store.is_empty()
+    assert store.latest == '2024-08-04'
+
+    previous = store.previous_map()
+    assert sorted(previous) == ['Note/Cool.note', 'Note/Journal.note']
+    cool = previous['Note/Cool.note']
+    assert cool == SnFiles(Path('/backups/2024-08-04'), 'Note/Cool.note', '2024-06-27 16:32:00', 27926564)
+    assert cool.full_path == Path('/backups/2024-08-04/Note/Cool.note')
+    assert cool.file_hash == 'abc123'
+
+
+def test_commit_run_replaces_snapshot(store, legacy_records, tmp_path):
+    store.import_records(legacy_records)
+    today = tmp_path.joinpath('2024-08-05')
+    journal = SnFiles(today, 'Note/Journal.note', '2024-08-05 10:00:00', 100, 'def456')
+
+    # An interrupted run leaves the previous state alone
+    run_id = store.begin_run(today.name)
+    store.end_run(run_id)
+    assert store.latest == '2024-08-04'
+
+    run_id = store.begin_run(today.name)
+    store.commit_run(run_id, [journal.make_record()], downloaded=1, deleted=1)
+    assert store.latest == '2024-08-05'
+    previous = store.previous_map()
+    assert list(previous) == ['Note/Journal.note']
+    assert previous['Note/Journal.note'].file_hash == 'def456'
+
+    # Same day rerun replaces the snapshot's rows
+    run_id = store.begin_run(today.name)
+    store.commit_run(run_id, [], skipped=0)
+    assert store.previous_map() == {}
+
+    runs = store.conn.execute('SELECT status, downloaded, deleted FROM runs ORDER BY id DESC').fetchall()
+    assert [status for status, *_ in runs] == ['complete', 'complete', 'failed', 'imported']
+    assert runs[1] == ('complete', 1, 1)
+
+
+def test_prune(store, legacy_records, tmp_path):
+    store.import_records(legacy_records)
+    today = tmp_path.joinpath('2024-08-05')
+    run_id = store.begin_run(today.name)
+    store.commit_run(run_id, [SnFiles(today, 'Note/New.note', '2024-08-05 10:00:00', 1).make_record()])
+
+    assert store.prune({'2024-08-05'}) == 2
+    assert store.prune(set()) == 0
+    assert list(store.previous_map()) == ['Note/New.note']
+
+
+def test_folder_cache(store):
+    assert store.folder_cache() == {}
+    entries = [{'uri': '/Note/Work/Plan.note', 'isDirectory': False, 'date': '2024-08-01 10:00', 'size': 20}]
+    store.save_folders(
+        {'Note': (None, []), 'Note/Work': ('2024-08-01 10:00', entries), 'Document': (None, [])},
+        roots=['Note', 'Document'],
+    )
+    assert store.folder_cache()['Note/Work'] == ('2024-08-01 10:00', entries)
+
+    # Folders missing from a new crawl of their root are dropped, other roots are left alone
+    store.save_folders({'Note': (None, [])}, roots=['Note'])
+    assert store.folder_cache() == {'Note': (None, []), 'Document': (None, [])}
+
+
+def test_snapshot_usage(store):
+    store.save_usage([SnapshotUsage('2024-08-01', 3, 300, 300), SnapshotUsage('2024-08-02', 3, 320, 20)])
+    store.save_usage([SnapshotUsage('2024-08-02', 4, 400, 100)])
+    assert store.snapshot_usage() == {
+        '2024-08-01': SnapshotUsage('2024-08-01', 3, 300, 300),
+        '2024-08-02': SnapshotUsage('2024-08-02', 4, 400, 100),
+    }
+
+    store.forget_usage(['2024-08-01'])
+    assert list(store.snapshot_usage()) == ['2024-08-02']
+    store.save_usage([SnapshotUsage('2024-08-03', 1, 10, 10)], replace=True)
+    assert list(store.snapshot_usage()) == ['2024-08-03']
@@ -0,0 +1,89 @@
+import json
+
+from snbackup import backup, profiling
+from snbackup.files import SnFiles
+from snbackup.device import Device
+from snbackup.metrics import RunMetrics, percentile
+from snbackup.profiling import Tracer
+from snbackup.simulator import CHUNK_SIZE, DeviceSimulator, SyntheticTree
+
+
+def traced_run() -> Tracer:
+    tracer = Tracer()
+    tracer.start()
+    with tracer.span('crawl'):
+        for n in range(4):
+            with tracer.span('list_request', uri=f'Note/{n}'):
+                tracer.set(latency=0.01 * (n + 1))
+    with tracer.span('download'):
+        with tracer.span('download_request', uri='Note/a.note') as span:
+            tracer.set(latency=0.02)
+            span.add(nbytes=2000, requests=1)
+        with tracer.span('download_request', uri='Note/b.note'):
+            pass  # Failed before the device responded
+    tracer.stop()
+    return tracer
+
+
+def test_percentile():
+    values = [float(n) for n in range(1, 101)]
+    assert percentile(values, 0.5) == 50.0
+    assert percentile(values, 0.99) == 99.0
+    assert percentile([3.0], 0.9) == 3.0
+    assert percentile([], 0.5) == 0.0
+
+
+def test_run_metrics(tmp_path):
+    run = RunMetrics()
+    run.count(listed=5, to_download=1, unchanged=4, downloaded=1, carried=4)
+    run.bytes = 2000
+    run.finish(traced_run().root)
+
+    assert set(run.phases) == {'crawl', 'download'}
+    assert run.latencies == {'list': [0.01, 0.02, 0.03, 0.04], 'download': [0.02]}
+    assert run.throughput > 0
+
+    text = run.openmetrics()
+    assert text.endswith('# EOF\n')
+    assert 'snbackup_files{kind="carried"} 4\n' in text
+    assert 'snbackup_downloaded_bytes 2000\n' in text
+    assert 'snbackup_request_latency_seconds_count{request="list"} 4\n' in text
+    assert 'snbackup_phase_duration_seconds{phase="crawl"}' in text
+
+    prom, history = tmp_path.joinpath('snbackup.prom'), tmp_path.joinpath('history.jsonl')
+    run.write_textfile(prom)
+    run.write_textfile(prom)
+    run.append_history(history)
+    run.exit_code = 1
+    run.append_history(history)
+    assert prom.read_text() == text
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['history.jsonl', 'snbackup.prom']
+    runs = [json.loads(line) for line in history.read_text().splitlines()]
+    assert [entry['exit_code'] for entry in runs] == [0, 1]
+    assert runs[0]['files']['listed'] == 5
+    assert runs[0]['latency']['list']['count'] == 4
+
+
+def test_download_latency_excludes_transfer(tmp_path, monkeypatch):
+    """A slow body makes a download take far longer than the device takes to start responding."""
+    backup.create_logger(str(tmp_path.joinpath('snbackup')), running_tests=True)
+    tracer = Tracer()
+    monkeypatch.setattr(backup, 'tracer', tracer)
+    monkeypatch.setattr(profiling, 'tracer', tracer)
+    monkeypatch.setattr('snbackup.device.tracer', tracer)
+    tree = SyntheticTree.generate(2, median_size=4 * CHUNK_SIZE, sigma=0.0)
+    with DeviceSimulator(tree, bandwidth=20 * CHUNK_SIZE) as simulator:
+        device = Device(simulator.url, timeout=10)
+        files = [SnFiles(tmp_path, uri, date, size) for uri, (date, size) in tree.files.items()]
+        tracer.start()
+        with tracer.span('download'):
+            downloaded, _, failed = backup.download_files(device, files, workers=2)
+        tracer.stop()
+        device.close()
+
+    assert len(downloaded) == 2 and not failed
+    run = RunMetrics()
+    run.finish(tracer.root)
+    requests = tracer.root.children[0].children
+    assert len(run.latencies['download']) == 2
+    assert max(run.latencies['download']) < min(span.duration for span in requests) / 2
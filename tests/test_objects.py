@@ -0,0 +1,108 @@
+import os
+from hashlib import sha256
+from pathlib import Path
+
+import pytest
+
+from snbackup import backup
+from snbackup.files import SnFiles, SizeMismatchError
+from snbackup.objects import ObjectStore
+from snbackup.snapshots import SnapshotUsage
+
+
+def digest(data: bytes) -> str:
+    return sha256(data).hexdigest()
+
+
+def record(snapshot: str, uri: str, data: bytes) -> dict:
+    snfile = SnFiles(Path('/backups', snapshot), uri, '2024-08-01 10:00:00', len(data), digest(data))
+    return snfile.make_record()
+
+
+@pytest.fixture
+def objects(tmp_path):
+    return ObjectStore(tmp_path)
+
+
+def test_add_stream_stores_content_once(objects):
+    plan = objects.add_stream([b'plan ', b'v1'], expected_size=7)
+    assert plan == digest(b'plan v1')
+    assert objects.path(plan).read_bytes() == b'plan v1'
+    assert objects.add_stream([b'plan v1']) == plan
+    assert [path.name for path in objects.objects.rglob('*') if path.is_file()] == [plan]
+
+    with pytest.raises(SizeMismatchError):
+        objects.add_stream([b'short'], expected_size=10)
+    assert not list(objects.objects.glob('*.part'))
+
+
+def test_manifests_usage_and_removal(objects):
+    plan, ideas_v1, ideas_v2 = b'p' * 100, b'i' * 10, b'i' * 20
+    for data in (plan, ideas_v1, ideas_v2):
+        objects.add_stream([data])
+    objects.write_manifest(
+        '2024-08-01', [record('2024-08-01', 'Note/Plan.note', plan), record('2024-08-01', 'Note/Ideas.note', ideas_v1)]
+    )
+    objects.write_manifest(
+        '2024-08-02', [record('2024-08-02', 'Note/Plan.note', plan), record('2024-08-02', 'Note/Ideas.note', ideas_v2)]
+    )
+
+    assert objects.snapshots() == ['2024-08-01', '2024-08-02']
+    assert objects.read_manifest('2024-08-02')[0] == {
+        'uri': 'Note/Ideas.note',
+        'modified': '2024-08-01 10:00:00',
+        'size': 20,
+        'hash': digest(ideas_v2),
+    }
+    assert objects.usage('2024-08-02', '2024-08-01') == SnapshotUsage('2024-08-02', 2, 120, 20)
+    assert list(objects.rescan()) == [
+        SnapshotUsage('2024-08-01', 2, 110, 110),
+        objects.usage('2024-08-02', '2024-08-01'),
+    ]
+
+    # Plan.note is still held by the later backup, so only the first version of Ideas.note goes
+    assert objects.freed_bytes(['2024-08-01']) == 10
+    assert objects.remove(['2024-08-01']) == 1
+    assert objects.snapshots() == ['2024-08-02']
+    assert digest(ideas_v1) not in objects
+    assert digest(plan) in objects
+
+
+def test_checkout(objects, tmp_path):
+    data = b'handwritten notes'
+    objects.add_stream([data])
+    objects.write_manifest('2024-08-01', [record('2024-08-01', 'Note/Work/Plan.note', data)])
+    backup.create_logger(str(tmp_path.joinpath('snbackup')), running_tests=True)
+
+    target = backup.checkout_snapshot(objects, 'latest', tmp_path.joinpath('checkout'), link_mode='hardlink')
+    assert target == tmp_path.joinpath('checkout/2024-08-01')
+    plan = target.joinpath('Note/Work/Plan.note')
+    assert plan.read_bytes() == data
+    assert os.path.samefile(plan, objects.path(digest(data)))
+    assert (
+        plan.stat().st_mtime
+        == SnFiles(target, 'Note/Work/Plan.note', '2024-08-01 10:00:00', 0).last_modified.timestamp()
+    )
+
+    with pytest.raises(SystemExit):
+        backup.checkout_snapshot(objects, '2024-07-01', tmp_path.joinpath('checkout'))
+
+
+def test_store_unchanged_from_folders(objects, tmp_path, caplog):
+    """Switching layouts adds files from the last dated folder to the store, after that nothing is copied."""
+    backup.create_logger(str(tmp_path.joinpath('snbackup')), running_tests=True)
+    folder = tmp_path.joinpath('2024-08-01/Note')
+    folder.mkdir(parents=True)
+    folder.joinpath('Plan.note').write_bytes(b'plan')
+    previous = SnFiles(tmp_path.joinpath('2024-08-01'), 'Note/Plan.note', '2024-08-01 10:00:00', 4)
+    today = tmp_path.joinpath('2024-08-02')
+
+    assert backup.store_unchanged([previous], today, objects, link_mode='hardlink') == ([previous], [])
+    assert 'carried forward in the object store (hardlink: 1)' in caplog.text
+    assert previous.recorded_hash == digest(b'plan')
+    assert previous.base_path == today
+    assert not today.exists()
+
+    objects.write_manifest(today.name, [previous.make_record()])
+    assert backup.store_unchanged([previous], tmp_path.joinpath('2024-08-03'), objects) == ([previous], [])
+    assert 'carried forward in the object store (stored: 1)' in caplog.text
@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+from snbackup import backup
+from snbackup.packs import Pack, packed_snapshots
+from snbackup.metadata import MetadataStore
+from snbackup.snapshots import SnapshotUsage
+
+
+@pytest.fixture
+def save_dir(tmp_path):
+    """Three daily backups. Plan.note is unchanged and hard linked forward, Ideas.note is edited each day."""
+    for day, size in (('2024-08-01', 10), ('2024-08-02', 20), ('2024-08-03', 30)):
+        folder = tmp_path.joinpath(day, 'Note/Work')
+        folder.mkdir(parents=True)
+        if day == '2024-08-01':
+            folder.joinpath('Plan.note').write_bytes(b'plan' * 25)
+        else:
+            os.link(tmp_path.joinpath('2024-08-01/Note/Work/Plan.note'), folder.joinpath('Plan.note'))
+        folder.joinpath('Ideas.note').write_bytes(os.urandom(size))
+        os.utime(folder.joinpath('Ideas.note'), (1722500000, 1722500000))
+    tmp_path.joinpath('metadata.db').touch()
+    return tmp_path
+
+
+def test_pack_reads_single_files(save_dir):
+    folder = save_dir.joinpath('2024-08-02')
+    ideas = folder.joinpath('Note/Work/Ideas.note').read_bytes()
+    pack = Pack.create(folder)
+    assert pack.exists() and folder.is_dir()
+    assert [entry['path'] for entry in pack.entries()] == ['Note/Work/Ideas.note', 'Note/Work/Plan.note']
+    assert pack.usage() == SnapshotUsage('2024-08-02', 2, 120, pack.disk_bytes())
+
+    # Entries are read from the index again and each file straight from its offset
+    reopened = Pack(save_dir, '2024-08-02')
+    (plan,) = reopened.select(['Note/Work/Plan.note'])
+    assert b''.join(reopened.read(plan)) == b'plan' * 25
+    (entry,) = reopened.select(['/Note/Work/Ideas.note'])
+    assert b''.join(reopened.read(entry)) == ideas and entry['mtime'] == 1722500000
+    assert reopened.select(['Note']) == reopened.entries()
+    assert reopened.select(['Note/Wo']) == []
+
+    with open(pack.path, 'r+b') as damaged:
+        damaged.seek(plan['offset'] + plan['length'] // 2)
+        damaged.write(b'\xff\xff')
+    with pytest.raises(OSError, match='the pack is damaged'):
+        b''.join(reopened.read(plan))
+
+
+def test_pack_backups(save_dir, caplog):
+    backup.create_logger(str(save_dir.joinpath('snbackup')), running_tests=True)
+    store = MetadataStore(save_dir.joinpath(MetadataStore.file_name))
+    try:
+        backup.list_backups(save_dir, store, rescan=True)
+        assert backup.pack_backups(save_dir, store, older_than=10_000) == []
+
+        # The latest backup stays a folder for the next run to carry unchanged files from
+        assert backup.pack_backups(save_dir, store, older_than=0, workers=2) == ['2024-08-01', '2024-08-02']
+        assert packed_snapshots(save_dir) == ['2024-08-01', '2024-08-02']
+        assert not save_dir.joinpath('2024-08-01').exists() and save_dir.joinpath('2024-08-03').is_dir()
+        assert backup.snapshot_names(save_dir) == ['2024-08-01', '2024-08-02', '2024-08-03']
+        assert 'Packed backup 2024-08-02: 2 files' in caplog.text
+
+        # Plan.note is no longer shared with a folder before it, so it counts towards the latest backup
+        index = store.snapshot_usage()
+        assert index['2024-08-02'] == Pack(save_dir, '2024-08-02').usage()
+        assert index['2024-08-03'] == SnapshotUsage('2024-08-03', 2, 130, 130)
+        assert list(backup.rescan_backups(save_dir)) == list(index.values())
+
+        target = backup.unpack_snapshot(
+            save_dir, '2024-08-01', save_dir.joinpath('checkout'), paths=['Note/Work/Plan.note']
+        )
+        assert [path.name for path in target.rglob('*.note')] == ['Plan.note']
+        assert target.joinpath('Note/Work/Plan.note').read_bytes() == b'plan' * 25
+        latest = backup.unpack_snapshot(save_dir, 'latest', save_dir.joinpath('checkout'))
+        assert latest.name == '2024-08-02'
+        assert latest.joinpath('Note/Work/Ideas.note').stat().st_mtime == 1722500000
+        with pytest.raises(SystemExit, match='is not packed'):
+            backup.unpack_snapshot(save_dir, '2024-08-03', save_dir.joinpath('checkout'))
+
+        # Retention sees packed backups and removes their files
+        removed = backup.cleanup_backups(save_dir, num_backups=2, cleanup=True, dry_run=True)
+        assert [folder.name for folder in removed] == ['2024-08-01']
+        assert f'would free {backup.bytes_to_mb(Pack(save_dir, "2024-08-01").disk_bytes())} MB' in caplog.text
+        backup.cleanup_backups(save_dir, num_backups=2, cleanup=True)
+        assert backup.snapshot_names(save_dir) == ['2024-08-02', '2024-08-03']
+        assert not any(save_dir.glob('2024-08-01*'))
+    finally:
+        store.close()
+
+
+def test_pack_keeps_latest_complete_backup(save_dir):
+    backup.create_logger(str(save_dir.joinpath('snbackup')), running_tests=True)
+    store = MetadataStore(save_dir.joinpath(MetadataStore.file_name))
+    try:
+        backup.list_backups(save_dir, store, rescan=True)
+        # The run that made 2024-08-03 never completed, so the next run carries files from 2024-08-02
+        store.commit_run(store.begin_run('2024-08-02'), [])
+        store.begin_run('2024-08-03')
+        assert backup.pack_backups(save_dir, store, older_than=0) == ['2024-08-01']
+        assert save_dir.joinpath('2024-08-02').is_dir() and save_dir.joinpath('2024-08-03').is_dir()
+    finally:
+        store.close()
@@ -0,0 +1,54 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from snbackup.profiling import NULL_SPAN, Tracer
+
+
+def request(tracer: Tracer, n: int) -> None:
+    with tracer.span('request', n=n) as span:
+        span.add(nbytes=100, requests=1)
+        tracer.set(latency=n / 100)
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer()
+    with tracer.span('phase') as span:
+        assert span is NULL_SPAN
+        span.add(nbytes=10)
+        span.set(fsyncs=3)
+        tracer.set(latency=0.1)
+    assert tracer.root.children == []
+
+
+def test_span_tree(tmp_path):
+    tracer = Tracer()
+    tracer.start()
+    with tracer.span('crawl'):
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            list(pool.map(lambda n: request(tracer, n), range(6)))
+    with pytest.raises(OSError):
+        with tracer.span('carry') as span:
+            span.set(files=2)
+            raise OSError
+    tracer.stop()
+
+    crawl, carry = tracer.root.children
+    assert [child.name for child in crawl.children] == ['request'] * 6
+    assert crawl.total_bytes == 600 and tracer.root.total_requests == 6
+    # Each worker thread's attributes land on the request span it has open
+    assert all(child.attrs['latency'] == child.attrs['n'] / 100 for child in crawl.children)
+    assert carry.attrs == {'files': 2, 'error': 'OSError'}
+    assert crawl.duration <= tracer.root.duration
+
+    summary = tracer.summary().splitlines()
+    assert summary[1].split()[:2] == ['run', '1']
+    assert summary[3].split()[:2] == ['request', '6']
+
+    trace_file = tmp_path.joinpath('trace.json')
+    tracer.write(trace_file)
+    trace = json.loads(trace_file.read_text())
+    assert trace['requests'] == 6
+    assert trace['children'][0]['bytes'] == 600
+    assert len(trace['children'][0]['children']) == 6
@@ -0,0 +1,81 @@
+import os
+from datetime import date, timedelta
+
+import pytest
+
+from snbackup import backup
+from snbackup.retention import TRASH, RetentionPolicy, remove_trees
+from snbackup.snapshots import freed_bytes, snapshot_folders
+
+
+def days(start: str, count: int) -> list[str]:
+    first = date.fromisoformat(start)
+    return [str(first + timedelta(days=n)) for n in range(count)]
+
+
+def test_policy_keeps_tiers():
+    names = days('2024-01-01', 120)  # Monday 1 January to 29 April
+    assert RetentionPolicy().keep(names) == set(names)
+    assert RetentionPolicy(daily=3).keep(names) == {'2024-04-27', '2024-04-28', '2024-04-29'}
+
+    # The newest backup of each week, so Sundays apart from the current week
+    assert RetentionPolicy(weekly=3).keep(names) == {'2024-04-21', '2024-04-28', '2024-04-29'}
+    assert RetentionPolicy(monthly=3).keep(names) == {'2024-02-29', '2024-03-31', '2024-04-29'}
+    assert RetentionPolicy(daily=2, weekly=2, monthly=2).keep(names) == {
+        '2024-04-28',
+        '2024-04-29',
+        '2024-03-31',
+    }
+
+    # Gaps between backups do not use up days
+    assert RetentionPolicy(daily=2).keep(['2024-01-01', '2024-02-01', '2024-03-01']) == {'2024-02-01', '2024-03-01'}
+    # Folders keep working past 2029
+    assert RetentionPolicy(monthly=1).keep(['2029-12-31', '2030-01-01']) == {'2030-01-01'}
+
+
+@pytest.mark.parametrize('counts', [{'daily': -1}, {'weekly': 1.5}, {'monthly': '3'}, {'daily': True}])
+def test_policy_rejects_invalid_counts(counts):
+    with pytest.raises(ValueError):
+        RetentionPolicy(**counts)
+
+
+def test_remove_trees(tmp_path):
+    for n in range(20):
+        folder = tmp_path.joinpath('2024-08-01', f'Note/folder_{n % 3}/sub_{n}')
+        folder.mkdir(parents=True)
+        folder.joinpath('note.note').write_bytes(b'note')
+    tmp_path.joinpath('2024-08-01/empty').mkdir()
+    remove_trees([tmp_path.joinpath('2024-08-01')], workers=4)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cleanup_dry_run_and_prune(tmp_path, caplog):
+    backup.create_logger(str(tmp_path.joinpath('snbackup')), running_tests=True)
+    names = ['2029-12-30', '2029-12-31', '2030-01-01']
+    for name in names:
+        tmp_path.joinpath(name).mkdir()
+        tmp_path.joinpath(name, 'Ideas.note').write_bytes(b'i' * 10)
+    tmp_path.joinpath(names[0], 'Plan.note').write_bytes(b'p' * 100)
+    for name in names[1:]:
+        os.link(tmp_path.joinpath(names[0], 'Plan.note'), tmp_path.joinpath(name, 'Plan.note'))
+    tmp_path.joinpath('metadata.db').touch()
+
+    assert [folder.name for folder in snapshot_folders(tmp_path)] == names
+    # Plan.note is still linked from the backups kept, so only Ideas.note would be freed
+    assert freed_bytes(snapshot_folders(tmp_path)[:2]) == 20
+    assert freed_bytes(snapshot_folders(tmp_path)) == 130
+
+    policy = RetentionPolicy(daily=1)
+    removed = backup.cleanup_backups(tmp_path, retention=policy, dry_run=True)
+    assert [folder.name for folder in removed] == names[:2]
+    assert 'removing 2 would free 0.00 MB' in caplog.text
+    assert [folder.name for folder in snapshot_folders(tmp_path)] == names
+
+    assert backup.cleanup_backups(tmp_path, retention=policy) == removed
+    assert sorted(item.name for item in tmp_path.iterdir()) == ['2030-01-01', 'metadata.db']
+    assert tmp_path.joinpath('2030-01-01/Plan.note').read_bytes() == b'p' * 100
+
+    # Anything left in the trash by an interrupted prune goes the next time
+    tmp_path.joinpath(TRASH, '2029-12-29').mkdir(parents=True)
+    assert backup.cleanup_backups(tmp_path, retention=policy) == []
+    assert not tmp_path.joinpath(TRASH).exists()
@@ -0,0 +1,209 @@
+import sys
+import json
+import hashlib
+
+import pytest
+
+from snbackup import backup
+from snbackup.files import SnFiles
+from snbackup.device import Device
+from snbackup.helpers import today_pth
+from snbackup.objects import ObjectStore
+from snbackup.storage import Durability
+from snbackup.metadata import MetadataStore
+from snbackup.traffic import TrafficController
+from snbackup.simulator import DeviceSimulator, SyntheticTree
+
+backup.create_logger(__file__, running_tests=True)
+
+
+@pytest.fixture
+def tree() -> SyntheticTree:
+    return SyntheticTree.generate(60, depth=2, fanout=2, median_size=5000, seed=1)
+
+
+def crawl(device: Device, workers=1) -> list[SnFiles]:
+    return [
+        SnFiles(None, uri, date, size)
+        for uri, date, size in backup.device_uri_gen(device, [{'uri': 'Note', 'isDirectory': True}], workers=workers)
+    ]
+
+
+def test_generated_tree_is_repeatable(tree):
+    again = SyntheticTree.generate(60, depth=2, fanout=2, median_size=5000, seed=1)
+    assert again.files == tree.files
+    assert len(tree.files) == 60
+    assert len(tree.folders) == 1 + 6 + 2 + 4  # Device root, top level folders and Note's subfolders
+    assert tree.folder_dates['Note'] == max(date for date, _ in tree.files.values())
+
+
+def test_crawl_and_download(tree, tmp_path):
+    with DeviceSimulator(tree) as simulator:
+        device = Device(simulator.url, timeout=10, traffic=TrafficController(4))
+        files = crawl(device, workers=4)
+        for file in files:
+            file.base_path = tmp_path
+        downloaded, skipped, failed = backup.download_files(device, files, workers=4)
+        device.close()
+
+    assert sorted((f.file_uri, f.file_size) for f in files) == sorted((u, s) for u, (_, s) in tree.files.items())
+    assert len(downloaded) == len(tree.files) and not failed
+    sample = downloaded[0]
+    expected = b''.join(tree.content(sample.file_uri))
+    assert sample.full_path.read_bytes() == expected
+    assert sample.file_hash == hashlib.sha256(expected).hexdigest()
+
+
+@pytest.mark.parametrize('traffic, limit', [(None, None), (TrafficController(3), 3)])
+def test_requests_run_concurrently(tree, tmp_path, traffic, limit):
+    with DeviceSimulator(tree, latency=0.02) as simulator:
+        device = Device(simulator.url, timeout=10, traffic=traffic)
+        files = crawl(device, workers=4)
+        for file in files:
+            file.base_path = tmp_path
+        downloaded, _, failed = backup.download_files(device, files, workers=4)
+        device.close()
+
+    assert len(downloaded) == len(tree.files) and not failed
+    assert device.traffic.peak > 1
+    assert device.traffic.peak <= (limit or 4)
+
+
+def test_dropped_downloads_are_reported(tree, tmp_path):
+    with DeviceSimulator(tree, drop_rate=0.3, seed=3) as simulator:
+        device = Device(simulator.url, timeout=10, retries=0, traffic=TrafficController(2))
+        files = crawl(device)
+        for file in files:
+            file.base_path = tmp_path
+        downloaded, _, failed = backup.download_files(device, files, workers=2)
+        device.close()
+
+    assert failed and downloaded
+    assert len(downloaded) + len(failed) == len(tree.files)
+    assert not any(file.full_path.exists() for file in failed)
+
+
+def test_dropped_downloads_are_retried(tree, tmp_path):
+    with DeviceSimulator(tree, drop_rate=0.2, seed=3) as simulator:
+        device = Device(simulator.url, timeout=10, retries=6, backoff=0.001, traffic=TrafficController(2))
+        files = crawl(device)
+        for file in files:
+            file.base_path = tmp_path
+        downloaded, _, failed = backup.download_files(device, files, workers=2)
+        device.close()
+
+    assert not failed and len(downloaded) == len(tree.files)
+    assert device.retried > 0
+    assert all(file.full_path.stat().st_size == file.file_size for file in downloaded)
+
+
+def test_upload(tree, tmp_path):
+    report = tmp_path.joinpath('Report.pdf')
+    report.write_bytes(b'%PDF report')
+    books = [tmp_path.joinpath(f'book_{n}.epub') for n in range(5)]
+    for book in books:
+        book.write_bytes(b'epub' * 100)
+    duplicate = tmp_path.joinpath('other').joinpath(report.name)
+    duplicate.parent.mkdir()
+    duplicate.write_bytes(b'different')
+    unsupported = tmp_path.joinpath('notes.zip')
+    unsupported.write_bytes(b'zip')
+
+    with DeviceSimulator(tree) as simulator:
+        device = Device(simulator.url, timeout=10, traffic=TrafficController(3))
+        uploaded, skipped, failed = backup.upload_files(
+            device, [report, *books, duplicate, unsupported], 'Document', workers=3
+        )
+        assert uploaded == sorted([report, *books]) and skipped == failed == []
+        listing = backup.list_directory(device, 'Document')
+
+        report.write_bytes(b'%PDF report v2')
+        uploaded, skipped, failed = backup.upload_files(device, [report, *books], 'Document', workers=3)
+        assert (uploaded, skipped, failed) == ([report], books, [])
+        posts = [uri for method, uri in simulator.requests if method == 'POST']
+        device.close()
+
+    assert tree.uploads['Document/Report.pdf'] == b'%PDF report v2'
+    assert len(posts) == 7
+    assert sorted((entry['uri'], entry['size']) for entry in listing) == sorted(
+        [('/Document/Report.pdf', 11)] + [(f'/Document/{book.name}', 400) for book in books]
+    )
+
+
+def test_backup_end_to_end(tree, tmp_path, monkeypatch):
+    save_dir = tmp_path.joinpath('backups')
+    save_dir.mkdir()
+    config = tmp_path.joinpath('config.json')
+    with DeviceSimulator(tree) as simulator:
+        config.write_text(json.dumps({'save_dir': str(save_dir), 'device_url': simulator.url, 'workers': 4}))
+        monkeypatch.setattr(sys, 'argv', ['snbackup', '-c', str(config), '--notes'])
+        backup.backup()
+        # Rerunning on the same day finds every file already saved
+        backup.backup()
+
+    today = today_pth(save_dir)
+    saved = {path.relative_to(today).as_posix(): path for path in today.rglob('*') if path.is_file()}
+    assert sorted(saved) == sorted(tree.files)
+    uri = sorted(tree.files)[0]
+    assert saved[uri].read_bytes() == b''.join(tree.content(uri))
+    assert 'Backup complete' in save_dir.joinpath('snbackup.log').read_text()
+
+
+def test_manifest_synced_before_commit(tree, tmp_path, monkeypatch):
+    save_dir = tmp_path.joinpath('backups')
+    save_dir.mkdir()
+    config = tmp_path.joinpath('config.json')
+    durabilities, unsynced = [], []
+    sync = Durability.sync
+    commit_run = MetadataStore.commit_run
+
+    def spy_sync(self):
+        durabilities.append(self)
+        return sync(self)
+
+    def spy_commit_run(self, *args, **kwargs):
+        unsynced.extend(path for durability in durabilities for path in durability.pending_files)
+        return commit_run(self, *args, **kwargs)
+
+    monkeypatch.setattr(Durability, 'sync', spy_sync)
+    monkeypatch.setattr(MetadataStore, 'commit_run', spy_commit_run)
+    with DeviceSimulator(tree) as simulator:
+        settings = {'save_dir': str(save_dir), 'device_url': simulator.url, 'layout': 'objects', 'durability': 'batch'}
+        config.write_text(json.dumps(settings))
+        monkeypatch.setattr(sys, 'argv', ['snbackup', '-c', str(config), '--notes'])
+        backup.backup()
+
+    assert durabilities and unsynced == []
+    assert save_dir.joinpath('manifests', f'{today_pth(save_dir).name}.json').is_file()
+
+
+@pytest.mark.parametrize('layout', ['folders', 'objects'])
+def test_unreadable_unchanged_files_are_downloaded(tree, tmp_path, monkeypatch, layout):
+    """A file missing from the previous backup folder is downloaded again, also when switching to objects."""
+    save_dir = tmp_path.joinpath('backups')
+    save_dir.mkdir()
+    config = tmp_path.joinpath('config.json')
+    earlier = save_dir.joinpath('2024-08-01')
+    with DeviceSimulator(tree) as simulator:
+        config.write_text(json.dumps({'save_dir': str(save_dir), 'device_url': simulator.url}))
+        monkeypatch.setattr(sys, 'argv', ['snbackup', '-c', str(config), '--notes'])
+        monkeypatch.setattr(backup, 'today_pth', lambda _: earlier)
+        backup.backup()
+        uri = sorted(tree.files)[0]
+        earlier.joinpath(uri).unlink()
+        config.write_text(json.dumps({'save_dir': str(save_dir), 'device_url': simulator.url, 'layout': layout}))
+        monkeypatch.setattr(backup, 'today_pth', today_pth)
+        backup.backup()
+        downloads = [uri for method, uri in simulator.requests if method == 'GET' and uri in tree.files]
+
+    today = today_pth(save_dir)
+    assert len(downloads) == len(tree.files) + 1
+    if layout == 'objects':
+        objects = ObjectStore(save_dir)
+        entries = {entry['uri']: entry for entry in objects.read_manifest(today.name)}
+        assert sorted(entries) == sorted(tree.files)
+        assert objects.path(entries[uri]['hash']).read_bytes() == b''.join(tree.content(uri))
+    else:
+        assert today.joinpath(uri).read_bytes() == b''.join(tree.content(uri))
+        saved = sorted(path.relative_to(today).as_posix() for path in today.rglob('*') if path.is_file())
+        assert saved == sorted(tree.files)
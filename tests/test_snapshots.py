@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from snbackup import backup
+from snbackup.metadata import MetadataStore
+from snbackup.snapshots import SnapshotUsage, rebased, scan_snapshot, snapshot_folders, rescan_snapshots
+
+
+@pytest.fixture
+def save_dir(tmp_path):
+    """Three daily backups. Plan.note is unchanged and hard linked forward, Ideas.note is edited each day."""
+    first = tmp_path.joinpath('2024-08-01/Note/Work')
+    first.mkdir(parents=True)
+    first.joinpath('Plan.note').write_bytes(b'p' * 100)
+    first.joinpath('Ideas.note').write_bytes(b'i' * 10)
+    for day, size in (('2024-08-02', 20), ('2024-08-03', 30)):
+        folder = tmp_path.joinpath(day, 'Note/Work')
+        folder.mkdir(parents=True)
+        previous = sorted(tmp_path.glob('2024-*'))[-2]
+        os.link(previous.joinpath('Note/Work/Plan.note'), folder.joinpath('Plan.note'))
+        folder.joinpath('Ideas.note').write_bytes(b'i' * size)
+    tmp_path.joinpath('metadata.db').touch()
+    return tmp_path
+
+
+def test_scan_snapshot(save_dir):
+    first, second, third = snapshot_folders(save_dir)
+    usage, inodes = scan_snapshot(first, previous=set(), workers=2)
+    assert usage == SnapshotUsage('2024-08-01', 2, 110, 110)
+
+    assert scan_snapshot(second, previous=inodes)[0] == SnapshotUsage('2024-08-02', 2, 120, 20)
+    # Without the previous inodes, data with other links counts as shared
+    assert scan_snapshot(third)[0] == SnapshotUsage('2024-08-03', 2, 130, 30)
+
+    # Unique bytes add up to what the backups take on disk together
+    assert sum(usage.unique_bytes for usage in rescan_snapshots([first, second, third])) == 160
+
+
+def test_rebased():
+    names = ['2024-08-01', '2024-08-02', '2024-08-03', '2024-08-04', '2024-08-05']
+    assert rebased(names, set()) == []
+    assert rebased(names, {'2024-08-01', '2024-08-02'}) == [(None, '2024-08-03')]
+    assert rebased(names, {'2024-08-02', '2024-08-04'}) == [('2024-08-01', '2024-08-03'), ('2024-08-03', '2024-08-05')]
+    assert rebased(names, {'2024-08-05'}) == []
+
+
+def test_list_and_cleanup_keep_index(save_dir, caplog):
+    backup.create_logger(str(save_dir.joinpath('snbackup')), running_tests=True)
+    store = MetadataStore(save_dir.joinpath(MetadataStore.file_name))
+    try:
+        backup.list_backups(save_dir, store)
+        assert '3 backups are not in the size index' in caplog.text
+
+        backup.list_backups(save_dir, store, rescan=True)
+        assert '3 backups found' in caplog.text
+        assert '2024-08-02: 2 files' in caplog.text
+        assert [usage.unique_bytes for usage in store.snapshot_usage().values()] == [110, 20, 30]
+
+        removed = backup.cleanup_backups(save_dir, num_backups=2, cleanup=True)
+        backup.reindex_after_cleanup(store, save_dir, removed)
+        assert store.snapshot_usage() == {
+            '2024-08-02': SnapshotUsage('2024-08-02', 2, 120, 120),
+            '2024-08-03': SnapshotUsage('2024-08-03', 2, 130, 30),
+        }
+    finally:
+        store.close()
@@ -3,7 +3,7 @@ from datetime import datetime
 
 import pytest
 
-from snbackup.files import SnFiles, BadDateError
+from snbackup.files import SnFiles, BadDateError, BytesEmptyError
 
 
 @pytest.fixture
@@ -19,21 +19,6 @@ def test_full_path(some_note):
     assert some_note.full_path == Path('/test/path/2024-08-01/uri/fake.note')
 
 
-def test_file_bytes(some_note):
-    assert some_note.file_bytes == b''
-
-
-def test_file_bytes_raises_type_error(some_note):
-    with pytest.raises(TypeError) as exc_info:
-        some_note.file_bytes = 'not_bytes_object'
-        assert 'File must be bytes object' in str(exc_info)
-
-
-def test_file_bytes_sets_properly(some_note):
-    some_note.file_bytes = b'actual_bytes_object'
-    assert some_note.file_bytes == b'actual_bytes_object'
-
-
 def test_last_modified(some_note):
     assert some_note.last_modified == datetime.fromisoformat('2024-07-04 13:45:01')
 
@@ -55,5 +40,25 @@ def test_make_record(some_note):
         'uri': 'uri/fake.note',
         'modified': '2024-07-04 13:45:01',
         'size': 404040,
+        'hash': None,
     }
     assert some_note.make_record() == record
+
+    some_note.file_hash = 'abc123'
+    assert some_note.make_record()['hash'] == 'abc123'
+
+
+def test_file_hash(some_note):
+    with pytest.raises(BytesEmptyError):
+        some_note.file_hash
+
+    some_note.file_hash = 'streamed_hash'
+    assert some_note.file_hash == 'streamed_hash'
+    assert not hasattr(some_note, '__dict__')
+
+
+def test_ordering_is_total(some_note):
+    other = SnFiles(Path('/test/path/2024-08-01'), 'uri/other.note', '2024-07-04 13:45:01', 404040)
+    assert some_note != other
+    assert (some_note < other) != (some_note > other)
+    assert sorted([some_note, other]) == sorted([other, some_note]) == [some_note, other]
@@ -0,0 +1,43 @@
+import os
+import sys
+import subprocess
+
+# Packages only needed once the device is contacted or setup prompts are shown
+DEFERRED = {'httpx', 'httpcore', 'rich'}
+
+# A stdlib package the CLI doesn't load, timed the same way so the budget holds on slow machines.
+# Importing the CLI takes about twice as long, the budget leaves room for variance between runs.
+REFERENCE = 'unittest'
+IMPORT_BUDGET_RATIO = 5
+
+PROBE = 'import sys; before = set(sys.modules); import {0}; print(*set(sys.modules) - before)'
+
+
+def import_module(name: str) -> tuple[set[str], int]:
+    """Modules newly loaded by importing name in a fresh interpreter and its cumulative import time in microseconds."""
+    env = {key: value for key, value in os.environ.items() if key != 'PYTHONDONTWRITEBYTECODE'}
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE.format(name)],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    )
+    for line in result.stderr.splitlines():
+        _, cumulative, imported = line.split('|')
+        if imported.strip() == name:
+            return set(result.stdout.split()), int(cumulative)
+    raise AssertionError(f'{name} missing from -X importtime output')
+
+
+def test_cli_imports_stay_light():
+    import_module('snbackup.__main__')  # Compile and cache bytecode, as an installed package would have
+    runs = [(import_module('snbackup.__main__'), import_module(REFERENCE)) for _ in range(3)]
+    loaded = runs[0][0][0]
+    assert not {name.split('.')[0] for name in loaded} & DEFERRED
+    assert 'snbackup.device' not in loaded
+    assert REFERENCE not in loaded
+
+    cli = min(cli_time for (_, cli_time), _ in runs)
+    reference = min(reference_time for _, (_, reference_time) in runs)
+    assert cli < IMPORT_BUDGET_RATIO * reference, f'CLI import took {cli} us, {REFERENCE} took {reference} us'
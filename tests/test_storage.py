@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+from snbackup import storage
+
+
+@pytest.fixture
+def previous_file(tmp_path):
+    src = tmp_path.joinpath('2024-08-01/Note/Work/Plan.note')
+    src.parent.mkdir(parents=True)
+    src.write_bytes(b'handwritten notes')
+    return src
+
+
+def test_carry_file_hardlink(previous_file, tmp_path):
+    dst = tmp_path.joinpath('2024-08-02/Note/Work/Plan.note')
+    assert storage.carry_file(previous_file, dst, mode='hardlink') == 'hardlink'
+    assert os.path.samefile(previous_file, dst)
+    assert previous_file.stat().st_nlink == 2
+
+
+def test_carry_file_copy(previous_file, tmp_path):
+    dst = tmp_path.joinpath('2024-08-02/Note/Work/Plan.note')
+    assert storage.carry_file(previous_file, dst) == 'copy'
+    assert dst.read_bytes() == b'handwritten notes'
+    assert not os.path.samefile(previous_file, dst)
+
+
+def test_carry_file_falls_back(previous_file, tmp_path, monkeypatch):
+    def unsupported(src, dst):
+        raise OSError('not supported')
+
+    monkeypatch.setitem(storage.STRATEGIES, 'reflink', unsupported)
+    monkeypatch.setitem(storage.STRATEGIES, 'copy_file_range', unsupported)
+
+    dst = tmp_path.joinpath('2024-08-02/Note/Work/Plan.note')
+    assert storage.carry_file(previous_file, dst, mode='reflink') == 'copy'
+    assert dst.read_bytes() == b'handwritten notes'
+
+
+def test_carry_file_existing(previous_file, tmp_path):
+    assert storage.carry_file(previous_file, previous_file, mode='hardlink') == 'existing'
+    assert previous_file.read_bytes() == b'handwritten notes'
+
+    stale = tmp_path.joinpath('2024-08-02/Note/Work/Plan.note')
+    stale.parent.mkdir(parents=True)
+    stale.write_bytes(b'stale')
+    storage.carry_file(previous_file, stale, mode='copy')
+    assert stale.read_bytes() == b'handwritten notes'
+
+
+def test_carry_file_unknown_mode(previous_file, tmp_path):
+    with pytest.raises(ValueError):
+        storage.carry_file(previous_file, tmp_path.joinpath('dst'), mode='symlink')
+
+
+def test_durability_modes(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(storage, '_fsync_path', synced.append)
+
+    new_dir = tmp_path.joinpath('2024-08-02/Note/Work')
+    files = [new_dir.joinpath(f'{n}.note') for n in range(3)]
+
+    durability = storage.Durability('batch')
+    for file in files:
+        durability.makedirs(file.parent)
+        file.write_bytes(b'data')
+        durability.written(file)
+    assert durability.created == {new_dir}
+    assert synced == []
+    assert durability.sync() == len(files) + 4  # Files, their folder, then each new folder's parent
+    assert set(synced) == {*files, new_dir, new_dir.parent, new_dir.parent.parent, tmp_path}
+    assert durability.sync() == 0
+
+    synced.clear()
+    durability = storage.Durability('file')
+    durability.written(files[0])
+    assert synced == [files[0]]
+
+    synced.clear()
+    durability = storage.Durability('none')
+    durability.makedirs(tmp_path.joinpath('other'))
+    durability.written(files[0])
+    assert durability.sync() == 0
+    assert synced == []
+
+    with pytest.raises(ValueError):
+        storage.Durability('sometimes')
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='Windows only has a read-only flag')
+def test_written_files_get_default_permissions(tmp_path):
+    from snbackup import backup
+    from snbackup.objects import ObjectStore
+    from snbackup.packs import Pack
+
+    backup.create_logger(str(tmp_path.joinpath('snbackup')), running_tests=True)
+    folder = tmp_path.joinpath('2024-08-01')
+    backup.save_stream(folder.joinpath('Note/Plan.note'), [b'plan'])
+    storage.write_atomic(folder.joinpath('Note/Ideas.note'), b'ideas')
+    store = ObjectStore(tmp_path)
+    digest = store.add_stream([b'plan'])
+    pack = Pack.create(folder)
+    for path in (*folder.rglob('*.note'), store.path(digest), pack.path, pack.index_path):
+        assert path.stat().st_mode & 0o777 == storage.FILE_MODE
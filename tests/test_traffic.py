@@ -0,0 +1,71 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from snbackup import traffic
+from snbackup.traffic import TokenBucket, TrafficController
+
+
+def test_token_bucket_caps_rate(monkeypatch):
+    slept = []
+    monkeypatch.setattr(traffic.time, 'sleep', slept.append)
+    bucket = TokenBucket(1000)
+    assert bucket.consume(600) == 0.0
+    bucket.consume(900)
+    bucket.consume(500)
+    # 2000 bytes at 1000 B/s with a 1000 byte burst leaves about a second of waiting
+    assert 0.9 < sum(slept) < 1.6
+    assert slept == sorted(slept)
+
+
+def test_aimd_limit():
+    controller = TrafficController(8)
+    for latency in (0.01, 0.012, 0.011):
+        controller.record(latency)
+    assert controller.limit == 8
+
+    controller.record(error=True)
+    controller.record(error=True)  # Within the cooldown, so the limit only halves once
+    assert controller.limit == 4
+    controller.record(0.5)
+    assert controller.limit == 4
+    assert controller.decreases == {'error': 1, 'slow': 0}
+
+    for _ in range(8):
+        controller.record(0.01)
+    assert 5 < controller.limit < 6
+
+    controller._last_decrease -= traffic.DECREASE_COOLDOWN
+    controller.record(0.5)
+    assert controller.decreases == {'error': 1, 'slow': 1}
+    assert 'peak 0 in flight' in controller.state()
+
+
+def test_slot_limits_requests_in_flight():
+    controller = TrafficController(4)
+    controller.limit = 2.0
+    active, seen = [0], []
+    lock = threading.Lock()
+
+    def request(_):
+        with controller.slot():
+            with lock:
+                active[0] += 1
+                seen.append(active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        list(pool.map(request, range(12)))
+    assert max(seen) == controller.peak == 2
+    assert controller.in_flight == 0
+
+
+def test_unbounded_by_default():
+    controller = TrafficController()
+    controller.record(error=True)
+    with controller.slot(), controller.slot(), controller.slot():
+        assert controller.in_flight == 3
+    assert controller.peak == 3 and controller.decreases == {'error': 0, 'slow': 0}
+    assert controller.state().startswith('no concurrency limit')